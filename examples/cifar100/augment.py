@@ -0,0 +1,73 @@
+'''Batched tensor augmentation for uint8 image batches.
+
+Replaces the per-sample PIL pipeline
+    RandomCrop(size, padding) -> RandomHorizontalFlip -> ToTensor -> Normalize
+with a handful of vectorized ops over the whole (N, C, H, W) uint8 batch,
+run on the training device after collation.
+'''
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+__all__ = ['ToUint8Tensor', 'BatchAugment']
+
+
+class ToUint8Tensor(object):
+    """Convert a PIL image or HWC uint8 array to a CHW uint8 tensor (no scaling)."""
+
+    def __call__(self, pic):
+        img = torch.from_numpy(np.array(pic, dtype=np.uint8, copy=True))
+        if img.dim() == 2:
+            img = img.unsqueeze(-1)
+
+        return img.permute(2, 0, 1).contiguous()
+
+
+class BatchAugment(object):
+    """Pad + random crop, random horizontal flip and normalization of a uint8 batch.
+
+    With train=False only a center crop (when size differs) and normalization
+    are applied, matching the test transforms.
+    """
+
+    def __init__(self, mean, std, size, padding=0, flip=True, train=True):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1) * 255.
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1) * 255.
+        self.size = size
+        self.padding = padding
+        self.flip = flip
+        self.train = train
+
+    def crop(self, x):
+        n, c, h, w = x.size()
+        if self.padding > 0:
+            # zero fill on uint8, identical to RandomCrop(padding=p) on PIL
+            x = F.pad(x, (self.padding, self.padding, self.padding, self.padding))
+            h, w = h + 2*self.padding, w + 2*self.padding
+        if not self.train:
+            top, left = (h - self.size) // 2, (w - self.size) // 2
+            return x[:, :, top:top+self.size, left:left+self.size]
+
+        # one offset per sample, gathered with advanced indexing -> (N, size, size, C)
+        top = torch.randint(0, h - self.size + 1, (n, 1), device=x.device)
+        left = torch.randint(0, w - self.size + 1, (n, 1), device=x.device)
+        grid = torch.arange(self.size, device=x.device).view(1, -1)
+        rows = (top + grid).view(n, self.size, 1)
+        cols = (left + grid).view(n, 1, self.size)
+        batch = torch.arange(n, device=x.device).view(n, 1, 1)
+
+        return x[batch, :, rows, cols].permute(0, 3, 1, 2)
+
+    def __call__(self, x):
+        if x.size(-1) != self.size or x.size(-2) != self.size or self.padding > 0:
+            x = self.crop(x)
+        if self.train and self.flip:
+            mask = torch.rand(x.size(0), device=x.device) < 0.5
+            x = torch.where(mask.view(-1, 1, 1, 1), x.flip(3), x)
+
+        x = x.float()
+        if x.device != self.mean.device:
+            self.mean, self.std = self.mean.to(x.device), self.std.to(x.device)
+
+        return x.sub_(self.mean).div_(self.std).contiguous()
@@ -0,0 +1,85 @@
+'''Images/sec of the per-sample PIL augmentation vs. the batched tensor path.
+
+python bench_augment.py --num-images 10000 --batch-size 128 [--device cuda]
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+import config as cf
+from augment import ToUint8Tensor, BatchAugment
+
+parser = argparse.ArgumentParser(description='CIFAR-100 augmentation benchmark')
+parser.add_argument('--num-images', default=10000, type=int, help='number of synthetic 32x32 images')
+parser.add_argument('--batch-size', default=128, type=int, help='batch size of the tensor path')
+parser.add_argument('--device', default='cpu', type=str, help='device of the tensor path')
+parser.add_argument('--repeat', default=3, type=int, help='timed passes, best one is reported')
+args = parser.parse_args()
+
+rng = np.random.RandomState(0)
+images = rng.randint(0, 256, size=(args.num_images, 32, 32, 3)).astype(np.uint8)
+mean, std = cf.mean['cifar100'], cf.std['cifar100']
+
+transform_train = transforms.Compose([
+transforms.RandomCrop(32, padding=4),
+transforms.RandomHorizontalFlip(),
+transforms.ToTensor(),
+transforms.Normalize(mean, std),
+])
+device = torch.device(args.device)
+augment = BatchAugment(mean, std, 32, padding=4)
+to_tensor = ToUint8Tensor()
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def run_pil(keep=False):
+    outs = []
+    for i in range(0, args.num_images, args.batch_size):
+        out = torch.stack([transform_train(Image.fromarray(img)) for img in images[i:i+args.batch_size]])
+        out = out.to(device)
+        if keep:
+            outs.append(out.cpu())
+    sync()
+    return outs
+
+def run_batched(keep=False):
+    outs = []
+    for i in range(0, args.num_images, args.batch_size):
+        batch = torch.stack([to_tensor(img) for img in images[i:i+args.batch_size]])
+        out = augment(batch.to(device))
+        if keep:
+            outs.append(out.cpu())
+    sync()
+    return outs
+
+def best_rate(fn):
+    best = 0.
+    for _ in range(args.repeat):
+        start = time.time()
+        fn()
+        best = max(best, args.num_images / (time.time() - start))
+    return best
+
+run_batched()
+pil_rate = best_rate(run_pil)
+batched_rate = best_rate(run_batched)
+print('| PIL Compose     : %10.1f images/sec' % pil_rate)
+print('| Batched (%4s)  : %10.1f images/sec  (x%.1f)' % (device.type, batched_rate, batched_rate / pil_rate))
+
+# same distribution: per-channel moments and the zero-padding fraction should agree
+pil = torch.cat(run_pil(keep=True))
+batched = torch.cat(run_batched(keep=True))
+for name, out in (('PIL', pil), ('Batched', batched)):
+    pad_value = torch.tensor([-m / s for m, s in zip(mean, std)]).view(1, 3, 1, 1)
+    padded = (out - pad_value).abs().lt(1e-4).float().mean().item()
+    print('| %-8s mean %s std %s padded %.4f' % (name,
+          np.round(out.mean(dim=(0, 2, 3)).numpy(), 3),
+          np.round(out.std(dim=(0, 2, 3)).numpy(), 3), padded))
@@ -0,0 +1,98 @@
+'''Per-rank memory and communication cost of the ZeRO-sharded optimizer.
+
+horovodrun -np 4 -H localhost:4 --gloo python bench_zero.py --depth 28 --widen_factor 10 --batch-size 8
+
+Trains the network from the same initialization and data once with
+hvd.DistributedOptimizer(optim.SGD) ('allreduce') and once with
+ShardedOptimizer(optim.SGD) ('zero'). For each, reports per rank: momentum
+bytes, parameter + gradient bytes, bytes on the wire per step for a ring
+implementation, and the time spent waiting for gradients (synchronize) and in
+the update (the allgather included for zero), then how far the parameters of
+the two runs drifted apart (only the reduction order differs). The process
+high-water RSS only grows, so run one mode per process (--modes zero) to
+compare it.
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import horovod.torch as hvd
+
+import config as cf
+from mixed_precision import peak_memory_mb
+from wideresnet import Wide_ResNet, conv_init
+from zero import ShardedOptimizer, state_bytes
+
+parser = argparse.ArgumentParser(description='ZeRO sharded optimizer benchmark')
+parser.add_argument('--depth', default=28, type=int, help='depth of model')
+parser.add_argument('--widen_factor', default=10, type=int, help='width of model')
+parser.add_argument('--batch-size', default=8, type=int, help='batch size per rank')
+parser.add_argument('--steps', default=5, type=int, help='timed steps per mode')
+parser.add_argument('--warmup-steps', default=1, type=int, help='untimed steps per mode')
+parser.add_argument('--bucket-size-mb', default=25., type=float, help='ShardedOptimizer bucket size')
+parser.add_argument('--modes', default='allreduce,zero', type=str, help='comma separated: allreduce,zero')
+args = parser.parse_args()
+
+hvd.init()
+torch.set_num_threads(cf.get_num_threads(hvd.local_size()))
+criterion = nn.CrossEntropyLoss()
+generator = torch.Generator().manual_seed(hvd.rank())
+batches = [(torch.randn(args.batch_size, 3, 32, 32, generator=generator),
+            torch.randint(0, 100, (args.batch_size,), generator=generator)) for _ in range(args.warmup_steps + args.steps)]
+
+
+def run(mode):
+    torch.manual_seed(0)
+    net = Wide_ResNet(args.depth, args.widen_factor, 0., 100)
+    net.apply(conv_init)
+    hvd.broadcast_parameters(net.state_dict(), root_rank=0)
+    sgd = optim.SGD(net.parameters(), lr=0.01, momentum=0.9, weight_decay=5e-4)
+    if mode == 'zero':
+        optimizer = ShardedOptimizer(sgd, net.named_parameters(), args.bucket_size_mb)
+        # a reduce-scatter and an allgather of the padded buckets
+        wire = 2 * optimizer.bytes_per_step * (hvd.size() - 1) / hvd.size()
+    else:
+        optimizer = hvd.DistributedOptimizer(sgd, named_parameters=net.named_parameters())
+        wire = 2 * sum(p.numel() * p.element_size() for p in net.parameters()) * (hvd.size() - 1) / hvd.size()
+
+    net.train()
+    times = []
+    for step, (inputs, targets) in enumerate(batches):
+        start = time.time()
+        optimizer.zero_grad()
+        criterion(net(inputs), targets).backward()
+        backward = time.time()
+        optimizer.synchronize()
+        synced = time.time()
+        with optimizer.skip_synchronize():
+            optimizer.step()
+        if step >= args.warmup_steps:
+            times.append((time.time() - start, synced - backward, time.time() - synced))
+
+    step_ms, sync_ms, update_ms = 1000. * np.median(np.array(times), 0)
+    params = sum(p.numel() * p.element_size() for p in net.parameters())
+    local = torch.tensor([[state_bytes(optimizer) / 2.**20, 2 * params / 2.**20, wire / 2.**20,
+                           step_ms, sync_ms, update_ms, peak_memory_mb(torch.device('cpu'))]])
+    return hvd.allgather(local, name='bench_zero.' + mode), [p.detach().clone() for p in net.parameters()]
+
+
+if hvd.rank() == 0:
+    print('| WRN-%d-%d, batch %d per rank, %d ranks' % (args.depth, args.widen_factor, args.batch_size, hvd.size()))
+final = {}
+for mode in args.modes.split(','):
+    stats, final[mode] = run(mode)
+    if hvd.rank() == 0:
+        for rank, row in enumerate(stats.tolist()):
+            print('| %-9s rank %d  momentum %8.1f MB  params+grads %8.1f MB  wire %8.1f MB/step  '
+                  'step %8.1f ms  sync %7.1f ms  update %7.1f ms  peak rss %8.1f MB' % ((mode, rank) + tuple(row)))
+
+if len(final) == 2 and hvd.rank() == 0:
+    # as one vector: conv biases feeding a BatchNorm hold rounding noise around 0
+    a, b = [torch.cat([p.flatten() for p in final[mode]]) for mode in ('allreduce', 'zero')]
+    drift = ((a - b).abs().max() / a.abs().max()).item()
+    print('| largest relative parameter difference allreduce vs zero: %.2e' % drift)
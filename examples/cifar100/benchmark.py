@@ -0,0 +1,276 @@
+'''Synthetic-data training throughput of Wide_ResNet / PreResNet.
+
+python benchmark.py --arch WIDERESNET --depth 16,28 --widen_factor 4,10 --batch-size 64,128
+horovodrun -np 4 python benchmark.py --horovod --scaling weak --output bench.json
+python benchmark.py --device cpu --modes eager,compile --channels-last
+python benchmark.py --recompute none,every1,stages23 --memory-budget-mb 16000
+horovodrun -np 4 python benchmark.py --horovod --optim sgd,flat --bucket-size-mb 25
+
+Every configuration runs --warmup-steps untimed and --steps timed SGD steps on
+random tensors, and appends one JSON record per configuration to --output.
+Scaling efficiency is computed against a 1-rank record of the same
+configuration found in --output or --baseline; throughput below the --baseline
+record by more than --tolerance is flagged as a regression (exit code 1).
+Compiled modes report their speedup over the eager run of the same
+configuration; compilation happens during the warmup steps.
+Each record also holds the activation memory saved for backward by one step;
+with --memory-budget-mb, the largest per-rank batch whose weights, gradients,
+momentum and activations fit that budget is extrapolated from it.
+--optim flat runs the flat-bucket SGD of flat_optim.py (one allreduce per
+bucket under --horovod); every record holds the optimizer step time and the
+allreduce calls per step (per-tensor for sgd, as counted by the optimizer
+for flat; 0 without --horovod, where nothing is allreduced).
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import config as cf
+from preresnet import *
+from wideresnet import *
+from mixed_precision import amp_dtype, autocast, grad_scaler, peak_memory_mb
+from compiled import channels_last, compile_model
+from recompute import enable_recompute, saved_activation_bytes
+from flat_optim import BucketedDistributedOptimizer, FlatSGD
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+parser = argparse.ArgumentParser(description='CIFAR-100 synthetic throughput benchmark')
+parser.add_argument('--arch', default='WIDERESNET', type=str, help='comma separated: WIDERESNET,PRERESNET')
+parser.add_argument('--depth', default='28', type=int_list, help='comma separated depths')
+parser.add_argument('--widen_factor', default='10', type=int_list, help='comma separated widen factors (WIDERESNET)')
+parser.add_argument('--batch-size', default='128', type=int_list, help='comma separated batch sizes (per rank for weak, global for strong scaling)')
+parser.add_argument('--dropout', default=0.3, type=float, help='dropout_rate')
+parser.add_argument('--num-classes', default=100, type=int, help='number of classes')
+parser.add_argument('--image-size', default=32, type=int, help='input resolution')
+parser.add_argument('--warmup-steps', default=5, type=int, help='untimed steps per configuration')
+parser.add_argument('--steps', default=20, type=int, help='timed steps per configuration')
+parser.add_argument('--device', default='auto', choices=['auto', 'cuda', 'cpu'], help='benchmark device')
+parser.add_argument('--amp', action='store_true', help='bf16 autocast on cpu, fp16 + loss scaling on cuda')
+parser.add_argument('--modes', default='eager', type=str, help='comma separated: eager,compile,trace')
+parser.add_argument('--channels-last', action='store_true', help='NHWC weights and inputs')
+parser.add_argument('--compile-cache', default='./compile_cache', type=str, help='persistent inductor cache')
+parser.add_argument('--recompute', default='none', type=str, help='comma separated: none, every<K>, stages<digits>')
+parser.add_argument('--optim', default='sgd', type=str, help='comma separated: sgd (per-tensor), flat (flat buckets)')
+parser.add_argument('--bucket-size-mb', default=25., type=float, help='bucket size of --optim flat')
+parser.add_argument('--memory-budget-mb', default=0., type=float, help='per-rank memory used to estimate the largest batch')
+parser.add_argument('--horovod', action='store_true', help='run data-parallel under horovodrun')
+parser.add_argument('--scaling', default='weak', choices=['weak', 'strong'], help='weak: --batch-size per rank, strong: --batch-size global')
+parser.add_argument('--output', default='benchmark.json', type=str, help='JSON file the records are appended to')
+parser.add_argument('--baseline', default='', type=str, help='JSON records of a reference run to compare against')
+parser.add_argument('--tolerance', default=0.05, type=float, help='relative throughput drop flagged as a regression')
+args = parser.parse_args()
+
+if args.horovod:
+    import horovod.torch as hvd
+    hvd.init()
+    rank, size, local_rank, local_size = hvd.rank(), hvd.size(), hvd.local_rank(), hvd.local_size()
+else:
+    hvd = None
+    rank, size, local_rank, local_size = 0, 1, 0, 1
+
+use_cuda = torch.cuda.is_available() if args.device == 'auto' else args.device == 'cuda'
+if use_cuda:
+    torch.cuda.set_device(local_rank)
+    device = torch.device('cuda', local_rank)
+else:
+    torch.set_num_threads(cf.get_num_threads(local_size))
+    device = torch.device('cpu')
+
+def load_records(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return []
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def config_key(record, ranks=None, batch_key='batch_size'):
+    return (record['arch'], record['depth'], record['widen_factor'], record['device'], record.get('precision', 'fp32'),
+            record.get('mode', 'eager'), record.get('channels_last', False), record.get('recompute', 'none'), record.get('optim', 'sgd'), record[batch_key], record['ranks'] if ranks is None else ranks)
+
+def valid_depth(arch, depth):
+    return (depth - 4) % 6 == 0 if arch == 'WIDERESNET' else (depth - 2) % 6 == 0
+
+def build(arch, depth, widen_factor):
+    if arch == 'WIDERESNET':
+        net = Wide_ResNet(depth, widen_factor, args.dropout, args.num_classes)
+        net.apply(conv_init)
+    elif arch == 'PRERESNET':
+        net = preresnet(depth=depth, num_classes=args.num_classes)
+    else:
+        raise ValueError('unknown arch %s' % arch)
+    return net.to(device)
+
+def sync():
+    if use_cuda:
+        torch.cuda.synchronize(device)
+
+def run(arch, depth, widen_factor, batch_size, mode, recompute, optim_type):
+    per_rank = batch_size if args.scaling == 'weak' else max(batch_size // size, 1)
+    net = enable_recompute(build(arch, depth, widen_factor), recompute)
+    if args.channels_last:
+        channels_last(net)
+    model = net if mode == 'eager' else compile_model(net, mode, args.compile_cache)
+    criterion = nn.CrossEntropyLoss().to(device)
+    if hvd is not None:
+        hvd.broadcast_parameters(net.state_dict(), root_rank=0)
+    if optim_type == 'flat':
+        if hvd is not None:
+            optimizer = BucketedDistributedOptimizer(net.named_parameters(), lr=0.01, momentum=0.9, weight_decay=5e-4,
+                                                     bucket_size_mb=args.bucket_size_mb)
+        else:
+            optimizer = FlatSGD(net.parameters(), lr=0.01, momentum=0.9, weight_decay=5e-4, bucket_size_mb=args.bucket_size_mb)
+    else:
+        optimizer = optim.SGD(net.parameters(), lr=0.01, momentum=0.9, weight_decay=5e-4)
+        if hvd is not None:
+            optimizer = hvd.DistributedOptimizer(optimizer, named_parameters=net.named_parameters())
+    inputs = torch.randn(per_rank, 3, args.image_size, args.image_size, device=device)
+    if args.channels_last:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    targets = torch.randint(0, args.num_classes, (per_rank,), device=device)
+    precision = amp_dtype(device)
+    scaler = grad_scaler(device, precision, args.amp)
+    if use_cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+
+    net.train()
+    latencies, step_times = [], []
+    for step in range(args.warmup_steps + args.steps):
+        sync()
+        start = time.time()
+        optimizer.zero_grad()
+        with autocast(device, precision, args.amp):
+            loss = criterion(model(inputs), targets)
+        scaler.scale(loss).backward()
+        if hvd is not None:
+            optimizer.synchronize()
+            scaler.unscale_(optimizer)
+            sync()
+            step_start = time.time()
+            with optimizer.skip_synchronize():
+                scaler.step(optimizer)
+        else:
+            scaler.unscale_(optimizer)
+            sync()
+            step_start = time.time()
+            scaler.step(optimizer)
+        scaler.update()
+        sync()
+        if step >= args.warmup_steps:
+            latencies.append(time.time() - start)
+            step_times.append(time.time() - step_start)
+
+    latencies = np.array(latencies)
+    with autocast(device, precision, args.amp):
+        activations = saved_activation_bytes(model, inputs, lambda outputs: criterion(outputs, targets))
+    if hvd is not None:
+        # consume the allreduce the extra backward started
+        optimizer.synchronize()
+    optimizer.zero_grad()
+    if hvd is None:
+        allreduces = 0
+    elif optim_type == 'flat':
+        allreduces = optimizer.allreduces_per_step
+    else:
+        # hvd.DistributedOptimizer launches one per gradient tensor
+        allreduces = sum(p.requires_grad for p in net.parameters())
+    # weights, gradients and momentum
+    static = 3 * sum(p.numel() * p.element_size() for p in net.parameters())
+    # process-wide high-water mark on cpu
+    peak_mem = peak_memory_mb(device)
+    if hvd is not None:
+        # the slowest rank sets the pace of a synchronous step
+        latencies = hvd.allreduce(torch.from_numpy(latencies), name='bench_latency', op=hvd.Max).numpy()
+        peak_mem = hvd.allreduce(torch.tensor([peak_mem]), name='bench_mem', op=hvd.Max).item()
+
+    return {
+        'arch': arch,
+        'depth': depth,
+        'widen_factor': widen_factor if arch == 'WIDERESNET' else 0,
+        'device': device.type,
+        'precision': str(precision).split('.')[-1] if args.amp else 'fp32',
+        'mode': mode,
+        'channels_last': args.channels_last,
+        'ranks': size,
+        'scaling': args.scaling,
+        'batch_size': per_rank,
+        'global_batch': per_rank * size,
+        'images_per_sec': round(float(per_rank * size * len(latencies) / latencies.sum()), 2),
+        'latency_ms': dict(('p%d' % q, round(1000. * np.percentile(latencies, q), 3)) for q in (50, 90, 99)),
+        'peak_mem_mb': round(peak_mem, 1),
+        'recompute': recompute,
+        'optim': optim_type,
+        'allreduces_per_step': allreduces,
+        'optimizer_ms': round(1000. * float(np.median(step_times)), 3),
+        'activation_mb': round(activations / 2.**20, 1),
+        'max_batch_est': int((args.memory_budget_mb * 2.**20 - static) * per_rank / activations) if args.memory_budget_mb else None,
+        'commit': git_commit(),
+        'host': platform.node(),
+        'torch': torch.__version__,
+        'time': time.time(),
+    }
+
+records = load_records(args.output)
+baseline = load_records(args.baseline)
+new_records = []
+regressions = 0
+for arch in args.arch.split(','):
+    for depth in args.depth:
+        if not valid_depth(arch, depth):
+            if rank == 0:
+                print('| skipping %s depth %d (WIDERESNET needs 6n+4, PRERESNET 6n+2)' % (arch, depth))
+            continue
+        for widen_factor in (args.widen_factor if arch == 'WIDERESNET' else [0]):
+            for batch_size, mode, recompute, optim_type in [(b, m, r, o) for b in args.batch_size for m in args.modes.split(',')
+                                                            for r in args.recompute.split(',') for o in args.optim.split(',')]:
+                record = run(arch, depth, widen_factor, batch_size, mode, recompute, optim_type)
+                eager = [r for r in new_records if r['mode'] == 'eager' and
+                         config_key(dict(r, mode=mode)) == config_key(record)]
+                if eager and mode != 'eager':
+                    record['speedup_vs_eager'] = round(record['images_per_sec'] / eager[-1]['images_per_sec'], 3)
+                # single-rank reference: same per-rank batch (weak) or same global batch (strong)
+                batch_key = 'batch_size' if args.scaling == 'weak' else 'global_batch'
+                single = [r for r in records + baseline + new_records
+                          if r['ranks'] == 1 and config_key(r, batch_key=batch_key) == config_key(record, 1, batch_key)]
+                if single and size > 1:
+                    record['scaling_efficiency'] = round(record['images_per_sec'] / (size * single[-1]['images_per_sec']), 4)
+                ref = [r for r in baseline if config_key(r) == config_key(record)]
+                if ref:
+                    record['baseline_images_per_sec'] = ref[-1]['images_per_sec']
+                    record['regression'] = bool(record['images_per_sec'] < (1. - args.tolerance) * ref[-1]['images_per_sec'])
+                    regressions += record['regression']
+                new_records.append(record)
+                if rank == 0:
+                    print('| %-10s %-8s %-7s %-9s %-4s depth %3d k %2d  batch %4d x %2d ranks  %9.1f img/s  p50 %8.2f ms  p99 %8.2f ms  opt %7.2f ms  %4d allreduces  mem %8.1f MB  act %8.1f MB%s%s%s%s' % (
+                        arch, record['precision'], mode, recompute, optim_type, depth, record['widen_factor'], record['batch_size'], size, record['images_per_sec'],
+                        record['latency_ms']['p50'], record['latency_ms']['p99'], record['optimizer_ms'], record['allreduces_per_step'], record['peak_mem_mb'], record['activation_mb'],
+                        '  max batch ~%d' % record['max_batch_est'] if record['max_batch_est'] is not None else '',
+                        '  eff %.2f' % record['scaling_efficiency'] if 'scaling_efficiency' in record else '',
+                        '  x%.2f vs eager' % record['speedup_vs_eager'] if 'speedup_vs_eager' in record else '',
+                        '  REGRESSION' if record.get('regression') else ''))
+                    sys.stdout.flush()
+
+if rank == 0:
+    with open(args.output + '.tmp', 'w') as f:
+        json.dump(records + new_records, f, indent=1, sort_keys=True)
+    os.rename(args.output + '.tmp', args.output)
+    print('| %d records written to %s' % (len(new_records), args.output))
+sys.exit(1 if regressions else 0)
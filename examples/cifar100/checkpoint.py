@@ -0,0 +1,179 @@
+'''Asynchronous, atomic checkpointing.
+
+Checkpoints are plain dicts of state_dicts:
+    {'net', 'optimizer', 'scaler', 'sampler', 'epoch', 'batch_idx',
+     'epoch_done', 'acc', 'best_acc', 'config'}
+with the accuracies as fractions in [0, 1], written as <dir>/<file_name>-e<epoch>-s<step>.pth (periodic, the newest
+`keep` are retained) and <dir>/<file_name>-best.pth.
+
+save() snapshots every tensor to host memory and returns; a background thread
+writes the snapshot to a temporary file and renames it into place, so a crash
+never leaves a truncated checkpoint behind. If a write is still running when
+the next snapshot arrives, only the newest pending snapshot of each kind
+(periodic / best) is kept.
+'''
+import glob
+import os
+import re
+import threading
+import time
+
+import torch
+import torch.nn as nn
+
+
+__all__ = ['CheckpointManager', 'atomic_save', 'find_checkpoint', 'load_checkpoint']
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        # clone: training keeps updating device and host tensors in place
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _periodic(directory, file_name):
+    pattern = re.compile(re.escape(file_name) + r'-e(\d+)-s(\d+)\.pth$')
+    found = []
+    for path in glob.glob(os.path.join(directory, file_name + '-e*-s*.pth')):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            found.append(((int(match.group(1)), int(match.group(2))), path))
+    return [path for _, path in sorted(found)]
+
+
+def find_checkpoint(directory, file_name, which='last'):
+    """Path of the newest periodic ('last') or the 'best' checkpoint, or None.
+
+    Falls back to the other kind, then to the legacy <file_name>.t7 file.
+    """
+    best = os.path.join(directory, file_name + '-best.pth')
+    periodic = _periodic(directory, file_name)
+    candidates = [best] + periodic[-1:] if which == 'best' else periodic[-1:] + [best]
+    candidates.append(os.path.join(directory, file_name + '.t7'))
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_checkpoint(path, map_location='cpu'):
+    # legacy .t7 files pickle modules and need the full unpickler
+    legacy = path.endswith('.t7')
+    try:
+        checkpoint = torch.load(path, map_location=map_location, weights_only=not legacy)
+    except TypeError:
+        checkpoint = torch.load(path, map_location=map_location)
+    if isinstance(checkpoint.get('net'), nn.Module):
+        # legacy main.py checkpoint pickling the whole module
+        net = checkpoint['net']
+        checkpoint['net'] = (net.module if hasattr(net, 'module') else net).state_dict()
+        checkpoint.setdefault('epoch_done', True)
+        if checkpoint.get('acc') is not None:
+            # the legacy format stored a percentage
+            checkpoint['acc'] = checkpoint['acc'] / 100.
+    return checkpoint
+
+
+def atomic_save(state, path):
+    """torch.save to a temporary file, fsync, then rename over `path`."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class CheckpointManager(object):
+    """Writes checkpoints on a background thread; only the enabled rank writes.
+
+    due(step) is true every `interval_steps` optimizer steps or
+    `interval_minutes` minutes, whichever is configured.
+    """
+
+    def __init__(self, directory, file_name, keep=3, interval_steps=0, interval_minutes=0., enabled=True):
+        self.directory = directory
+        self.file_name = file_name
+        self.keep = keep
+        self.interval_steps = interval_steps
+        self.interval_minutes = interval_minutes
+        self.enabled = enabled
+        self.last_time = time.time()
+        self._pending = {}
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._error = None
+
+    def due(self, step):
+        if self.interval_steps > 0 and step > 0 and step % self.interval_steps == 0:
+            return True
+        if self.interval_minutes > 0 and time.time() - self.last_time >= 60. * self.interval_minutes:
+            return True
+        return False
+
+    def save(self, state, best=False):
+        """Snapshot `state` to host memory and queue it for writing."""
+        self.last_time = time.time()
+        self._raise()
+        if not self.enabled:
+            return
+        # the directory is made on first use: ranks enabled after an elastic reset write too
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if best:
+            path = os.path.join(self.directory, self.file_name + '-best.pth')
+        else:
+            path = os.path.join(self.directory, '%s-e%03d-s%06d.pth' % (self.file_name, state['epoch'], state.get('step', 0)))
+        snapshot = _to_cpu(state)
+        with self._cond:
+            # latest wins: a snapshot of the same kind nobody started writing is replaced
+            self._pending[best] = (path, snapshot)
+            self._cond.notify_all()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                best = sorted(self._pending)[0]
+                path, snapshot = self._pending.pop(best)
+                self._busy = True
+            try:
+                atomic_save(snapshot, path)
+                if not best:
+                    self._prune()
+            except Exception as e:
+                # keep serving the queue; wait() or the next save() re-raises
+                with self._cond:
+                    self._error = e
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _prune(self):
+        for path in _periodic(self.directory, self.file_name)[:-self.keep] if self.keep > 0 else []:
+            os.remove(path)
+
+    def _raise(self):
+        with self._cond:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def wait(self):
+        """Block until every queued snapshot is on disk; re-raises a failed write."""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+        self._raise()
@@ -0,0 +1,325 @@
+'''Communication timeline of a bounded window of training steps.
+
+The profiler wraps the optimizer's allreduce launch: _allreduce_grad_async of
+hvd.DistributedOptimizer (one tensor, named as in named_parameters, e.g.
+layer3.2.conv2.weight) or the bucket launch of
+flat_optim.BucketedDistributedOptimizer. A thread polls the outstanding
+handles to time their completion. Gradient hooks time when each parameter's
+gradient is ready; hooks on the autograd node behind each leaf module's output
+give the module's backward span. On CUDA these stamps are events, resolved to
+host time after the step, so they show when the device ran the kernels, not
+when they were queued.
+
+For steps [start, start + steps) the training loop brackets each optimizer step
+with begin_step()/end_step() and its backward with begin_backward()/
+end_backward(). After the window, rank 0 writes:
+
+    <path>.json   Chrome trace (chrome://tracing, ui.perfetto.dev): step and
+                  backward spans, module backward spans, one async slice per
+                  allreduce from gradient ready to completion
+    <path>.txt    summary: communication hidden behind backward vs exposed
+                  after it, the gradients finishing latest, and the estimated
+                  fusion-buffer utilization
+
+and, where Horovod supports it, the Horovod timeline of the same window to
+<path>.horovod.json. The fusion estimate treats tensors seen complete in the
+same polling sweep as one fused response; the Horovod timeline has the exact
+responses. A handle that synchronize() clears before the poller sees it counts
+as finished when it was found cleared.
+'''
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+import torch
+import horovod.torch as hvd
+
+from flat_optim import BucketedDistributedOptimizer
+
+
+__all__ = ['CommProfiler']
+
+
+def _union(intervals):
+    total, end = 0., None
+    for a, b in sorted(intervals):
+        if end is None or a > end:
+            total += b - a
+            end = b
+        elif b > end:
+            total += b - end
+            end = b
+    return total
+
+
+def _clip(intervals, lo, hi):
+    return [(max(a, lo), min(b, hi)) for a, b in intervals if min(b, hi) > max(a, lo)]
+
+
+class CommProfiler(object):
+    """Records the allreduces and backward of steps [start, start + steps).
+
+    A disabled profiler installs nothing and its methods return at once, so
+    the training loop calls them unconditionally.
+    """
+
+    def __init__(self, optimizer, net, path, start=20, steps=10, device=torch.device('cpu'),
+                 enabled=True, poll_interval=0.0002):
+        self.path = path
+        self.start = start
+        self.steps = steps
+        self.device = device
+        self.enabled = enabled
+        self.poll_interval = poll_interval
+        self.step = 0
+        self.active = False
+        self.records = []
+        if not enabled:
+            return
+
+        self.names = dict((p, name) for name, p in net.named_parameters())
+        self.modules = [(name, m) for name, m in net.named_modules()
+                        if len(list(m.parameters(recurse=False))) > 0]
+        self._hooks = []
+        self._pending = []
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sweep = 0
+        if hasattr(optimizer, '_allreduce_grad_async'):
+            launch = optimizer._allreduce_grad_async
+
+            def traced(p):
+                handle, ctx = launch(p)
+                self._launched(self.names.get(p, 'param'), [p], handle)
+                return handle, ctx
+            optimizer._allreduce_grad_async = traced
+        elif isinstance(optimizer, BucketedDistributedOptimizer):
+            launch = optimizer._allreduce
+
+            def traced(index):
+                launch(index)
+                self._launched('flat.bucket.%d' % index, optimizer.buckets[index].params, optimizer._handles[index])
+            optimizer._allreduce = traced
+        else:
+            raise ValueError('communication profiling needs hvd.DistributedOptimizer or --flat-buckets, not %s'
+                             % type(optimizer).__name__)
+
+    # timestamps: host seconds on CPU, CUDA events resolved in end_step()
+    def _stamp(self):
+        if self.device.type == 'cuda':
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.time()
+
+    def _resolve(self, stamp):
+        if self.device.type == 'cuda':
+            return self._anchor_time + self._anchor.elapsed_time(stamp) / 1000.
+        return stamp
+
+    def _launched(self, name, params, handle):
+        if not self.active:
+            return
+        record = {'name': name, 'bytes': sum(p.numel() * p.element_size() for p in params),
+                  'params': [self.names.get(p, '') for p in params], 'launch': time.time()}
+        self._current['tensors'].append(record)
+        with self._lock:
+            self._pending.append((record, handle))
+            self._outstanding += 1
+
+    def _poll(self):
+        while self.active:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            self._sweep += 1
+            now = time.time()
+            for record, handle in pending:
+                try:
+                    done = hvd.poll(handle)
+                except Exception:
+                    # synchronize() already waited for it and released the handle
+                    record['finish'], record['sweep'], done = now, None, True
+                with self._lock:
+                    if done:
+                        record.setdefault('finish', now)
+                        record.setdefault('sweep', self._sweep)
+                        self._outstanding -= 1
+                    else:
+                        self._pending.append((record, handle))
+            time.sleep(self.poll_interval)
+
+    def _install(self):
+        def grad_ready(p):
+            if self.active:
+                self._current['ready'][self.names.get(p, '')] = self._stamp()
+
+        def forward(name):
+            def hook(module, inputs, output):
+                node = getattr(output, 'grad_fn', None)
+                if not self.active or node is None:
+                    return
+
+                def pre(grad_outputs):
+                    self._current['modules'].append((name, 'begin', self._stamp()))
+
+                def post(grad_inputs, grad_outputs):
+                    self._current['modules'].append((name, 'end', self._stamp()))
+                node.register_prehook(pre)
+                node.register_hook(post)
+            return hook
+
+        for p in self.names:
+            if p.requires_grad:
+                self._hooks.append(p.register_post_accumulate_grad_hook(grad_ready))
+        for name, module in self.modules:
+            self._hooks.append(module.register_forward_hook(forward(name)))
+        self._thread = threading.Thread(target=self._poll)
+        self._thread.daemon = True
+        if hasattr(hvd, 'start_timeline'):
+            hvd.start_timeline(self.path + '.horovod.json', mark_cycles=True)
+
+    def _remove(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        if hasattr(hvd, 'stop_timeline'):
+            hvd.stop_timeline()
+
+    def begin_step(self):
+        if not self.enabled or not self.start <= self.step < self.start + self.steps:
+            return
+        if self.step == self.start:
+            self._install()
+        if self.device.type == 'cuda':
+            self._anchor = torch.cuda.Event(enable_timing=True)
+            self._anchor.record()
+            self._anchor.synchronize()
+            self._anchor_time = time.time()
+        self._current = {'step': self.step, 'begin': self._stamp(), 'ready': {}, 'modules': [], 'tensors': []}
+        self.active = True
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def begin_backward(self):
+        if self.active:
+            # with gradient accumulation the last backward of the step is kept
+            self._current['backward_begin'] = self._stamp()
+            self._current['modules'] = []
+
+    def end_backward(self):
+        if self.active:
+            self._current['backward_end'] = self._stamp()
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        if self.active:
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+            step = self._current
+            step['end'] = time.time()
+            while self._outstanding > 0:
+                # the poller times the completions synchronize() has waited for
+                time.sleep(self.poll_interval)
+            for key in ('begin', 'backward_begin', 'backward_end'):
+                step[key] = self._resolve(step[key])
+            step['modules'] = [(name, kind, self._resolve(stamp)) for name, kind, stamp in step['modules']]
+            ready = dict((name, self._resolve(stamp)) for name, stamp in step['ready'].items())
+            for record in step['tensors']:
+                times = [ready[name] for name in record['params'] if name in ready]
+                # Horovod starts a tensor once its gradient is ready on the device
+                record['ready'] = max([record['launch']] + times)
+            del step['ready']
+            self.records.append(step)
+        self.step += 1
+        if self.active and self.step == self.start + self.steps:
+            self.active = False
+            self._thread.join()
+            self._remove()
+            if hvd.rank() == 0:
+                self.write()
+
+    def write(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'traceEvents': self.trace(), 'displayTimeUnit': 'ms'}, f)
+        summary = self.summary()
+        with open(self.path + '.txt', 'w') as f:
+            f.write(summary + '\n')
+        print(summary)
+        print('| Communication profile written to %s.json and %s.txt' % (self.path, self.path))
+
+    def trace(self):
+        origin = self.records[0]['begin']
+        us = lambda t: round(1e6 * (t - origin), 1)
+        pid = hvd.rank()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in enumerate(['steps', 'modules backward', 'allreduce'])]
+        serial = 0
+        for step in self.records:
+            events.append({'name': 'step %d' % step['step'], 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': us(step['begin']), 'dur': round(us(step['end']) - us(step['begin']), 1)})
+            events.append({'name': 'backward', 'ph': 'X', 'pid': pid, 'tid': 0, 'ts': us(step['backward_begin']),
+                           'dur': round(us(step['backward_end']) - us(step['backward_begin']), 1)})
+            for name, kind, stamp in step['modules']:
+                events.append({'name': name, 'ph': 'B' if kind == 'begin' else 'E', 'pid': pid, 'tid': 1, 'ts': us(stamp)})
+            for record in step['tensors']:
+                serial += 1
+                args = {'bytes': record['bytes'], 'params': record['params'], 'launch_us': us(record['launch'])}
+                events.append({'name': record['name'], 'cat': 'allreduce', 'ph': 'b', 'id': serial,
+                               'pid': pid, 'tid': 2, 'ts': us(record['ready']), 'args': args})
+                events.append({'name': record['name'], 'cat': 'allreduce', 'ph': 'e', 'id': serial,
+                               'pid': pid, 'tid': 2, 'ts': us(record['finish'])})
+        return events
+
+    def summary(self, top=10):
+        n = float(len(self.records))
+        backward = comm = hidden = exposed = step_time = sent = launches = 0.
+        late, responses = {}, []
+        for step in self.records:
+            b0, b1 = step['backward_begin'], step['backward_end']
+            intervals = [(r['ready'], r['finish']) for r in step['tensors']]
+            backward += b1 - b0
+            comm += _union(intervals)
+            hidden += _union(_clip(intervals, b0, b1))
+            exposed += _union(_clip(intervals, b1, float('inf')))
+            step_time += step['end'] - step['begin']
+            sent += sum(r['bytes'] for r in step['tensors'])
+            launches += len(step['tensors'])
+            for r in step['tensors']:
+                entry = late.setdefault(r['name'], [0., 0., 0., r['bytes']])
+                entry[0] += r['ready'] - b0
+                entry[1] += r['finish'] - b0
+                entry[2] += max(r['finish'] - b1, 0.)
+            sweeps = {}
+            for r in step['tensors']:
+                if r.get('sweep') is not None:
+                    sweeps[r['sweep']] = sweeps.get(r['sweep'], 0) + r['bytes']
+            responses.extend(sweeps.values())
+
+        threshold = int(os.environ.get('HOROVOD_FUSION_THRESHOLD', 64 * 2**20))
+        ms = lambda t: 1000. * t / n
+        lines = ['Communication profile: steps %d-%d, rank %d of %d'
+                 % (self.start, self.start + len(self.records) - 1, hvd.rank(), hvd.size()),
+                 '| Step                          %8.2f ms' % ms(step_time),
+                 '| Backward                      %8.2f ms' % ms(backward),
+                 '| Allreduce busy (union)        %8.2f ms' % ms(comm),
+                 '|   hidden behind backward      %8.2f ms (%.1f%%)' % (ms(hidden), 100. * hidden / max(comm, 1e-12)),
+                 '|   exposed after backward      %8.2f ms' % ms(exposed),
+                 '| Launches per step             %8d (%.2f MB)' % (launches / n, sent / n / 2.**20)]
+        if responses:
+            fill = [float(b) / threshold for b in responses]
+            lines.append('| Estimated fused responses     %8.1f per step, mean %.2f MB, fusion buffer %.1f%% full on average, %.1f%% at most (HOROVOD_FUSION_THRESHOLD %d MB)'
+                         % (len(responses) / n, sum(responses) / len(responses) / 2.**20,
+                            100. * sum(fill) / len(fill), 100. * max(fill), threshold // 2**20))
+        lines.append('| Latest gradients (ms after backward start, mean over steps):')
+        lines.append('|   %-40s %8s %8s %8s %8s' % ('tensor', 'ready', 'done', 'exposed', 'MB'))
+        for name, (ready, finish, tail, nbytes) in sorted(late.items(), key=lambda item: -item[1][1])[:top]:
+            lines.append('|   %-40s %8.2f %8.2f %8.2f %8.2f' % (name, ms(ready), ms(finish), ms(tail), nbytes / 2.**20))
+        return '\n'.join(lines)
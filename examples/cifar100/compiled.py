@@ -0,0 +1,92 @@
+'''Channels-last and compiled execution of the CIFAR models.
+
+compile_model() wraps a model with torch.compile (inductor) and falls back to
+TorchScript tracing when torch.compile is missing or refuses the model.
+torch.compile is lazy: dynamo and inductor run, and fail (unsupported ops, no
+C++ toolchain), on the first call in each train/eval mode, so CompiledModule
+catches errors there and switches to the trace for good. Both
+share parameters and buffers with the wrapped model, so the optimizer,
+broadcast_parameters and checkpoints keep using the original module.
+
+Inductor keeps compiled kernels and FX graphs in an on-disk cache; pointing
+cache_dir at a persistent directory lets a restarted job skip most of the
+compile time. A trace is cheap and is simply redone on every start.
+'''
+import os
+import warnings
+
+import torch
+import torch.nn as nn
+
+
+__all__ = ['channels_last', 'compile_model', 'CompiledModule', 'TracedModule']
+
+
+def channels_last(net):
+    """Convert conv weights and activations of `net` to NHWC in place."""
+    return net.to(memory_format=torch.channels_last)
+
+
+class TracedModule(nn.Module):
+    """TorchScript trace of `module`, one per train/eval mode.
+
+    A trace bakes in the mode of dropout and batch norm, so each mode is
+    traced on its first call, with that call's inputs, and selected by
+    module.training.
+    """
+
+    def __init__(self, module):
+        super(TracedModule, self).__init__()
+        self.module = module
+        self._traced = {}
+
+    def forward(self, inputs):
+        mode = self.module.training
+        if mode not in self._traced:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self._traced[mode] = torch.jit.trace(self.module, inputs, check_trace=False)
+        return self._traced[mode](inputs)
+
+
+class CompiledModule(nn.Module):
+    """torch.compile of `module`, replaced by a TracedModule if its first call in a mode fails."""
+
+    def __init__(self, module, mode=None):
+        super(CompiledModule, self).__init__()
+        self.module = module
+        self._compiled = torch.compile(module, mode=mode)
+        self._fallback = None
+        self._checked = set()
+
+    def forward(self, inputs):
+        if self._fallback is not None:
+            return self._fallback(inputs)
+        mode = self.module.training
+        if mode in self._checked:
+            return self._compiled(inputs)
+        try:
+            outputs = self._compiled(inputs)
+        except Exception as e:
+            print ("| torch.compile failed ({}), tracing instead".format(e))
+            self._fallback = TracedModule(self.module)
+            return self._fallback(inputs)
+        self._checked.add(mode)
+        return outputs
+
+
+def compile_model(net, backend='compile', cache_dir='', mode=None):
+    """Return a module computing net(x) through torch.compile or a trace.
+
+    backend: 'compile' (falling back to a trace) or 'trace'.
+    """
+    if backend == 'compile' and hasattr(torch, 'compile'):
+        if cache_dir:
+            # read by inductor when it first compiles
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+            os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        try:
+            return CompiledModule(net, mode=mode)
+        except Exception as e:
+            print ("| torch.compile unavailable ({}), tracing instead".format(e))
+    return TracedModule(net)
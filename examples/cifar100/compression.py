@@ -0,0 +1,232 @@
+'''Gradient compression with error feedback for data-parallel SGD.
+
+fp16 uses Horovod's own compressor inside hvd.DistributedOptimizer. Top-k
+sparsification and PowerSGD do not fit Horovod's allreduce-only Compressor
+interface (top-k needs an allgather, PowerSGD two dependent allreduces), so
+they go through CompressedDistributedOptimizer, which communicates in step().
+
+Every rank keeps its own error-feedback residuals (what compression dropped
+from its gradients), so they stay out of optimizer.state, which holds what all
+ranks share and rank 0 checkpoints. residual_state_dict() and
+load_residual_state_dict() save and restore one rank's residuals, keyed by
+parameter name; main_horovod.py writes them to a per-rank file next to the
+checkpoint. Residuals are kept unscaled: with a GradScaler the training loop
+sets grad_scale to its current scale before synchronize(), so growth or
+back-off of the scale does not reweight what has accumulated, and a step
+with a non-finite averaged gradient (which every rank then skips) leaves the
+residuals as they were. PowerSGD's warm-start Q is averaged over the ranks, the same
+everywhere, and stays in optimizer.state[p]['powersgd_q'].
+'''
+import contextlib
+import zlib
+
+import torch
+import horovod.torch as hvd
+
+
+__all__ = ['TopKCompressor', 'PowerSGDCompressor', 'CompressedDistributedOptimizer',
+           'dense_bytes', 'build_compression']
+
+
+def dense_bytes(params):
+    return sum(p.numel() * p.element_size() for p in params if p.requires_grad)
+
+
+class TopKCompressor(object):
+    """Keep the `ratio` largest-magnitude entries of every gradient; allgather them."""
+
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def reduce(self, items):
+        """items: [(name, corrected_grad, state)] -> ([averaged], [local approximation], bytes sent)"""
+        handles, locals_, sent = [], [], 0
+        for name, grad, state in items:
+            flat = grad.reshape(-1)
+            k = max(1, int(flat.numel() * self.ratio))
+            _, indices = flat.abs().topk(k, sorted=False)
+            values = flat[indices]
+            local = torch.zeros_like(flat).index_put_((indices,), values)
+            locals_.append(local.view_as(grad))
+            handles.append((hvd.allgather_async(values, name='topk.values.' + name),
+                            hvd.allgather_async(indices.int(), name='topk.indices.' + name)))
+            sent += values.numel() * (values.element_size() + 4)
+
+        averaged = []
+        for (name, grad, state), (values, indices) in zip(items, handles):
+            values, indices = hvd.synchronize(values), hvd.synchronize(indices)
+            dense = torch.zeros(grad.numel(), dtype=grad.dtype, device=grad.device)
+            dense.index_add_(0, indices.long(), values)
+            averaged.append(dense.div_(hvd.size()).view_as(grad))
+
+        return averaged, locals_, sent
+
+
+class PowerSGDCompressor(object):
+    """Rank-r PowerSGD (Vogels et al. 2019): M ~ P Q^T with one power iteration per step.
+
+    Vectors (BatchNorm, biases) are allreduced uncompressed.
+    """
+
+    def __init__(self, rank):
+        self.rank = rank
+
+    def _q(self, name, matrix, state):
+        rank = min(self.rank, *matrix.size())
+        if 'powersgd_q' not in state:
+            # same seed on every rank so Q starts out identical
+            gen = torch.Generator().manual_seed(zlib.crc32(name.encode()))
+            state['powersgd_q'] = torch.randn(matrix.size(1), rank, generator=gen).to(matrix)
+        return state['powersgd_q']
+
+    def reduce(self, items):
+        sent = 0
+        dense, low_rank = [], []
+        for i, (name, grad, state) in enumerate(items):
+            if grad.dim() <= 1:
+                dense.append((i, hvd.allreduce_async(grad, name='powersgd.dense.' + name)))
+                sent += grad.numel() * grad.element_size()
+            else:
+                low_rank.append(i)
+
+        # P = M Q, averaged over ranks and orthogonalized
+        ps = []
+        for i in low_rank:
+            name, grad, state = items[i]
+            matrix = grad.reshape(grad.size(0), -1)
+            p = matrix.mm(self._q(name, matrix, state))
+            ps.append(hvd.allreduce_async_(p, name='powersgd.p.' + name))
+            sent += p.numel() * p.element_size()
+        ps = [torch.linalg.qr(hvd.synchronize(h))[0] for h in ps]
+
+        # Q = M^T P, averaged over ranks; kept as the next warm start
+        qs = []
+        for i, p in zip(low_rank, ps):
+            name, grad, state = items[i]
+            q = grad.reshape(grad.size(0), -1).t().mm(p)
+            qs.append(hvd.allreduce_async_(q, name='powersgd.q.' + name))
+            sent += q.numel() * q.element_size()
+
+        averaged, locals_ = [None] * len(items), [None] * len(items)
+        for i, p, h in zip(low_rank, ps, qs):
+            name, grad, state = items[i]
+            q = hvd.synchronize(h)
+            # an overflow step is skipped; keep the last finite warm start
+            state['powersgd_q'] = torch.where(torch.isfinite(q).all(), q, state['powersgd_q'])
+            averaged[i] = locals_[i] = p.mm(q.t()).view_as(grad)
+        for i, h in dense:
+            # sent exactly, nothing left for error feedback
+            averaged[i], locals_[i] = hvd.synchronize(h), items[i][1]
+
+        return averaged, locals_, sent
+
+
+class CompressedDistributedOptimizer(object):
+    """Wraps a torch optimizer; step() allreduces compressed, error-corrected gradients.
+
+    Mirrors the parts of hvd.DistributedOptimizer the training loop uses:
+    synchronize(), skip_synchronize(), param_groups, state_dict().
+    """
+
+    def __init__(self, optimizer, named_parameters, compressor):
+        self.optimizer = optimizer
+        self.compressor = compressor
+        self._names = dict((p, name) for name, p in named_parameters)
+        self.residuals = {}
+        self.grad_scale = 1.
+        self._skip_synchronize = False
+        self.bytes_sent = 0
+        self.dense_bytes = 0
+        self.steps = 0
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    @property
+    def bytes_per_step(self):
+        return self.bytes_sent // max(self.steps, 1)
+
+    @property
+    def compression_ratio(self):
+        return float(self.dense_bytes) / max(self.bytes_sent, 1)
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        # older checkpoints hold rank 0's residuals in the shared state
+        for state in state_dict['state'].values():
+            state.pop('residual', None)
+        self.optimizer.load_state_dict(state_dict)
+
+    def residual_state_dict(self):
+        return dict((self._names[p], r) for p, r in self.residuals.items())
+
+    def load_residual_state_dict(self, residuals):
+        params = dict((name, p) for p, name in self._names.items())
+        self.residuals = dict((params[name], r.to(params[name])) for name, r in residuals.items())
+
+    def synchronize(self):
+        items = []
+        params = [p for group in self.param_groups for p in group['params'] if p.grad is not None]
+        scale = self.grad_scale
+        for p in params:
+            if p not in self.residuals:
+                self.residuals[p] = torch.zeros_like(p.grad)
+            items.append((self._names[p], p.grad + self.residuals[p] * scale, self.optimizer.state[p]))
+
+        averaged, locals_, sent = self.compressor.reduce(items)
+        # averaged gradients are the same on every rank, and so is this verdict; no host sync
+        overflow = torch.stack([~torch.isfinite(avg).all() for avg in averaged]).any()
+        for p, (name, corrected, state), avg, local in zip(params, items, averaged, locals_):
+            residual = torch.nan_to_num((corrected - local) / scale, 0., 0., 0.)
+            self.residuals[p] = torch.where(overflow, self.residuals[p], residual)
+            p.grad.copy_(avg)
+        self.bytes_sent += sent
+        self.dense_bytes += dense_bytes(params)
+        self.steps += 1
+
+    @contextlib.contextmanager
+    def skip_synchronize(self):
+        self._skip_synchronize = True
+        try:
+            yield
+        finally:
+            self._skip_synchronize = False
+
+    def step(self, closure=None):
+        if not self._skip_synchronize:
+            self.synchronize()
+        return self.optimizer.step(closure)
+
+
+def build_compression(optimizer, named_parameters, method, topk_ratio=0.01, powersgd_rank=4, **kwargs):
+    """Distributed optimizer for --compression; kwargs go to hvd.DistributedOptimizer."""
+    named_parameters = list(named_parameters)
+    if method in ('none', 'fp16'):
+        compression = hvd.Compression.fp16 if method == 'fp16' else hvd.Compression.none
+        optimizer = hvd.DistributedOptimizer(optimizer, named_parameters=named_parameters,
+                                             compression=compression, **kwargs)
+        # fixed wire size, recorded so both paths report the same way
+        full = dense_bytes(p for _, p in named_parameters)
+        optimizer.bytes_per_step = full // 2 if method == 'fp16' else full
+        optimizer.compression_ratio = 2. if method == 'fp16' else 1.
+        # one per gradient tensor; Horovod's tensor fusion may pack them into fewer buffers
+        optimizer.allreduces_per_step = sum(p.requires_grad for _, p in named_parameters)
+        return optimizer
+    if method == 'topk':
+        compressor = TopKCompressor(topk_ratio)
+    elif method == 'powersgd':
+        compressor = PowerSGDCompressor(powersgd_rank)
+    else:
+        raise ValueError('unknown compression %s' % method)
+
+    return CompressedDistributedOptimizer(optimizer, named_parameters, compressor)
@@ -1,5 +1,6 @@
 ############### Pytorch CIFAR configuration file ###############
 import math
+import os
 
 start_epoch = 0
 num_epochs = 200
@@ -44,8 +45,40 @@ def learning_rate(init, epoch, warmup_epoch, batch_idx, batch_count, hvd_size):
 
     return init*math.pow(0.2, optim_factor)*hvd_size
 
+def learning_rate_poly(init, epoch, warmup_epoch, batch_idx, batch_count, hvd_size, total_epochs, power=2.):
+    # linear warmup to init*hvd_size, then polynomial decay to zero (large-batch LARS/LAMB)
+    progress = epoch + float(batch_idx + 1) / batch_count
+    if(progress < warmup_epoch):
+        return init * (progress * (hvd_size - 1) / warmup_epoch + 1)
+
+    decay = max(1. - (progress - warmup_epoch) / max(total_epochs - warmup_epoch, 1), 0.)
+    return init*hvd_size*math.pow(decay, power)
+
+def local_sgd_period(epoch, warmup_epoch, periods):
+    # fully synchronous during warmup, then the period of the last (epoch, period) milestone reached
+    if(epoch < warmup_epoch):
+        return 1
+    period = 1
+    for start, value in periods:
+        if(epoch >= start):
+            period = value
+
+    return period
+
 def get_hms(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
 
     return h, m, s
+
+def get_num_threads(local_size):
+    # cores this process may run on (respects taskset / horovodrun binding)
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    if cores == (os.cpu_count() or cores):
+        # unbound: every local rank sees all the cores, split them evenly
+        cores = cores // max(local_size, 1)
+
+    return max(cores, 1)
@@ -0,0 +1,45 @@
+'''Merge the per-rank optimizer shards of a --zero checkpoint.
+
+python consolidate_zero.py checkpoint/wide-resnet-28x10-e009-s003900.pth
+
+main_horovod.py --zero writes the optimizer state of rank r of N to
+<name>-zero<r>of<N><suffix> next to rank 0's <name><suffix>. This reads every
+shard, merges them into the layout of a plain optim.SGD state_dict and writes
+the checkpoint back (atomically, or to --output) with the optimizer included.
+The result resumes on any number of ranks, with or without --zero.
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import re
+
+from checkpoint import atomic_save, load_checkpoint
+from zero import consolidate_state_dicts
+
+
+parser = argparse.ArgumentParser(description='Merge ZeRO optimizer shards into a checkpoint')
+parser.add_argument('checkpoint', type=str, help='rank 0 checkpoint of a --zero run')
+parser.add_argument('--output', default='', type=str, help='write here instead of replacing the checkpoint')
+args = parser.parse_args()
+
+checkpoint = load_checkpoint(args.checkpoint)
+size = checkpoint.pop('zero', None)
+assert size, 'Error: %s has no optimizer shards' % args.checkpoint
+
+directory, base = os.path.split(args.checkpoint)
+match = re.match(r'(.*?)(-e\d+-s\d+|-best)\.pth$', base)
+assert match, 'Error: not a checkpoint name written by main_horovod.py: %s' % base
+shards = []
+for rank in range(size):
+    path = os.path.join(directory, '%s-zero%dof%d%s.pth' % (match.group(1), rank, size, match.group(2)))
+    assert os.path.exists(path), 'Error: missing shard %s' % path
+    shard = load_checkpoint(path)
+    assert (shard['epoch'], shard['step']) == (checkpoint['epoch'], checkpoint['step']), \
+        'Error: %s is from epoch %d step %d' % (path, shard['epoch'], shard['step'])
+    shards.append(shard['optimizer'])
+
+checkpoint['optimizer'] = consolidate_state_dicts(shards)
+output = args.output or args.checkpoint
+atomic_save(checkpoint, output)
+print('| Merged %d shards, optimizer state of %d parameters, into %s' % (size, len(checkpoint['optimizer']['state']), output))
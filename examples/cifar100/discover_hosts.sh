@@ -0,0 +1,11 @@
+#!/bin/bash
+# Host discovery for elastic training on a single machine.
+#
+#   echo 2 > slots
+#   horovodrun -np 2 --min-np 1 --max-np 4 --host-discovery-script ./discover_hosts.sh \
+#       python main_horovod.py --elastic --commit-interval 20 --device cpu --datadir ...
+#
+# Write a new number of local slots to the file while training runs to add or
+# remove workers; killing a worker process simulates a failed rank.
+SLOTS_FILE=${SLOTS_FILE:-$(dirname "$0")/slots}
+echo "localhost:$(cat "$SLOTS_FILE" 2>/dev/null || echo 1)"
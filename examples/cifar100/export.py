@@ -0,0 +1,201 @@
+'''Inference export of a trained Wide_ResNet / PreResNet checkpoint.
+
+python export.py --datadir ~/data --checkpoint checkpoint/wide-resnet-28x10-best.pth --int8
+
+The model is traced with torch.fx; in eval mode dropout is an identity and is
+removed, which leaves every BatchNorm that directly follows a convolution
+(bn2 of wide_basic and BasicBlock, bn2/bn3 of Bottleneck) foldable into that
+convolution. The pre-activation bn1 of each block and the final BatchNorm read
+the residual sum, which the shortcut also needs unnormalized, so they stay.
+fuse_fx then folds those BatchNorms and fuses conv+relu.
+
+Written to --output-dir: a TorchScript trace of the fused fp32 model, an ONNX
+export of it (when the onnx exporter is installed) and, with --int8, a
+TorchScript trace of the static int8 model calibrated on --calib-batches
+training batches. Every variant is timed (batch-1 latency, batched
+throughput) and evaluated against the fp32 eager model.
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import operator
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.fx as fx
+import torch.nn as nn
+import torchvision
+import torchvision.transforms as transforms
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, fuse_fx, prepare_fx
+
+import config as cf
+from checkpoint import find_checkpoint, load_checkpoint
+from models import get_network
+
+
+__all__ = ['strip_for_inference', 'fuse_for_inference', 'quantize_static']
+
+
+def strip_for_inference(net):
+    """FX graph of `net` (in eval mode) without dropout/identity calls or in-place adds."""
+    gm = fx.symbolic_trace(net.eval())
+    modules = dict(gm.named_modules())
+    for node in list(gm.graph.nodes):
+        if node.op == 'call_module' and isinstance(modules[node.target], (nn.Dropout, nn.Identity)):
+            node.replace_all_uses_with(node.args[0])
+            gm.graph.erase_node(node)
+        elif node.op == 'call_function' and node.target is operator.iadd:
+            # out += residual; quantization only has patterns for add
+            node.target = operator.add
+    gm.graph.lint()
+    gm.recompile()
+    gm.delete_all_unused_submodules()
+    return gm
+
+
+def fuse_for_inference(net):
+    """Fold conv->bn and fuse conv->relu; the result is numerically the eval model."""
+    return fuse_fx(strip_for_inference(net))
+
+
+def quantize_static(net, calibration, backend='x86'):
+    """Post-training static int8 quantization calibrated on an iterable of input batches."""
+    torch.backends.quantized.engine = backend
+    inputs = next(iter(calibration))
+    prepared = prepare_fx(strip_for_inference(net), get_default_qconfig_mapping(backend), (inputs,))
+    with torch.inference_mode():
+        for inputs in calibration:
+            prepared(inputs)
+    return convert_fx(prepared)
+
+
+def count_batchnorms(net):
+    return sum(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in net.modules())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained CIFAR-100 model for inference')
+    parser.add_argument('--datadir', required=True, type=str, help='data directory')
+    parser.add_argument('--checkpoint', default='', type=str, help='checkpoint file (default: best checkpoint in --checkpoint-dir)')
+    parser.add_argument('--checkpoint-dir', default='./checkpoint', type=str, help='directory searched without --checkpoint')
+    parser.add_argument('--arch', default='WIDERESNET', type=str, help='used when the checkpoint has no config')
+    parser.add_argument('--depth', default=28, type=int, help='used when the checkpoint has no config')
+    parser.add_argument('--widen_factor', default=10, type=int, help='used when the checkpoint has no config')
+    parser.add_argument('--num-classes', default=100, type=int, help='used when the checkpoint has no config')
+    parser.add_argument('--output-dir', default='./export', type=str, help='directory of the exported artifacts')
+    parser.add_argument('--int8', action='store_true', help='also export a static int8 model')
+    parser.add_argument('--qbackend', default='x86', choices=['x86', 'fbgemm', 'qnnpack'], help='quantized kernel backend')
+    parser.add_argument('--calib-batches', default=32, type=int, help='training batches used to calibrate int8 ranges')
+    parser.add_argument('--eval-batches', default=0, type=int, help='test batches evaluated per variant (0: all)')
+    parser.add_argument('--batch-size', default=128, type=int, help='calibration, evaluation and throughput batch size')
+    parser.add_argument('--latency-iters', default=100, type=int, help='batch-1 forward passes timed per variant')
+    parser.add_argument('--throughput-iters', default=10, type=int, help='batched forward passes timed per variant')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op threads (0: torch default)')
+    parser.add_argument('--report', default='', type=str, help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    warnings.filterwarnings('ignore', category=torch.jit.TracerWarning)
+
+    path = args.checkpoint or find_checkpoint(args.checkpoint_dir, get_network(
+        args.arch, args.depth, args.widen_factor, 0., args.num_classes)[1], 'best')
+    assert path and os.path.exists(path), 'Error: No checkpoint found!'
+    checkpoint = load_checkpoint(path)
+    config = checkpoint.get('config') or {}
+    net, file_name = get_network(config.get('arch', args.arch), config.get('depth', args.depth),
+                                 config.get('widen_factor', args.widen_factor), 0.,
+                                 config.get('num_classes', args.num_classes))
+    # InPlaceABN is a BatchNorm2d subclass with |weight| and leaky ReLU; fuse_fx would fold it as a plain BN
+    assert not config.get('inplace_abn'), 'Error: --inplace-abn checkpoints cannot be folded, serve them with serve.py'
+    net.load_state_dict(checkpoint['net'])
+    net.eval()
+    print('| Loaded %s' % path)
+
+    normalize = transforms.Normalize(cf.mean['cifar100'], cf.std['cifar100'])
+    testset = torchvision.datasets.CIFAR100(root=args.datadir, train=False, download=False,
+                                            transform=transforms.Compose([transforms.ToTensor(), normalize]))
+    testloader = torch.utils.data.DataLoader(testset, batch_size=args.batch_size, shuffle=False, num_workers=2)
+    # calibration sees un-augmented training images, like test-time inputs
+    calibset = torchvision.datasets.CIFAR100(root=args.datadir, train=True, download=False,
+                                             transform=transforms.Compose([transforms.ToTensor(), normalize]))
+    calibloader = torch.utils.data.DataLoader(calibset, batch_size=args.batch_size, shuffle=True, num_workers=2)
+
+    def evaluate(model):
+        correct, total = 0, 0
+        with torch.inference_mode():
+            for batch_idx, (inputs, targets) in enumerate(testloader):
+                if args.eval_batches and batch_idx >= args.eval_batches:
+                    break
+                correct += model(inputs).argmax(1).eq(targets).sum().item()
+                total += targets.size(0)
+        return 100. * correct / total
+
+    def benchmark(model):
+        single = torch.randn(1, 3, 32, 32)
+        batch = torch.randn(args.batch_size, 3, 32, 32)
+        latencies = []
+        with torch.inference_mode():
+            for i in range(args.latency_iters + 10):
+                start = time.time()
+                model(single)
+                if i >= 10:
+                    latencies.append(time.time() - start)
+            model(batch)
+            start = time.time()
+            for _ in range(args.throughput_iters):
+                model(batch)
+            elapsed = time.time() - start
+        return {
+            'latency_ms': dict(('p%d' % q, round(1000. * np.percentile(latencies, q), 3)) for q in (50, 99)),
+            'images_per_sec': round(args.batch_size * args.throughput_iters / elapsed, 1),
+        }
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    example = torch.randn(1, 3, 32, 32)
+
+    variants = [('fp32 eager', net)]
+    fused = fuse_for_inference(net)
+    print('| Folded %d of %d BatchNorms into convolutions' % (count_batchnorms(net) - count_batchnorms(fused), count_batchnorms(net)))
+    scripted = torch.jit.freeze(torch.jit.trace(fused, example, check_trace=False))
+    scripted_path = os.path.join(args.output_dir, file_name + '-fp32.pt')
+    torch.jit.save(scripted, scripted_path)
+    print('| Wrote %s' % scripted_path)
+    variants.append(('fp32 fused torchscript', scripted))
+
+    onnx_path = os.path.join(args.output_dir, file_name + '.onnx')
+    try:
+        torch.onnx.export(fused, example, onnx_path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17)
+        print('| Wrote %s' % onnx_path)
+    except Exception as e:
+        # the exporter needs the optional onnx / onnxscript packages
+        print('| ONNX export skipped: %s' % e)
+
+    if args.int8:
+        calibration = [inputs for _, (inputs, _) in zip(range(args.calib_batches), calibloader)]
+        quantized = quantize_static(net, calibration, args.qbackend)
+        quantized = torch.jit.freeze(torch.jit.trace(quantized, example, check_trace=False))
+        int8_path = os.path.join(args.output_dir, file_name + '-int8.pt')
+        torch.jit.save(quantized, int8_path)
+        print('| Wrote %s (%d calibration batches)' % (int8_path, len(calibration)))
+        variants.append(('int8 torchscript', quantized))
+
+    results = []
+    for name, model in variants:
+        result = dict(benchmark(model), variant=name, top1=round(evaluate(model), 2))
+        result['top1_delta'] = round(result['top1'] - results[0]['top1'], 2) if results else 0.
+        results.append(result)
+        print('| %-24s latency p50 %7.3f ms  p99 %7.3f ms  %9.1f img/s  Acc@1 %6.2f%% (%+.2f)' % (
+            name, result['latency_ms']['p50'], result['latency_ms']['p99'], result['images_per_sec'],
+            result['top1'], result['top1_delta']))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'checkpoint': path, 'threads': torch.get_num_threads(), 'results': results}, f, indent=1)
@@ -0,0 +1,216 @@
+'''Flat parameter/gradient buckets with a fused SGD step and bucketed allreduce.
+
+The parameters of each param group are copied into a few contiguous buffers of
+about `bucket_size_mb`, filled in reverse registration order so that the first
+bucket holds the last layers, whose gradients backward produces first. Every
+parameter, its .grad and its momentum buffer become views into their bucket:
+autograd accumulates gradients straight into the flat buffers, zero_grad() is
+one fill per bucket, and FlatSGD updates all buckets with a handful of
+torch._foreach_* kernels instead of a Python loop over hundreds of tensors.
+The arithmetic is that of optim.SGD (momentum without dampening or nesterov,
+L2 weight decay), in the same order, so the results are identical.
+
+BucketedDistributedOptimizer adds gradient hooks: once every parameter of a
+bucket has its gradient for the step, the whole bucket is allreduced
+asynchronously while backward continues, one Horovod call per bucket instead
+of one per tensor. It mirrors the parts of hvd.DistributedOptimizer the
+training loop uses: synchronize(), skip_synchronize(), backward_passes_per_step.
+
+Momentum is exposed per parameter in optimizer.state[p]['momentum_buffer'], so
+state_dict() has the optim.SGD layout and checkpoints load into either one.
+Code must not replace p.data or set p.grad to None afterwards, which would
+detach the parameter from its bucket.
+'''
+import contextlib
+
+import torch
+from torch.optim import Optimizer
+
+try:
+    import horovod.torch as hvd
+except ImportError:
+    # FlatSGD alone runs without Horovod
+    hvd = None
+
+
+__all__ = ['FlatBucket', 'FlatSGD', 'BucketedDistributedOptimizer']
+
+
+def _nbytes(p):
+    return p.numel() * p.element_size()
+
+
+def _split(params, bucket_bytes):
+    """Consecutive runs of `params` of about bucket_bytes, one dtype and device each."""
+    buckets, current, size = [], [], 0
+    for p in params:
+        if current and (size + _nbytes(p) > bucket_bytes or p.dtype != current[0].dtype
+                        or p.device != current[0].device):
+            buckets.append(current)
+            current, size = [], 0
+        current.append(p)
+        size += _nbytes(p)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+class FlatBucket(object):
+    """Contiguous parameter, gradient and (optionally) momentum storage of some parameters.
+
+    The buffers are zero-padded to a multiple of `pad_to` elements.
+    """
+
+    def __init__(self, params, pad_to=1, momentum=True):
+        self.params = params
+        self.numel = sum(p.numel() for p in params)
+        padded = self.numel + (-self.numel) % pad_to
+        self.param = torch.zeros(padded, dtype=params[0].dtype, device=params[0].device)
+        self.grad = torch.zeros_like(self.param)
+        self.momentum = torch.zeros_like(self.param) if momentum else None
+        self.momentum_views = []
+        offset = 0
+        with torch.no_grad():
+            for p in params:
+                # keeps the strides, so channels_last weights stay channels_last
+                view = self.param.as_strided(p.size(), p.stride(), offset)
+                view.copy_(p)
+                p.data = view
+                p.grad = self.grad.as_strided(p.size(), p.stride(), offset)
+                if momentum:
+                    self.momentum_views.append(self.momentum.as_strided(p.size(), p.stride(), offset))
+                offset += p.numel()
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.param)
+
+
+class FlatSGD(Optimizer):
+    """optim.SGD over flat buckets; every step is a few foreach kernels per param group."""
+
+    def __init__(self, params, lr, momentum=0., weight_decay=0., bucket_size_mb=25.):
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay)
+        super(FlatSGD, self).__init__(params, defaults)
+        self.bucket_size_mb = bucket_size_mb
+        self.group_buckets = []
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.requires_grad]
+            buckets = [FlatBucket(b) for b in _split(params[::-1], bucket_size_mb * 2.**20)]
+            for bucket in buckets:
+                for p, momentum in zip(bucket.params, bucket.momentum_views):
+                    self.state[p]['momentum_buffer'] = momentum
+            self.group_buckets.append(buckets)
+
+    @property
+    def buckets(self):
+        return [b for buckets in self.group_buckets for b in buckets]
+
+    def zero_grad(self, set_to_none=False):
+        # gradients must stay views into the buckets
+        for bucket in self.buckets:
+            bucket.grad.zero_()
+
+    def load_state_dict(self, state_dict):
+        super(FlatSGD, self).load_state_dict(state_dict)
+        with torch.no_grad():
+            for bucket in self.buckets:
+                for p, momentum in zip(bucket.params, bucket.momentum_views):
+                    loaded = self.state[p].get('momentum_buffer')
+                    if loaded is None:
+                        # optim.SGD before its first step: a zero buffer is equivalent
+                        momentum.zero_()
+                    elif loaded is not momentum:
+                        momentum.copy_(loaded)
+                    self.state[p]['momentum_buffer'] = momentum
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group, buckets in zip(self.param_groups, self.group_buckets):
+            if not buckets:
+                continue
+            params = [b.param for b in buckets]
+            grads = [b.grad for b in buckets]
+            if group['weight_decay'] != 0:
+                grads = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+            if group['momentum'] != 0:
+                # the buffers start at zero, so the first step sets them to the gradient as optim.SGD does
+                bufs = [b.momentum for b in buckets]
+                torch._foreach_mul_(bufs, group['momentum'])
+                torch._foreach_add_(bufs, grads)
+                grads = bufs
+            torch._foreach_add_(params, grads, alpha=-group['lr'])
+
+        return loss
+
+
+class BucketedDistributedOptimizer(FlatSGD):
+    """FlatSGD whose buckets are allreduced (averaged) as soon as backward fills them."""
+
+    def __init__(self, named_parameters, lr, momentum=0., weight_decay=0., bucket_size_mb=25.,
+                 backward_passes_per_step=1):
+        named_parameters = list(named_parameters)
+        super(BucketedDistributedOptimizer, self).__init__(
+            [p for _, p in named_parameters], lr, momentum, weight_decay, bucket_size_mb)
+        self.backward_passes_per_step = backward_passes_per_step
+        self._skip_synchronize = False
+        self._handles = {}
+        self._arrived = [0] * len(self.buckets)
+        self.allreduce_calls = 0
+        self.steps = 0
+        self.bytes_per_step = sum(b.nbytes for b in self.buckets)
+        self.compression_ratio = 1.
+        for index, bucket in enumerate(self.buckets):
+            for p in bucket.params:
+                p.register_post_accumulate_grad_hook(self._make_hook(index))
+
+    @property
+    def allreduces_per_step(self):
+        return self.allreduce_calls // self.steps if self.steps else len(self.buckets)
+
+    def _make_hook(self, index):
+        expected = len(self.buckets[index].params) * self.backward_passes_per_step
+
+        def hook(p):
+            self._arrived[index] += 1
+            if self._arrived[index] == expected:
+                self._allreduce(index)
+        return hook
+
+    def _allreduce(self, index):
+        self._handles[index] = hvd.allreduce_async_(self.buckets[index].grad, name='flat.bucket.%d' % index,
+                                                    op=hvd.Average)
+        self.allreduce_calls += 1
+
+    def synchronize(self):
+        for index in range(len(self.buckets)):
+            # parameters without a gradient this step still take part, with zeros
+            if index not in self._handles:
+                self._allreduce(index)
+        for handle in self._handles.values():
+            hvd.synchronize(handle)
+        self.reset()
+        self.steps += 1
+
+    def reset(self):
+        """Forget the allreduces of the current step, e.g. one abandoned by an elastic reset."""
+        self._handles.clear()
+        self._arrived = [0] * len(self.buckets)
+
+    @contextlib.contextmanager
+    def skip_synchronize(self):
+        self._skip_synchronize = True
+        try:
+            yield
+        finally:
+            self._skip_synchronize = False
+
+    def step(self, closure=None):
+        if not self._skip_synchronize:
+            self.synchronize()
+        return super(BucketedDistributedOptimizer, self).step(closure)
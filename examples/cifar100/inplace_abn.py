@@ -0,0 +1,144 @@
+'''In-place activated BatchNorm for the pre-activation blocks.
+
+(Rota Bulo et al., In-Place Activated BatchNorm, https://arxiv.org/abs/1712.02616)
+
+A pre-activation block computes conv(relu(bn(x))); autograd keeps x for the
+BatchNorm backward and relu(bn(x)) for the conv backward. InPlaceABN keeps only
+the activated output y, which the following conv stores anyway, and recovers
+the normalized input from it during backward:
+
+    z = leaky_relu^-1(y),  x_hat = (z - beta) / gamma
+
+This needs an invertible activation and a non-zero scale, so ReLU becomes a
+leaky ReLU (slope 0.01 by default) and the scale is |weight| + eps. The blocks
+therefore compute a slightly different function than the ReLU originals and
+are trained with it from the start; parameter and buffer names are unchanged.
+
+convert_inplace_abn(net) swaps the block classes of a Wide_ResNet or PreResNet.
+'''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from preresnet import BasicBlock, Bottleneck
+from wideresnet import wide_basic
+
+
+__all__ = ['InPlaceABN', 'convert_inplace_abn']
+
+
+class _InPlaceABNFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x, weight, bias, running_mean, running_var, training, momentum, eps, slope):
+        # half/bfloat16 inputs are normalized in float32
+        dtype, compute = x.dtype, torch.promote_types(x.dtype, torch.float32)
+        gamma = weight.to(compute).abs() + eps
+        y, mean, invstd = torch.native_batch_norm(x.to(compute), gamma, bias.to(compute), running_mean, running_var,
+                                                   training, momentum, eps)
+        if not training:
+            mean, invstd = running_mean.to(compute), torch.rsqrt(running_var.to(compute) + eps)
+        y = F.leaky_relu_(y, slope).to(dtype)
+
+        ctx.save_for_backward(y, weight, bias, running_mean, running_var, mean, invstd)
+        ctx.training, ctx.eps, ctx.slope = training, eps, slope
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        y, weight, bias, running_mean, running_var, mean, invstd = ctx.saved_tensors
+        dtype, compute = grad_y.dtype, invstd.dtype
+        shape = [1, -1] + [1] * (y.dim() - 2)
+        gamma = weight.to(compute).abs() + ctx.eps
+        y, grad_y = y.to(compute), grad_y.to(compute)
+
+        grad_z = torch.ops.aten.leaky_relu_backward(grad_y, y, ctx.slope, True)
+        # z = leaky_relu^-1(y), then x = (z - beta) / (gamma * invstd) + mean
+        scale = 1. / (gamma * invstd)
+        x = torch.addcmul((mean - bias.to(compute) * scale).view(shape), F.leaky_relu(y, 1. / ctx.slope), scale.view(shape))
+        del y
+        grad_x, grad_gamma, grad_bias = torch.ops.aten.native_batch_norm_backward(
+            grad_z, x, gamma, running_mean, running_var, mean, invstd, ctx.training, ctx.eps, [True, True, True])
+
+        sign = torch.where(weight >= 0, torch.ones_like(weight), -torch.ones_like(weight))
+        return (grad_x.to(dtype), (grad_gamma * sign).to(weight.dtype), grad_bias.to(bias.dtype),
+                None, None, None, None, None, None)
+
+
+class InPlaceABN(nn.BatchNorm2d):
+    """BatchNorm2d followed by leaky ReLU, storing only its output for backward.
+
+    Created by changing the class of an existing BatchNorm2d, so the
+    parameters and running statistics carry over.
+    """
+
+    slope = 0.01
+
+    def forward(self, x):
+        momentum = 0. if self.momentum is None else self.momentum
+        if self.training and self.track_running_stats:
+            self.num_batches_tracked += 1
+            if self.momentum is None:
+                momentum = 1. / float(self.num_batches_tracked)
+        if not (self.training or torch.is_grad_enabled()):
+            # inference: nothing is stored, plain kernels are faster
+            out = F.batch_norm(x, self.running_mean, self.running_var, self.weight.abs() + self.eps, self.bias,
+                               False, 0., self.eps)
+            return F.leaky_relu(out, self.slope)
+        return _InPlaceABNFunction.apply(x, self.weight, self.bias, self.running_mean, self.running_var,
+                                         self.training, momentum, self.eps, self.slope)
+
+
+class ABNWideBasic(wide_basic):
+    def forward(self, x):
+        out = self.dropout(self.conv1(self.bn1(x)))
+        out = self.conv2(self.bn2(out))
+        out += self.shortcut(x)
+
+        return out
+
+
+class ABNBasicBlock(BasicBlock):
+    def forward(self, x):
+        residual = x
+
+        out = self.conv1(self.bn1(x))
+        out = self.conv2(self.bn2(out))
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        out += residual
+
+        return out
+
+
+class ABNBottleneck(Bottleneck):
+    def forward(self, x):
+        residual = x
+
+        out = self.conv1(self.bn1(x))
+        out = self.conv2(self.bn2(out))
+        out = self.conv3(self.bn3(out))
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        out += residual
+
+        return out
+
+
+_BLOCKS = {wide_basic: ABNWideBasic, BasicBlock: ABNBasicBlock, Bottleneck: ABNBottleneck}
+
+
+def convert_inplace_abn(net, slope=0.01):
+    """Swap every pre-activation block of `net` to InPlaceABN in place; returns net."""
+    for module in net.modules():
+        if type(module) in _BLOCKS:
+            module.__class__ = _BLOCKS[type(module)]
+            for bn in module.children():
+                if type(bn) is nn.BatchNorm2d:
+                    bn.__class__ = InPlaceABN
+                    bn.slope = slope
+    return net
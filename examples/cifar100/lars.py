@@ -0,0 +1,144 @@
+'''Layer-wise adaptive large-batch optimizers.
+
+LARS (You et al. 2017, https://arxiv.org/abs/1708.03888) and LAMB (You et al.
+2019, https://arxiv.org/abs/1904.00962). The per-layer norms and trust ratios
+of a param group are computed with torch._foreach_* kernels in a few batched
+launches instead of a Python loop over every parameter.
+
+Both optimizers are plain torch.optim.Optimizer subclasses, so they can be
+wrapped by hvd.DistributedOptimizer like optim.SGD.
+'''
+import torch
+from torch.optim import Optimizer
+
+
+__all__ = ['LARS', 'LAMB', 'param_groups_lars']
+
+
+def param_groups_lars(net, weight_decay):
+    """Split parameters into adapted weights and excluded BatchNorm/bias vectors.
+
+    Excluded parameters get no weight decay and a trust ratio of 1.
+    """
+    decay, no_decay = [], []
+    for p in net.parameters():
+        if p.requires_grad:
+            (no_decay if p.dim() <= 1 else decay).append(p)
+
+    return [
+        {'params': decay, 'weight_decay': weight_decay},
+        {'params': no_decay, 'weight_decay': 0., 'lars_exclude': True},
+    ]
+
+
+def _trust_ratio(param_norms, update_norms, coefficient, eps):
+    trust = coefficient * param_norms / (update_norms + eps)
+    # a layer with zero weights or zero update keeps the global learning rate
+    return torch.where((param_norms > 0) & (update_norms > 0), trust, torch.ones_like(trust))
+
+
+def _norms(tensors):
+    if hasattr(torch, '_foreach_norm'):
+        return torch.stack(torch._foreach_norm(tensors))
+    return torch.stack([t.norm() for t in tensors])
+
+
+class LARS(Optimizer):
+    """SGD with momentum whose per-layer step is scaled by
+    trust_coefficient * ||w|| / ||g + weight_decay * w||.
+    """
+
+    def __init__(self, params, lr, momentum=0.9, weight_decay=0., trust_coefficient=0.001,
+                 eps=1e-8, lars_exclude=False):
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay,
+                        trust_coefficient=trust_coefficient, eps=eps, lars_exclude=lars_exclude)
+        super(LARS, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            weight_decay = group['weight_decay']
+
+            if weight_decay != 0:
+                grads = torch._foreach_add(grads, params, alpha=weight_decay)
+            if not group['lars_exclude']:
+                trust = _trust_ratio(_norms(params), _norms(grads), group['trust_coefficient'], group['eps'])
+                if weight_decay == 0:
+                    grads = [g.clone() for g in grads]
+                torch._foreach_mul_(grads, list(trust.unbind(0)))
+
+            bufs = []
+            for p in params:
+                state = self.state[p]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.zeros_like(p)
+                bufs.append(state['momentum_buffer'])
+            torch._foreach_mul_(bufs, group['momentum'])
+            torch._foreach_add_(bufs, grads)
+            torch._foreach_add_(params, bufs, alpha=-group['lr'])
+
+        return loss
+
+
+class LAMB(Optimizer):
+    """Adam moments with a decoupled weight decay, step scaled by ||w|| / ||update||."""
+
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-6, weight_decay=0., lars_exclude=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, lars_exclude=lars_exclude)
+        super(LAMB, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            beta1, beta2 = group['betas']
+
+            exp_avgs, exp_avg_sqs = [], []
+            for p in params:
+                state = self.state[p]
+                if 'step' not in state:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+                exp_avgs.append(state['exp_avg'])
+                exp_avg_sqs.append(state['exp_avg_sq'])
+            # every parameter of a group is stepped together, so they share the step count
+            step = self.state[params[0]]['step']
+
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_div_(denom, (1 - beta2 ** step) ** 0.5)
+            torch._foreach_add_(denom, group['eps'])
+            updates = torch._foreach_div(exp_avgs, denom)
+            torch._foreach_div_(updates, 1 - beta1 ** step)
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(updates, params, alpha=group['weight_decay'])
+
+            if not group['lars_exclude']:
+                trust = _trust_ratio(_norms(params), _norms(updates), 1., 0.)
+                torch._foreach_mul_(updates, list(trust.unbind(0)))
+            torch._foreach_add_(params, updates, alpha=-group['lr'])
+
+        return loss
@@ -0,0 +1,148 @@
+'''Load generator for serve.py: throughput versus latency.
+
+python loadgen.py --url http://127.0.0.1:8080 --concurrency 1,4,16,64 --duration 10
+
+For every --concurrency level, that many keep-alive connections send requests
+back to back (closed loop) for --duration seconds; with --rate, requests are
+instead started at a fixed rate per second (open loop) whatever the server's
+progress, which exposes queueing delay. Images are random pixels, or CIFAR-100
+test images with --datadir. Each level prints throughput, client latency
+percentiles and the server's mean batch size.
+'''
+from __future__ import print_function
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+
+import numpy as np
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+parser = argparse.ArgumentParser(description='Load generator for serve.py')
+parser.add_argument('--url', default='http://127.0.0.1:8080', type=str, help='server address')
+parser.add_argument('--concurrency', default='1,4,16,64', type=int_list, help='comma separated connection counts')
+parser.add_argument('--rate', default=0., type=float, help='open loop: requests started per second (0: closed loop)')
+parser.add_argument('--duration', default=10., type=float, help='seconds per level')
+parser.add_argument('--image-size', default=32, type=int, help='pixels per side of the raw images sent')
+parser.add_argument('--encode', action='store_true', help='send PNG files instead of raw uint8 pixels')
+parser.add_argument('--datadir', default='', type=str, help='send CIFAR-100 test images from here')
+parser.add_argument('--images', default=256, type=int, help='distinct images cycled through')
+parser.add_argument('--output', default='', type=str, help='also write the results as JSON to this file')
+args = parser.parse_args()
+
+host, _, port = args.url.split('//', 1)[-1].rstrip('/').partition(':')
+port = int(port or 80)
+
+
+def make_images():
+    if args.datadir:
+        import torchvision
+        testset = torchvision.datasets.CIFAR100(root=args.datadir, train=False, download=False)
+        pixels = [np.asarray(testset[i][0]) for i in range(min(args.images, len(testset)))]
+    else:
+        pixels = [np.random.randint(0, 256, (args.image_size, args.image_size, 3), dtype=np.uint8)
+                  for _ in range(args.images)]
+    if not args.encode:
+        return [(p.tobytes(), 'application/octet-stream') for p in pixels]
+    from PIL import Image
+    encoded = []
+    for p in pixels:
+        buf = io.BytesIO()
+        Image.fromarray(p).save(buf, format='PNG')
+        encoded.append((buf.getvalue(), 'image/png'))
+    return encoded
+
+
+async def request(reader, writer, method, path, body=b'', content_type='application/octet-stream'):
+    writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                  % (method, path, host, content_type, len(body))).encode() + body)
+    await writer.drain()
+    status = (await reader.readline()).split()[1]
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    payload = await reader.readexactly(length)
+    if status != b'200':
+        raise RuntimeError('%s %s: %s' % (method, path, payload.decode()))
+    return json.loads(payload.decode())
+
+
+async def get(path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await request(reader, writer, 'GET', path)
+    finally:
+        writer.close()
+
+
+async def run_level(concurrency, images):
+    latencies, errors = [], [0]
+    deadline = time.time() + args.duration
+    # open loop: a shared schedule of start times the connections pick from
+    origin = time.time()
+    ticks = (origin + i / args.rate for i in range(10**9)) if args.rate else None
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while True:
+                if ticks is not None:
+                    start = next(ticks)
+                    await asyncio.sleep(max(start - time.time(), 0))
+                else:
+                    start = time.time()
+                if start >= deadline:
+                    return
+                body, content_type = random.choice(images)
+                try:
+                    await request(reader, writer, 'POST', '/predict', body, content_type)
+                except RuntimeError:
+                    errors[0] += 1
+                    continue
+                # open loop latency counts from the scheduled start, queueing included
+                latencies.append(time.time() - start)
+        finally:
+            writer.close()
+
+    await get('/stats?reset')
+    started = time.time()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.time() - started
+    server = await get('/stats')
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        'concurrency': concurrency,
+        'rate': args.rate,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'requests_per_sec': round(len(latencies) / elapsed, 2),
+        'latency_ms': dict(('p%d' % q, round(1000. * np.percentile(latencies, q), 3)) for q in (50, 90, 99)),
+        'mean_batch_size': server.get('mean_batch_size'),
+        'server': server,
+    }
+
+
+async def main():
+    images = make_images()
+    results = []
+    for concurrency in args.concurrency:
+        result = await run_level(concurrency, images)
+        results.append(result)
+        print('| concurrency %4d  %9.1f req/s  p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  batch %6.2f  errors %d' % (
+            concurrency, result['requests_per_sec'], result['latency_ms']['p50'], result['latency_ms']['p90'],
+            result['latency_ms']['p99'], result['mean_batch_size'], result['errors']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+asyncio.run(main())
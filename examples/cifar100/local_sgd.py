@@ -0,0 +1,138 @@
+'''Local SGD: periodic model averaging instead of a per-step gradient allreduce.
+
+(Lin et al., Don't Use Large Mini-Batches, Use Local SGD,
+https://arxiv.org/abs/1808.07217)
+
+LocalSGDOptimizer wraps a plain torch optimizer. While `period` is 1 (the
+synchronous warm phase) synchronize() averages the gradients, flattened into
+one buffer, with a single hvd.allreduce. With a period H > 1 every rank steps
+on its own gradients, and right after the H-th step the parameters, floating
+point buffers (BatchNorm statistics) and, with average_momentum, the momentum
+buffers are averaged with one allreduce of a flattened buffer, so the next
+gradient is computed at the averaged model. synchronize() counts the steps and
+end_step() averages once H are done; the training loop calls both on every
+rank for every step, also one a GradScaler skips, so the ranks average
+together. With H > 1 the GradScaler sees only the rank's own gradients, so its
+scale and skipped steps are per rank. average() forces one, e.g. before
+evaluation or a checkpoint.
+
+The period per epoch comes from config.local_sgd_period with a schedule from
+parse_periods(): '8' or '0:4,60:8,120:16' (epoch:period milestones).
+'''
+import contextlib
+
+import torch
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+import horovod.torch as hvd
+
+from compression import dense_bytes
+
+
+__all__ = ['LocalSGDOptimizer', 'parse_periods']
+
+
+def parse_periods(spec):
+    """'8' -> [(0, 8)], '0:4,60:8' -> [(0, 4), (60, 8)]"""
+    periods = []
+    for item in spec.split(','):
+        epoch, _, period = item.rpartition(':')
+        periods.append((int(epoch or 0), int(period)))
+    if not periods or min(p for _, p in periods) < 1:
+        raise ValueError('local SGD periods must be H or epoch:H,... with H >= 1: %s' % spec)
+    return sorted(periods)
+
+
+class LocalSGDOptimizer(object):
+    """Wraps a torch optimizer; gradients are averaged while period is 1, models every `period` steps otherwise.
+
+    Mirrors the parts of hvd.DistributedOptimizer the training loop uses:
+    synchronize(), skip_synchronize(), param_groups, state_dict(); end_step()
+    must follow every step.
+    """
+
+    def __init__(self, optimizer, net, period=1, average_momentum=False):
+        self.optimizer = optimizer
+        self.net = net
+        self.period = period
+        self.average_momentum = average_momentum
+        self._skip_synchronize = False
+        self.local_steps = 0
+        self.averages = 0
+        self.bytes_sent = 0
+        self.steps = 0
+        self.dense_bytes = dense_bytes(net.parameters())
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    @property
+    def bytes_per_step(self):
+        return self.bytes_sent // max(self.steps, 1)
+
+    @property
+    def compression_ratio(self):
+        # relative to allreducing every gradient every step
+        return float(self.dense_bytes * self.steps) / max(self.bytes_sent, 1)
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+
+    def _allreduce(self, tensors, name):
+        groups = {}
+        for t in tensors:
+            groups.setdefault((t.dtype, t.device), []).append(t)
+        for i, group in enumerate(groups.values()):
+            flat = hvd.allreduce_(_flatten_dense_tensors(group), name='%s.%d' % (name, i), op=hvd.Average)
+            for t, averaged in zip(group, _unflatten_dense_tensors(flat, group)):
+                t.copy_(averaged)
+            self.bytes_sent += flat.numel() * flat.element_size()
+
+    @torch.no_grad()
+    def average(self):
+        """Average the models of all ranks now."""
+        tensors = list(self.net.parameters()) + [b for b in self.net.buffers() if b.is_floating_point()]
+        if self.average_momentum:
+            tensors += [s['momentum_buffer'] for s in self.optimizer.state.values()
+                        if torch.is_tensor(s.get('momentum_buffer'))]
+        self._allreduce(tensors, 'local_sgd.model')
+        self.local_steps = 0
+        self.averages += 1
+
+    @torch.no_grad()
+    def synchronize(self):
+        if self.period <= 1:
+            grads = [p.grad for group in self.param_groups for p in group['params'] if p.grad is not None]
+            self._allreduce(grads, 'local_sgd.grads')
+            self.local_steps = 0
+        else:
+            self.local_steps += 1
+        self.steps += 1
+
+    def end_step(self):
+        """Average the models once `period` local steps are done."""
+        if self.period > 1 and self.local_steps >= self.period:
+            self.average()
+
+    @contextlib.contextmanager
+    def skip_synchronize(self):
+        self._skip_synchronize = True
+        try:
+            yield
+        finally:
+            self._skip_synchronize = False
+
+    def step(self, closure=None):
+        if not self._skip_synchronize:
+            self.synchronize()
+        return self.optimizer.step(closure)
@@ -21,83 +21,13 @@ import datetime
 from torch.autograd import Variable
 import numpy as np
 from preresnet import *
-
-def conv3x3(in_planes, out_planes, stride=1):
-    return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=True)
-
-def conv_init(m):
-    classname = m.__class__.__name__
-    if classname.find('Conv') != -1:
-        init.xavier_uniform(m.weight, gain=np.sqrt(2))
-        if not m.bias is None:
-            init.constant(m.bias, 0)
-    elif classname.find('BatchNorm') != -1:
-        init.constant(m.weight, 1)
-        if not m.bias is None:
-            init.constant(m.bias, 0)
-
-class wide_basic(nn.Module):
-    def __init__(self, in_planes, planes, dropout_rate, stride=1):
-        super(wide_basic, self).__init__()
-        self.bn1 = nn.BatchNorm2d(in_planes)
-        self.conv1 = nn.Conv2d(in_planes, planes, kernel_size=3, padding=1, bias=True)
-        self.dropout = nn.Dropout(p=dropout_rate)
-        self.bn2 = nn.BatchNorm2d(planes)
-        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=stride, padding=1, bias=True)
-
-        self.shortcut = nn.Sequential()
-        if stride != 1 or in_planes != planes:
-            self.shortcut = nn.Sequential(
-                nn.Conv2d(in_planes, planes, kernel_size=1, stride=stride, bias=True),
-            )
-
-    def forward(self, x):
-        out = self.dropout(self.conv1(F.relu(self.bn1(x))))
-        out = self.conv2(F.relu(self.bn2(out)))
-        out += self.shortcut(x)
-
-        return out
-
-class Wide_ResNet(nn.Module):
-    def __init__(self, depth, widen_factor, dropout_rate, num_classes):
-        super(Wide_ResNet, self).__init__()
-        self.in_planes = 16
-
-        assert ((depth-4)%6 ==0), 'Wide-resnet depth should be 6n+4'
-        n = (depth-4)/6
-        k = widen_factor
-
-        print('| Wide-Resnet %dx%d' %(depth, k))
-        nStages = [16, 16*k, 32*k, 64*k]
-
-        self.conv1 = conv3x3(3,nStages[0])
-        self.layer1 = self._wide_layer(wide_basic, nStages[1], n, dropout_rate, stride=1)
-        self.layer2 = self._wide_layer(wide_basic, nStages[2], n, dropout_rate, stride=2)
-        self.layer3 = self._wide_layer(wide_basic, nStages[3], n, dropout_rate, stride=2)
-        self.bn1 = nn.BatchNorm2d(nStages[3], momentum=0.9)
-        self.linear = nn.Linear(nStages[3], num_classes)
-
-    def _wide_layer(self, block, planes, num_blocks, dropout_rate, stride):
-        strides = [stride] + [1]*int(num_blocks-1)
-        layers = []
-
-        for stride in strides:
-            layers.append(block(self.in_planes, planes, dropout_rate, stride))
-            self.in_planes = planes
-
-        return nn.Sequential(*layers)
-
-    def forward(self, x):
-        out = self.conv1(x)
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        out = F.relu(self.bn1(out))
-        out = F.avg_pool2d(out, 8)
-        out = out.view(out.size(0), -1)
-        out = self.linear(out)
-
-        return out
+from wideresnet import *
+from models import get_network
+from augment import ToUint8Tensor, BatchAugment
+from packed import PackedImageDataset
+from prefetch import Prefetcher, loader_kwargs
+from mixed_precision import amp_dtype, autocast, grad_scaler, peak_memory_mb
+from checkpoint import CheckpointManager, find_checkpoint, load_checkpoint
 
 parser = argparse.ArgumentParser(description='PyTorch CIFAR-100 Training')
 parser.add_argument('--lr', default=1. / (2**12), type=float, help='learning_rate')
@@ -110,6 +40,15 @@ parser.add_argument('--dataset', default='CIFAR100', type=str, help='dropout_rat
 parser.add_argument('--arch', default='WIDERESNET', type=str, help='dropout_rate')
 parser.add_argument('--batch-size', default=128, type=int, help='width of model')
 parser.add_argument('--datadir', required=True, type=str, help='data directory')
+parser.add_argument('--batch-augment', action='store_true', help='augment whole uint8 batches on the device instead of per-sample PIL transforms')
+parser.add_argument('--workers', default=1, type=int, help='DataLoader worker processes')
+parser.add_argument('--persistent-workers', action='store_true', help='keep DataLoader workers alive across epochs')
+parser.add_argument('--prefetch-depth', default=2, type=int, help='batches staged on the device ahead of the training step')
+parser.add_argument('--amp', action='store_true', help='mixed precision: bf16 autocast on cpu, fp16 with dynamic loss scaling on cuda')
+parser.add_argument('--amp-dtype', default='auto', choices=['auto', 'fp16', 'bf16'], help='autocast dtype for --amp')
+parser.add_argument('--packed-dir', default='', type=str, help='TinyImageNet arrays written by pack_tinyimagenet.py (replaces ImageFolder)')
+parser.add_argument('--checkpoint-dir', default='./checkpoint', type=str, help='directory of checkpoints written, resumed and tested')
+parser.add_argument('--checkpoint-keep', default=3, type=int, help='periodic checkpoints retained (best is kept separately)')
 args = parser.parse_args()
 
 # Hyper Parameter settings
@@ -121,6 +60,7 @@ print ("batch size {} per gpu".format(batch_size))
 batch_size = batch_size * torch.cuda.device_count()
 print ("batch size {} in total".format(batch_size))
 
+train_augment = test_augment = None
 if args.dataset=='CIFAR100':
     # Data Uplaod
     print('\n[Phase 1] : Data Preparation')
@@ -135,6 +75,10 @@ if args.dataset=='CIFAR100':
     transforms.ToTensor(),
     transforms.Normalize(cf.mean['cifar100'], cf.std['cifar100']),
     ])
+    if args.batch_augment:
+        transform_train = transform_test = ToUint8Tensor()
+        train_augment = BatchAugment(cf.mean['cifar100'], cf.std['cifar100'], 32, padding=4)
+        test_augment = BatchAugment(cf.mean['cifar100'], cf.std['cifar100'], 32, train=False)
 
     print("| Preparing CIFAR-100 dataset...")
     sys.stdout.write("| ")
@@ -148,42 +92,67 @@ elif args.dataset=='TinyImageNet':
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
     print ("\ndata dir", args.datadir)
-    testset = datasets.ImageFolder(os.path.join(args.datadir, 'val_cls'), transforms.Compose([
-                transforms.Scale(64),
-                transforms.CenterCrop(56),
-                transforms.ToTensor(),
-                normalize,
-                ]))
-    trainset = datasets.ImageFolder(os.path.join(args.datadir, 'train'), transforms.Compose([
-                transforms.Scale(64),
-                transforms.RandomCrop(56),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-                ]))
+    if args.packed_dir:
+        # already decoded and scaled to 64x64
+        testset = PackedImageDataset(os.path.join(args.packed_dir, 'val_cls'), transforms.Compose([
+                    transforms.CenterCrop(56),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
+        trainset = PackedImageDataset(os.path.join(args.packed_dir, 'train'), transforms.Compose([
+                    transforms.RandomCrop(56),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
+    else:
+        testset = datasets.ImageFolder(os.path.join(args.datadir, 'val_cls'), transforms.Compose([
+                    transforms.Scale(64),
+                    transforms.CenterCrop(56),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
+        trainset = datasets.ImageFolder(os.path.join(args.datadir, 'train'), transforms.Compose([
+                    transforms.Scale(64),
+                    transforms.RandomCrop(56),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
     num_classes = 200
-
-trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=1)
-testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=1)
+    if args.batch_augment:
+        if args.packed_dir:
+            trainset.transform = testset.transform = ToUint8Tensor()
+            trainset.to_pil = testset.to_pil = False
+        else:
+            trainset.transform = testset.transform = transforms.Compose([
+                    transforms.Scale(64),
+                    transforms.CenterCrop(64),
+                    ToUint8Tensor(),
+                    ])
+        train_augment = BatchAugment(normalize.mean, normalize.std, 56)
+        test_augment = BatchAugment(normalize.mean, normalize.std, 56, train=False)
+
+trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True,
+        **loader_kwargs(args.workers, args.persistent_workers, 2, use_cuda))
+testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=False,
+        **loader_kwargs(args.workers, args.persistent_workers, 2, use_cuda))
+# device copies and batch augmentation overlap with the running step
+device = torch.device('cuda' if use_cuda else 'cpu')
+train_input = Prefetcher(trainloader, device, args.prefetch_depth, train_augment)
+test_input = Prefetcher(testloader, device, args.prefetch_depth, test_augment)
 
 # Return network & file name
 def getNetwork(args):
-    if args.arch == 'WIDERESNET':
-        net = Wide_ResNet(args.depth, args.widen_factor, args.dropout, num_classes)
-        file_name = 'wide-resnet-'+str(args.depth)+'x'+str(args.widen_factor)
-    elif args.arch == 'PRERESNET':
-        net = preresnet(depth=args.depth, num_classes=num_classes)
-        file_name = 'preresnet-'+str(args.depth)
-
-    return net, file_name
+    return get_network(args.arch, args.depth, args.widen_factor, args.dropout, num_classes)
 
 # Test only option
 if (args.testOnly):
     print('\n[Test Phase] : Model setup')
-    assert os.path.isdir('checkpoint'), 'Error: No checkpoint directory found!'
-    _, file_name = getNetwork(args)
-    checkpoint = torch.load('./checkpoint/'+os.sep+file_name+'.t7')
-    net = checkpoint['net']
+    net, file_name = getNetwork(args)
+    path = find_checkpoint(args.checkpoint_dir, file_name, 'best')
+    assert path is not None, 'Error: No checkpoint found in %s!' % args.checkpoint_dir
+    net.load_state_dict(load_checkpoint(path)['net'])
 
     if use_cuda:
         net.cuda()
@@ -195,15 +164,13 @@ if (args.testOnly):
     correct = 0
     total = 0
 
-    for batch_idx, (inputs, targets) in enumerate(testloader):
-        if use_cuda:
-            inputs, targets = inputs.cuda(), targets.cuda()
-        inputs, targets = Variable(inputs, volatile=True), Variable(targets)
-        outputs = net(inputs)
+    with torch.inference_mode():
+        for batch_idx, (inputs, targets) in enumerate(test_input):
+            outputs = net(inputs)
 
-        _, predicted = torch.max(outputs.data, 1)
-        total += targets.size(0)
-        correct += predicted.eq(targets.data).cpu().sum()
+            _, predicted = torch.max(outputs, 1)
+            total += targets.size(0)
+            correct += predicted.eq(targets).sum().item()
 
     acc = 100.*correct/total
     print("| Test Result\tAcc@1: %.2f%%" %(acc))
@@ -215,12 +182,11 @@ print('\n[Phase 2] : Model setup')
 if args.resume:
     # Load checkpoint
     print('| Resuming from checkpoint...')
-    assert os.path.isdir('checkpoint'), 'Error: No checkpoint directory found!'
-    _, file_name = getNetwork(args)
-    checkpoint = torch.load('./checkpoint/'+os.sep+file_name+'.t7')
-    net = checkpoint['net']
-    best_acc = checkpoint['acc']
-    start_epoch = checkpoint['epoch']
+    net, file_name = getNetwork(args)
+    path = find_checkpoint(args.checkpoint_dir, file_name, 'last')
+    assert path is not None, 'Error: No checkpoint found in %s!' % args.checkpoint_dir
+    resume_state = load_checkpoint(path)
+    net.load_state_dict(resume_state['net'])
 else:
     print('| Building net ...')
     net, file_name = getNetwork(args)
@@ -234,6 +200,34 @@ if use_cuda:
 criterion = nn.CrossEntropyLoss()
 
 optimizer = optim.SGD(net.parameters(), lr=args.lr*batch_size, momentum=0.9, weight_decay=5e-4)
+precision = amp_dtype(device, args.amp_dtype)
+scaler = grad_scaler(device, precision, args.amp)
+ckpt = CheckpointManager(args.checkpoint_dir, file_name, args.checkpoint_keep)
+end_epoch = cf.start_epoch+num_epochs
+
+if args.resume:
+    if 'optimizer' in resume_state:
+        optimizer.load_state_dict(resume_state['optimizer'])
+    if resume_state.get('scaler'):
+        scaler.load_state_dict(resume_state['scaler'])
+    best_acc = resume_state.get('best_acc', resume_state.get('acc', 0))
+    start_epoch = resume_state['epoch'] + (1 if resume_state.get('epoch_done') else 0)
+
+def checkpoint_state(epoch, epoch_done, acc=None):
+    model = net.module if hasattr(net, 'module') else net
+    return {
+        'net': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
+        'epoch': epoch,
+        'step': (epoch+1)*len(train_input),
+        'epoch_done': epoch_done,
+        'acc': acc,
+        'best_acc': best_acc,
+        'config': {'arch': args.arch, 'depth': args.depth, 'widen_factor': args.widen_factor,
+                   'dropout': args.dropout, 'num_classes': num_classes, 'dataset': args.dataset},
+    }
+
 # Training
 def train(epoch):
     net.train()
@@ -245,14 +239,15 @@ def train(epoch):
         param_group['lr'] = lr
 
     print('\n=> Training Epoch #%d, LR=%.4f' %(epoch, cf.learning_rate_orig(args.lr*batch_size, epoch)))
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        if use_cuda:
-            inputs, targets = inputs.cuda(), targets.cuda() # GPU settings
+    train_input.reset_stats()
+    for batch_idx, (inputs, targets) in enumerate(train_input):
         optimizer.zero_grad()
-        outputs = net(inputs)               # Forward Propagation
-        loss = criterion(outputs, targets)  # Loss
-        loss.backward()  # Backward Propagation
-        optimizer.step() # Optimizer update
+        with autocast(device, precision, args.amp):
+            outputs = net(inputs)               # Forward Propagation
+            loss = criterion(outputs, targets)  # Loss
+        scaler.scale(loss).backward()  # Backward Propagation
+        scaler.step(optimizer) # Optimizer update, skipped on overflow
+        scaler.update()
 
         train_loss += loss.data[0]
         _, predicted = torch.max(outputs.data, 1)
@@ -264,6 +259,9 @@ def train(epoch):
                 %(epoch, num_epochs, batch_idx+1,
                     (len(trainset)//batch_size)+1, loss.data[0], 100.*correct/total, lr))
         sys.stdout.flush()
+    print('\n| Input wait: %d/%d steps, %.2fs' %(train_input.wait_count, train_input.batches, train_input.wait_time))
+    print('| Peak memory: %.1f MB%s' %(peak_memory_mb(device), ' (amp %s)' % str(precision).split('.')[-1] if args.amp else ''))
+    ckpt.save(checkpoint_state(epoch, True))
 
 def test(epoch):
     global best_acc
@@ -272,11 +270,10 @@ def test(epoch):
     correct = 0
     total = 0
     with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(testloader):
-            if use_cuda:
-                inputs, targets = inputs.cuda(), targets.cuda()
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
+        for batch_idx, (inputs, targets) in enumerate(test_input):
+            with autocast(device, precision, args.amp):
+                outputs = net(inputs)
+                loss = criterion(outputs, targets)
  
             test_loss += loss.data.item()
             _, predicted = torch.max(outputs.data, 1)
@@ -284,23 +281,13 @@ def test(epoch):
             correct += predicted.eq(targets.data).cpu().sum()
 
     # Save checkpoint when best model
-    acc = 100.*correct/total
-    print("\n| Validation Epoch #%d\t\t\tLoss: %.4f Acc@1: %.2f%%" %(epoch, loss.data[0], acc))
+    acc = float(correct)/total
+    print("\n| Validation Epoch #%d\t\t\tLoss: %.4f Acc@1: %.2f%%" %(epoch, loss.data[0], 100.*acc))
 
     if acc > best_acc:
-        print('| Saving Best model...\t\t\tTop1 = %.2f%%' %(acc))
-        state = {
-                'net':net.module if use_cuda else net,
-                'acc':acc,
-                'epoch':epoch,
-        }
-        if not os.path.isdir('checkpoint'):
-            os.mkdir('checkpoint')
-        save_point = './checkpoint/'+os.sep
-        if not os.path.isdir(save_point):
-            os.mkdir(save_point)
-        torch.save(state, save_point+file_name+'.t7')
+        print('| Saving Best model...\t\t\tTop1 = %.2f%%' %(100.*acc))
         best_acc = acc
+        ckpt.save(checkpoint_state(epoch, True, acc), best=True)
 
 print('\n[Phase 3] : Training model')
 print('| Training Epochs = ' + str(num_epochs))
@@ -308,7 +295,7 @@ print('| Initial Learning Rate = ' + str(args.lr))
 print('| Optimizer = ' + str(optim_type))
 
 elapsed_time = 0
-for epoch in range(start_epoch, start_epoch+num_epochs):
+for epoch in range(start_epoch, end_epoch):
     start_time = time.time()
 
     train(epoch)
@@ -318,5 +305,7 @@ for epoch in range(start_epoch, start_epoch+num_epochs):
     elapsed_time += epoch_time
     print('| Elapsed time : %d:%02d:%02d'  %(cf.get_hms(elapsed_time)))
 
+ckpt.wait()
+
 print('\n[Phase 4] : Testing model')
-print('* Test results : Acc@1 = %.2f%%' %(best_acc))
+print('* Test results : Acc@1 = %.2f%%' %(100.*best_acc))
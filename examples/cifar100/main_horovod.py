@@ -15,92 +15,37 @@ import torchvision.datasets as datasets
 import os
 import sys
 import time
+import socket
 import argparse
 import datetime
 
 from torch.autograd import Variable
 import numpy as np
 from preresnet import *
+from wideresnet import *
+from models import get_network
+from augment import ToUint8Tensor, BatchAugment
+from packed import PackedImageDataset
+from shm_cache import cache_cifar100, memory_usage_mb
+from prefetch import Prefetcher, loader_kwargs
+from step_timer import StepTimer
+from straggler import StragglerMonitor, RebalancingBatchSampler, parse_straggler
+from comm_profiler import CommProfiler
+from metrics import MetricAccumulator
+from compression import build_compression, CompressedDistributedOptimizer
+from lars import LARS, LAMB, param_groups_lars
+from mixed_precision import amp_dtype, autocast, grad_scaler, peak_memory_mb
+from checkpoint import CheckpointManager, find_checkpoint, load_checkpoint
+from sampler import ResumableDistributedSampler
+from compiled import channels_last, compile_model
+from recompute import enable_recompute
+from inplace_abn import convert_inplace_abn
+from flat_optim import BucketedDistributedOptimizer
+from zero import ShardedOptimizer, state_bytes
+from local_sgd import LocalSGDOptimizer, parse_periods
 import torch.utils.data.distributed
 import horovod.torch as hvd
 
-def conv3x3(in_planes, out_planes, stride=1):
-    return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=True)
-
-def conv_init(m):
-    classname = m.__class__.__name__
-    if classname.find('Conv') != -1:
-        init.xavier_uniform(m.weight, gain=np.sqrt(2))
-        if not m.bias is None:
-            init.constant(m.bias, 0)
-    elif classname.find('BatchNorm') != -1:
-        init.constant(m.weight, 1)
-        if not m.bias is None:
-            init.constant(m.bias, 0)
-
-class wide_basic(nn.Module):
-    def __init__(self, in_planes, planes, dropout_rate, stride=1):
-        super(wide_basic, self).__init__()
-        self.bn1 = nn.BatchNorm2d(in_planes)
-        self.conv1 = nn.Conv2d(in_planes, planes, kernel_size=3, padding=1, bias=True)
-        self.dropout = nn.Dropout(p=dropout_rate)
-        self.bn2 = nn.BatchNorm2d(planes)
-        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=stride, padding=1, bias=True)
-
-        self.shortcut = nn.Sequential()
-        if stride != 1 or in_planes != planes:
-            self.shortcut = nn.Sequential(
-                nn.Conv2d(in_planes, planes, kernel_size=1, stride=stride, bias=True),
-            )
-
-    def forward(self, x):
-        out = self.dropout(self.conv1(F.relu(self.bn1(x))))
-        out = self.conv2(F.relu(self.bn2(out)))
-        out += self.shortcut(x)
-
-        return out
-
-class Wide_ResNet(nn.Module):
-    def __init__(self, depth, widen_factor, dropout_rate, num_classes):
-        super(Wide_ResNet, self).__init__()
-        self.in_planes = 16
-
-        assert ((depth-4)%6 ==0), 'Wide-resnet depth should be 6n+4'
-        n = (depth-4)/6
-        k = widen_factor
-
-        print('| Wide-Resnet %dx%d' %(depth, k))
-        nStages = [16, 16*k, 32*k, 64*k]
-
-        self.conv1 = conv3x3(3,nStages[0])
-        self.layer1 = self._wide_layer(wide_basic, nStages[1], n, dropout_rate, stride=1)
-        self.layer2 = self._wide_layer(wide_basic, nStages[2], n, dropout_rate, stride=2)
-        self.layer3 = self._wide_layer(wide_basic, nStages[3], n, dropout_rate, stride=2)
-        self.bn1 = nn.BatchNorm2d(nStages[3], momentum=0.9)
-        self.linear = nn.Linear(nStages[3], num_classes)
-
-    def _wide_layer(self, block, planes, num_blocks, dropout_rate, stride):
-        strides = [stride] + [1]*int(num_blocks-1)
-        layers = []
-
-        for stride in strides:
-            layers.append(block(self.in_planes, planes, dropout_rate, stride))
-            self.in_planes = planes
-
-        return nn.Sequential(*layers)
-
-    def forward(self, x):
-        out = self.conv1(x)
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        out = F.relu(self.bn1(out))
-        out = F.avg_pool2d(out, 8)
-        out = out.view(out.size(0), -1)
-        out = self.linear(out)
-
-        return out
-
 parser = argparse.ArgumentParser(description='PyTorch CIFAR-100 Training')
 parser.add_argument('--datadir', required=True, type=str, help='data directory')
 parser.add_argument('--lr', default=1./(2**12), type=float, help='learning_rate')
@@ -114,6 +59,54 @@ parser.add_argument('--dropout', default=0.3, type=float, help='dropout_rate')
 parser.add_argument('--resume', '-r', action='store_true', help='resume from checkpoint')
 parser.add_argument('--testOnly', '-t', action='store_true', help='Test mode with the saved model')
 parser.add_argument('--multi-gpu', action='store_true', help='Test mode with the saved model')
+parser.add_argument('--device', default='auto', choices=['auto', 'cuda', 'cpu'], help='training device (auto picks cuda when available)')
+parser.add_argument('--threads-per-rank', default=0, type=int, help='intra-op threads per rank on cpu (0 splits the cores among local ranks)')
+parser.add_argument('--batch-augment', action='store_true', help='augment whole uint8 batches on the device instead of per-sample PIL transforms')
+parser.add_argument('--packed-dir', default='', type=str, help='TinyImageNet arrays written by pack_tinyimagenet.py (replaces ImageFolder)')
+parser.add_argument('--workers', default=1, type=int, help='DataLoader worker processes per rank')
+parser.add_argument('--persistent-workers', action='store_true', help='keep DataLoader workers alive across epochs')
+parser.add_argument('--prefetch-depth', default=2, type=int, help='batches staged on the device ahead of the training step')
+parser.add_argument('--stats-interval', default=50, type=int, help='steps between step-time breakdown records')
+parser.add_argument('--stats-file', default='', type=str, help='append step-time JSON lines here (default: stdout of rank 0)')
+parser.add_argument('--straggler-threshold', default=1.25, type=float, help='a rank is slow above this multiple of the median time per image')
+parser.add_argument('--straggler-patience', default=3, type=int, help='slow stats windows in a row before a rank is reported as a straggler')
+parser.add_argument('--rebalance', action='store_true', help='shift batch from persistent stragglers to faster ranks each epoch (global batch unchanged)')
+parser.add_argument('--profile-comm', default='', type=str, help='write a communication timeline and overlap report to PATH.json/.txt')
+parser.add_argument('--profile-start', default=20, type=int, help='first optimizer step of this process profiled by --profile-comm')
+parser.add_argument('--profile-steps', default=10, type=int, help='optimizer steps profiled by --profile-comm')
+parser.add_argument('--simulate-straggler', default='', type=str, help='RANK:SECONDS: slow RANK down by SECONDS per step of the nominal batch (testing)')
+parser.add_argument('--log-interval', default=20, type=int, help='steps between training progress lines (rank 0)')
+parser.add_argument('--confusion-matrix', action='store_true', help='accumulate a confusion matrix during validation')
+parser.add_argument('--optimizer', default='sgd', choices=['sgd', 'lars', 'lamb'], help='base optimizer (lars/lamb exclude BN and bias from adaptation)')
+parser.add_argument('--lr-schedule', default='step', choices=['step', 'poly'], help='step: cf.learning_rate, poly: warmup + polynomial decay')
+parser.add_argument('--trust-coefficient', default=0.001, type=float, help='LARS trust coefficient')
+parser.add_argument('--amp', action='store_true', help='mixed precision: bf16 autocast on cpu, fp16 with dynamic loss scaling on cuda')
+parser.add_argument('--amp-dtype', default='auto', choices=['auto', 'fp16', 'bf16'], help='autocast dtype for --amp')
+parser.add_argument('--accumulation-steps', default=1, type=int, help='local backward passes per allreduce and optimizer step')
+parser.add_argument('--compression', default='none', choices=['none', 'fp16', 'topk', 'powersgd'], help='gradient compression for the allreduce')
+parser.add_argument('--topk-ratio', default=0.01, type=float, help='fraction of gradient entries sent by topk')
+parser.add_argument('--powersgd-rank', default=4, type=int, help='rank of the PowerSGD approximation')
+parser.add_argument('--flat-buckets', action='store_true', help='flat parameter/gradient buckets: one allreduce per bucket, fused SGD step (sgd only)')
+parser.add_argument('--zero', action='store_true', help='shard optimizer state across ranks: reduce-scatter gradients, allgather parameters (sgd only)')
+parser.add_argument('--bucket-size-mb', default=25., type=float, help='bucket size of --flat-buckets and --zero')
+parser.add_argument('--local-sgd', default='', type=str, help='local SGD: average models every H steps; H or epoch:H,... (e.g. 0:4,60:8,120:16)')
+parser.add_argument('--local-sgd-warmup', default=5, type=int, help='fully synchronous epochs before --local-sgd starts')
+parser.add_argument('--local-sgd-momentum', action='store_true', help='also average momentum buffers with --local-sgd')
+parser.add_argument('--target-acc', default=0., type=float, help='report the time to reach this test accuracy (%%)')
+parser.add_argument('--checkpoint-dir', default='./checkpoint', type=str, help='directory of checkpoints written, resumed and tested')
+parser.add_argument('--checkpoint-steps', default=0, type=int, help='also checkpoint every N optimizer steps (0: end of epoch only)')
+parser.add_argument('--checkpoint-minutes', default=0., type=float, help='also checkpoint every N minutes (0: off)')
+parser.add_argument('--checkpoint-keep', default=3, type=int, help='periodic checkpoints retained (best is kept separately)')
+parser.add_argument('--channels-last', action='store_true', help='NHWC model weights and inputs')
+parser.add_argument('--compile', default='none', choices=['none', 'compile', 'trace'], help='torch.compile (falls back to a TorchScript trace) or trace only')
+parser.add_argument('--compile-cache', default='./compile_cache', type=str, help='persistent inductor cache reused across restarts')
+parser.add_argument('--recompute', default='none', type=str, help='activation recomputation: none, every<K> (every K-th block) or stages<digits> (e.g. stages23)')
+parser.add_argument('--inplace-abn', action='store_true', help='in-place activated BatchNorm (leaky ReLU) in the residual blocks')
+parser.add_argument('--abn-slope', default=0.01, type=float, help='leaky ReLU slope of --inplace-abn')
+parser.add_argument('--elastic', action='store_true', help='survive rank loss and scale-up (horovodrun --min-np/--max-np --host-discovery-script)')
+parser.add_argument('--commit-interval', default=50, type=int, help='optimizer steps between in-memory elastic commits')
+parser.add_argument('--seed', default=1111, type=int, help='random seed; also seeds the per-epoch shuffle')
+parser.add_argument('--shm-cache', default='', type=str, help='share decoded CIFAR-100 among local ranks through this directory (e.g. /dev/shm)')
 args = parser.parse_args()
 
 # Hyper Parameter settings
@@ -122,18 +115,34 @@ args = parser.parse_args()
 '''
 hvd.init()
 
-print ("use cuda!!")
+if args.device == 'auto':
+    use_cuda = torch.cuda.is_available()
+else:
+    use_cuda = args.device == 'cuda'
 print ("local rank {}, rank {}".format(hvd.local_rank(),hvd.rank()))
-torch.cuda.set_device(hvd.local_rank())
-torch.cuda.manual_seed(1111)
+if use_cuda:
+    print ("use cuda!!")
+    torch.cuda.set_device(hvd.local_rank())
+    torch.cuda.manual_seed(args.seed)
+    device = torch.device('cuda', hvd.local_rank())
+else:
+    # CPU tensors are reduced over Gloo (horovodrun --gloo) or MPI
+    torch.manual_seed(args.seed)
+    num_threads = args.threads_per_rank or cf.get_num_threads(hvd.local_size())
+    torch.set_num_threads(num_threads)
+    device = torch.device('cpu')
+    print ("use cpu, {} threads per rank, gloo {}".format(num_threads, hvd.gloo_enabled()))
 
 best_acc = 0
-start_epoch, num_epochs, batch_size, optim_type = cf.start_epoch, cf.num_epochs, args.batch_size, cf.optim_type
+start_epoch, num_epochs, batch_size, optim_type = cf.start_epoch, cf.num_epochs, args.batch_size, args.optimizer.upper()
 print ("device count {}".format(torch.cuda.device_count()))
 print ("batch size {} per node".format(batch_size))
-if args.multi_gpu:
+if args.multi_gpu and use_cuda:
     batch_size = batch_size * torch.cuda.device_count()
     print ("batch size {} in total".format(batch_size))
+print ("effective batch size {} ({} accumulation steps x {} ranks)".format(batch_size*args.accumulation_steps*hvd.size(), args.accumulation_steps, hvd.size()))
+train_augment = test_augment = None
+data_start_time = time.time()
 if args.dataset=='CIFAR100':
     # Data Uplaod
     print('\n[Phase 1] : Data Preparation')
@@ -148,177 +157,449 @@ if args.dataset=='CIFAR100':
     transforms.ToTensor(),
     transforms.Normalize(cf.mean['cifar100'], cf.std['cifar100']),
     ])
+    if args.batch_augment:
+        transform_train = transform_test = ToUint8Tensor()
+        train_augment = BatchAugment(cf.mean['cifar100'], cf.std['cifar100'], 32, padding=4)
+        test_augment = BatchAugment(cf.mean['cifar100'], cf.std['cifar100'], 32, train=False)
 
     print("| Preparing CIFAR-100 dataset...")
     sys.stdout.write("| ")
     import glob
     print ("\ndata dir", args.datadir)
     print ("\ndata dir list: {}".format(glob.glob(os.path.join(args.datadir, "*"))))
-    trainset = torchvision.datasets.CIFAR100(root=args.datadir, train=True, download=False, transform=transform_train)
-    testset = torchvision.datasets.CIFAR100(root=args.datadir, train=False, download=False, transform=transform_test)
+    if args.shm_cache:
+        def global_barrier():
+            # every rank, so also every local rank of this host
+            hvd.allreduce(torch.zeros(1), name='shm_cache_barrier')
+        train_prefix = cache_cifar100(args.datadir, True, hvd.local_rank(), global_barrier, args.shm_cache)
+        test_prefix = cache_cifar100(args.datadir, False, hvd.local_rank(), global_barrier, args.shm_cache)
+        trainset = PackedImageDataset(train_prefix, transform_train, to_pil=not args.batch_augment)
+        testset = PackedImageDataset(test_prefix, transform_test, to_pil=not args.batch_augment)
+    else:
+        trainset = torchvision.datasets.CIFAR100(root=args.datadir, train=True, download=False, transform=transform_train)
+        testset = torchvision.datasets.CIFAR100(root=args.datadir, train=False, download=False, transform=transform_test)
     num_classes = 100
 elif args.dataset=='TinyImageNet':
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
     print ("\ndata dir", args.datadir)
-    testset = datasets.ImageFolder(os.path.join(args.datadir, 'val_cls'), transforms.Compose([
-                transforms.Scale(64),
-                transforms.CenterCrop(56),
-                transforms.ToTensor(),
-                normalize,
-                ]))
-    trainset = datasets.ImageFolder(os.path.join(args.datadir, 'train'), transforms.Compose([
-                transforms.Scale(64),
-                transforms.RandomCrop(56),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-                ]))
+    if args.packed_dir:
+        # already decoded and scaled to 64x64
+        testset = PackedImageDataset(os.path.join(args.packed_dir, 'val_cls'), transforms.Compose([
+                    transforms.CenterCrop(56),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
+        trainset = PackedImageDataset(os.path.join(args.packed_dir, 'train'), transforms.Compose([
+                    transforms.RandomCrop(56),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
+    else:
+        testset = datasets.ImageFolder(os.path.join(args.datadir, 'val_cls'), transforms.Compose([
+                    transforms.Scale(64),
+                    transforms.CenterCrop(56),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
+        trainset = datasets.ImageFolder(os.path.join(args.datadir, 'train'), transforms.Compose([
+                    transforms.Scale(64),
+                    transforms.RandomCrop(56),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    normalize,
+                    ]))
     num_classes = 200
-
+    if args.batch_augment:
+        if args.packed_dir:
+            trainset.transform = testset.transform = ToUint8Tensor()
+            trainset.to_pil = testset.to_pil = False
+        else:
+            trainset.transform = testset.transform = transforms.Compose([
+                    transforms.Scale(64),
+                    transforms.CenterCrop(64),
+                    ToUint8Tensor(),
+                    ])
+        train_augment = BatchAugment(normalize.mean, normalize.std, 56)
+        test_augment = BatchAugment(normalize.mean, normalize.std, 56, train=False)
+
+
+# dataset startup cost, summed over the ranks of a host (pss counts shared pages once)
+rss, pss = memory_usage_mb()
+host_pss = {}
+for host, rank_pss in hvd.allgather_object((socket.gethostname(), pss), name='host_pss'):
+    host_pss[host] = host_pss.get(host, 0.) + rank_pss
+print ("| Dataset ready in {:.2f}s, rss {:.1f} MB, pss {:.1f} MB".format(time.time() - data_start_time, rss, pss))
+if hvd.rank()==0:
+    for host in sorted(host_pss):
+        print ("| Dataset resident memory on {} {:.1f} MB".format(host, host_pss[host]))
 
 '''
 2. Initialize Horovod distributed sampler
 '''
-train_sampler = torch.utils.data.distributed.DistributedSampler(trainset, num_replicas=hvd.size(), rank=hvd.rank())
-trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, num_workers=1, sampler=train_sampler, pin_memory=True)
-test_sampler = torch.utils.data.distributed.DistributedSampler(testset, num_replicas=hvd.size(), rank=hvd.rank())
-testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, num_workers=1, sampler=test_sampler, pin_memory=True)
+# reshuffled every epoch, resumable mid-epoch; the eval split is not padded so counts are exact
+train_sampler = ResumableDistributedSampler(trainset, hvd.size(), hvd.rank(), seed=args.seed)
+if args.rebalance:
+    assert not (args.elastic or args.local_sgd), 'Error: --rebalance needs a fixed set of ranks and a gradient allreduce every step'
+    # every rank cuts its slice out of each global batch; the split follows the straggler monitor
+    train_batches = RebalancingBatchSampler(train_sampler, batch_size)
+    trainloader = torch.utils.data.DataLoader(trainset, batch_sampler=train_batches,
+            **loader_kwargs(args.workers, args.persistent_workers, 2, use_cuda))
+else:
+    train_batches = None
+    trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, sampler=train_sampler,
+            **loader_kwargs(args.workers, args.persistent_workers, 2, use_cuda))
+test_sampler = ResumableDistributedSampler(testset, hvd.size(), hvd.rank(), shuffle=False, pad=False)
+testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, sampler=test_sampler,
+        **loader_kwargs(args.workers, args.persistent_workers, 2, use_cuda))
+# device copies and batch augmentation overlap with the running step
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+train_input = Prefetcher(trainloader, device, args.prefetch_depth, train_augment, memory_format)
+test_input = Prefetcher(testloader, device, args.prefetch_depth, test_augment, memory_format)
 
 # Return network & file name
 def getNetwork(args):
-    if args.arch == 'WIDERESNET':
-        net = Wide_ResNet(args.depth, args.widen_factor, args.dropout, num_classes)
-        file_name = 'wide-resnet-'+str(args.depth)+'x'+str(args.widen_factor)
-    elif args.arch == 'PRERESNET':
-        net = preresnet(depth=args.depth, num_classes=num_classes)
-        file_name = 'preresnet-'+str(args.depth)
-
+    net, file_name = get_network(args.arch, args.depth, args.widen_factor, args.dropout, num_classes)
+    if args.inplace_abn:
+        convert_inplace_abn(net, args.abn_slope)
     return net, file_name
 
 # Test only option
 if (args.testOnly):
     print('\n[Test Phase] : Model setup')
-    assert os.path.isdir('checkpoint'), 'Error: No checkpoint directory found!'
-    _, file_name = getNetwork(args)
-    checkpoint = torch.load('./checkpoint/'+os.sep+file_name+'.t7')
-    net = checkpoint['net']
-
-    net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
-    net.cuda()
-    cudnn.benchmark = True
+    net, file_name = getNetwork(args)
+    if hvd.rank()==0:
+        path = find_checkpoint(args.checkpoint_dir, file_name, 'best')
+        assert path is not None, 'Error: No checkpoint found in %s!' % args.checkpoint_dir
+        print('| Loading %s' % path)
+        net.load_state_dict(load_checkpoint(path)['net'])
+    net.to(device)
+    if args.channels_last:
+        channels_last(net)
+    # only rank 0 reads the file
+    hvd.broadcast_parameters(net.state_dict(), root_rank=0)
+    if args.multi_gpu and use_cuda:
+        net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
+        cudnn.benchmark = True
 
     net.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
-
-    for batch_idx, (inputs, targets) in enumerate(testloader):
-        inputs, targets = inputs.cuda(), targets.cuda()
-        inputs, targets = Variable(inputs, volatile=True), Variable(targets)
-        outputs = net(inputs)
+    model = compile_model(net, args.compile, args.compile_cache) if args.compile != 'none' else net
+    criterion = nn.CrossEntropyLoss().to(device)
+    test_metrics = MetricAccumulator(num_classes, device)
 
-        _, predicted = torch.max(outputs.data, 1)
-        total += targets.size(0)
-        correct += predicted.eq(targets.data).cpu().sum()
+    with torch.no_grad():
+        for batch_idx, (inputs, targets) in enumerate(test_input):
+            outputs = model(inputs)
+            test_metrics.update(outputs, targets, criterion(outputs, targets))
 
-    acc = 100.*correct/total
-    print("| Test Result\tAcc@1: %.2f%%" %(acc))
+    result = test_metrics.reduce(lambda t: hvd.allreduce(t, name='test_metrics', op=hvd.Sum))
+    if hvd.rank()==0:
+        print("| Test Result\tAcc@1: %.2f%% Acc@5: %.2f%%" %(result['top1'], result['top5']))
 
     sys.exit(0)
 
 # Model
 print('\n[Phase 2] : Model setup')
+resume_state = None
 if args.resume:
-    # Load checkpoint
+    # Load checkpoint on rank 0; the rest is broadcast once the optimizer exists
     print('| Resuming from checkpoint...')
-    assert os.path.isdir('checkpoint'), 'Error: No checkpoint directory found!'
-    _, file_name = getNetwork(args)
-    checkpoint = torch.load('./checkpoint/'+os.sep+file_name+'.t7')
-    net = checkpoint['net']
-    best_acc = checkpoint['acc']
-    start_epoch = checkpoint['epoch']
+    net, file_name = getNetwork(args)
+    if hvd.rank()==0:
+        path = find_checkpoint(args.checkpoint_dir, file_name, 'last')
+        assert path is not None, 'Error: No checkpoint found in %s!' % args.checkpoint_dir
+        print('| Loading %s' % path)
+        resume_state = load_checkpoint(path)
+        resume_state['file'] = os.path.basename(path)
+        net.load_state_dict(resume_state.pop('net'))
 else:
     print('| Building net ...')
     net, file_name = getNetwork(args)
     net.apply(conv_init)
 
-if args.multi_gpu:
+if args.multi_gpu and use_cuda:
     net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
     cudnn.benchmark = True
-net.cuda()
+enable_recompute(net.module if hasattr(net, 'module') else net, args.recompute)
+net.to(device)
+if args.channels_last:
+    channels_last(net)
 
 '''
 3. Broadcast parameters, scale learning rate, compression, and distributed optimizer
 '''
 hvd.broadcast_parameters(net.state_dict(), root_rank=0)
 
-criterion = nn.CrossEntropyLoss().cuda()
+criterion = nn.CrossEntropyLoss().to(device)
 
 print ("initializing optimizer on node {}".format(hvd.local_rank()))
-optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
-optimizer = hvd.DistributedOptimizer(optimizer, named_parameters=net.named_parameters())
+assert args.flat_buckets + args.zero + bool(args.local_sgd) <= 1, 'Error: --flat-buckets, --zero and --local-sgd exclude each other'
+local_sgd_periods = parse_periods(args.local_sgd) if args.local_sgd else None
+precision = amp_dtype(device, args.amp_dtype)
+scaler = grad_scaler(device, precision, args.amp)
+if args.flat_buckets:
+    # takes the place of both optim.SGD and hvd.DistributedOptimizer
+    assert args.optimizer == 'sgd' and args.compression == 'none', 'Error: --flat-buckets needs --optimizer sgd and --compression none'
+    optimizer = BucketedDistributedOptimizer(net.named_parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4,
+                                             bucket_size_mb=args.bucket_size_mb, backward_passes_per_step=args.accumulation_steps)
+    print ("| {} parameters in {} flat buckets".format(len(list(net.parameters())), len(optimizer.buckets)))
+elif args.zero:
+    # elastic commits would broadcast rank 0's shard to everyone
+    assert args.optimizer == 'sgd' and args.compression == 'none' and not args.elastic, 'Error: --zero needs --optimizer sgd, --compression none and no --elastic'
+    optimizer = ShardedOptimizer(optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4), net.named_parameters(),
+                                 args.bucket_size_mb, args.accumulation_steps, sync_overflow=scaler.is_enabled())
+    print ("| ZeRO: rank {} keeps optimizer state for {} of {} parameter elements".format(
+        hvd.rank(), optimizer.shard_numel, sum(p.numel() for p in net.parameters())))
+else:
+    if args.optimizer == 'lars':
+        optimizer = LARS(param_groups_lars(net, 5e-4), lr=args.lr, momentum=0.9, trust_coefficient=args.trust_coefficient)
+    elif args.optimizer == 'lamb':
+        optimizer = LAMB(param_groups_lars(net, 5e-4), lr=args.lr)
+    else:
+        optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
+    if local_sgd_periods:
+        assert args.compression == 'none', 'Error: --local-sgd sends no gradients to compress'
+        optimizer = LocalSGDOptimizer(optimizer, net, average_momentum=args.local_sgd_momentum)
+    else:
+        optimizer = build_compression(optimizer, net.named_parameters(), args.compression,
+                                      topk_ratio=args.topk_ratio, powersgd_rank=args.powersgd_rank,
+                                      backward_passes_per_step=args.accumulation_steps)
+# forward passes go through `model`; parameters, optimizer and checkpoints stay with `net`
+model = compile_model(net, args.compile, args.compile_cache) if args.compile != 'none' else net
+# per-module backward hooks need the eager model
+assert not (args.profile_comm and args.compile != 'none'), 'Error: --profile-comm needs --compile none'
+profiler = CommProfiler(optimizer, net, args.profile_comm, args.profile_start, args.profile_steps, device,
+                        enabled=bool(args.profile_comm))
+train_metrics = MetricAccumulator(num_classes, device)
+test_metrics = MetricAccumulator(num_classes, device, confusion=args.confusion_matrix)
+monitor = StragglerMonitor(batch_size, args.straggler_threshold, args.straggler_patience,
+                           hosts=hvd.allgather_object(socket.gethostname(), name='hosts'), verbose=hvd.rank()==0)
+timer = StepTimer(args.stats_interval, device, hvd.rank(), lambda t: hvd.allgather(t, name='step_timer'), args.stats_file,
+                  monitor=monitor)
+straggler_rank, straggler_seconds = parse_straggler(args.simulate_straggler) if args.simulate_straggler else (-1, 0.)
+ckpt = CheckpointManager(args.checkpoint_dir, file_name, args.checkpoint_keep, args.checkpoint_steps,
+                         args.checkpoint_minutes, enabled=hvd.rank()==0)
+# with --zero every rank writes its optimizer shard next to rank 0's checkpoint, with
+# top-k/PowerSGD its own error-feedback residuals (elastic runs restart them at zero)
+residual_shards = isinstance(optimizer, CompressedDistributedOptimizer) and not args.elastic
+shard_ckpt = CheckpointManager(args.checkpoint_dir, '%s-%s%dof%d' % (file_name, 'zero' if args.zero else 'rank', hvd.rank(), hvd.size()),
+                               args.checkpoint_keep) if args.zero or residual_shards else None
+end_epoch = cf.start_epoch+num_epochs+20
+
+if args.resume:
+    resume_state = hvd.broadcast_object(resume_state, root_rank=0, name='resume_state')
+    if resume_state.get('zero'):
+        assert args.zero and resume_state['zero'] == hvd.size(), \
+            'Error: optimizer sharded over %d ranks; merge it with consolidate_zero.py' % resume_state['zero']
+        shard_path = os.path.join(args.checkpoint_dir, shard_ckpt.file_name + resume_state['file'][len(file_name):])
+        resume_state['optimizer'] = load_checkpoint(shard_path)['optimizer']
+    if 'optimizer' in resume_state:
+        optimizer.load_state_dict(resume_state['optimizer'])
+    if residual_shards:
+        if resume_state.get('residual_shards') == hvd.size():
+            shard_path = os.path.join(args.checkpoint_dir, shard_ckpt.file_name + resume_state['file'][len(file_name):])
+            optimizer.load_residual_state_dict(load_checkpoint(shard_path)['residuals'])
+        else:
+            print('| No error-feedback residuals for %d ranks in the checkpoint; they restart at zero' % hvd.size())
+    if resume_state.get('scaler'):
+        scaler.load_state_dict(resume_state['scaler'])
+    if resume_state.get('sampler'):
+        train_sampler.load_state_dict(resume_state['sampler'])
+    best_acc = resume_state.get('best_acc', 0)
+    start_epoch = resume_state['epoch'] + (1 if resume_state.get('epoch_done') else 0)
+    print('| Resuming at epoch %d' % start_epoch)
+
+elastic_state = None
+
+def commit_state(epoch, batch_idx, sampler_state):
+    # rolled back to on a failed rank, broadcast to workers joining later
+    elastic_state.epoch = epoch
+    elastic_state.batch = batch_idx
+    elastic_state.sampler = sampler_state
+    elastic_state.best_acc = best_acc
+    elastic_state.scaler = scaler.state_dict()
+    elastic_state.commit()
+
+def checkpoint_state(epoch, batch_idx, step, epoch_done, acc=None, sampler_state=None):
+    unwrapped = net.module if hasattr(net, 'module') else net
+    return {
+        'net': unwrapped.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
+        'sampler': sampler_state,
+        'epoch': epoch,
+        'batch_idx': batch_idx,
+        'step': step,
+        'epoch_done': epoch_done,
+        'acc': acc,
+        'best_acc': best_acc,
+        'config': {'arch': args.arch, 'depth': args.depth, 'widen_factor': args.widen_factor,
+                   'dropout': args.dropout, 'num_classes': num_classes, 'dataset': args.dataset,
+                   'inplace_abn': args.abn_slope if args.inplace_abn else 0.},
+    }
+
+def checkpoint_due(step):
+    # with --local-sgd every rank takes part in the average before a checkpoint
+    if shard_ckpt is None and not local_sgd_periods:
+        return hvd.rank()==0 and ckpt.due(step)
+    due = ckpt.due(step)
+    if args.checkpoint_minutes:
+        # every shard must be written at the same step; rank 0's clock decides
+        due = bool(hvd.broadcast(torch.tensor([int(due)]), root_rank=0, name='checkpoint_due').item())
+    return due
+
+def save_checkpoint(state, best=False):
+    if args.zero:
+        shard_ckpt.save({'optimizer': state.pop('optimizer'), 'epoch': state['epoch'], 'step': state['step']}, best)
+        state['zero'] = hvd.size()
+    elif residual_shards:
+        shard_ckpt.save({'residuals': optimizer.residual_state_dict(), 'epoch': state['epoch'], 'step': state['step']}, best)
+        state['residual_shards'] = hvd.size()
+    ckpt.save(state, best)
+
+optimizer_steps = 0
 
 # Training
 def train(epoch):
+    global optimizer_steps
     net.train()
-    train_loss = 0
-    correct = 0
-    total = 0
-
-    print('\n=> Training Epoch #%d, LR=%.4f' %(epoch, cf.learning_rate(args.lr*batch_size, epoch, args.warmup_epoch, 0, len(trainloader), hvd.size())))
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        lr = cf.learning_rate(args.lr*batch_size, epoch, args.warmup_epoch, batch_idx, len(trainloader), hvd.size())
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
-        inputs, targets = inputs.cuda(), targets.cuda() # GPU settings
-        optimizer.zero_grad()
+    train_metrics.reset()
+    # one optimizer step per accumulation window; a trailing partial window is dropped
+    accumulation = args.accumulation_steps
+    if train_sampler.epoch != epoch:
+        train_sampler.set_epoch(epoch) # reshuffle; a resumed epoch keeps its offset
+    batches_per_epoch = (train_sampler.num_samples + batch_size - 1) // batch_size
+    loss_weight = 1.
+    if train_batches is not None:
+        # rank 0's split for everyone, taken up by this epoch's loader iterator
+        sizes = hvd.broadcast_object(monitor.batch_sizes(hvd.size()), root_rank=0, name='batch_sizes')
+        if sizes != train_batches.sizes:
+            train_batches.set_sizes(sizes)
+            if hvd.rank()==0:
+                print('| Rebalanced batch sizes: %s' %(sizes))
+        # the gradient average over ranks becomes the mean over the global batch
+        loss_weight = train_batches.loss_weight
+        batches_per_epoch = len(trainset) // train_batches.global_batch
+    steps_per_epoch = batches_per_epoch // accumulation
+    assert steps_per_epoch > 0, 'Error: %d batches per rank per epoch, fewer than --accumulation-steps %d' %(batches_per_epoch, accumulation)
+    # first batch left in the epoch, numbered on a window boundary
+    start_batch = train_sampler.offset // (batch_size*hvd.size())
+    start_batch -= start_batch % accumulation
+    effective_lr = args.lr*batch_size*accumulation
+    def schedule(step):
+        if args.lr_schedule == 'poly':
+            return cf.learning_rate_poly(effective_lr, epoch, args.warmup_epoch, step, steps_per_epoch, hvd.size(), end_epoch)
+        return cf.learning_rate(effective_lr, epoch, args.warmup_epoch, step, steps_per_epoch, hvd.size())
+
+    print('\n=> Training Epoch #%d, LR=%.4f' %(epoch, schedule(start_batch // accumulation)))
+    if local_sgd_periods:
+        optimizer.period = cf.local_sgd_period(epoch, args.local_sgd_warmup, local_sgd_periods)
+        print('| Local SGD: averaging every %d steps' %(optimizer.period))
+    if start_batch > 0:
+        print('| Resuming epoch #%d at batch %d' %(epoch, start_batch))
+    train_input.reset_stats()
+    timer.begin(epoch)
+    for batch_idx, (inputs, targets) in enumerate(train_input, start_batch):
+        if batch_idx >= steps_per_epoch*accumulation:
+            break
+        timer.mark('data')
+        if batch_idx % accumulation == 0:
+            lr = schedule(batch_idx // accumulation)
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
+            profiler.begin_step()
+            optimizer.zero_grad()
         inputs, targets = Variable(inputs), Variable(targets)
-        outputs = net(inputs)               # Forward Propagation
-        loss = criterion(outputs, targets)  # Loss
-        loss.backward()  # Backward Propagation
-        optimizer.step() # Optimizer update
-
-        train_loss += loss.data.item()
-        _, predicted = torch.max(outputs.data, 1)
-        total += targets.size(0)
-        correct += predicted.eq(targets.data).cpu().sum()
-        print ('| Epoch [%3d/%3d] Iter[%3d/%3d]\t\tLoss: %.4f Acc@1: %.3f%% LR: %.8f'
-                %(epoch, num_epochs, batch_idx+1,
-                    (len(trainset)//batch_size)+1, loss.data.item(), 100.*correct/total, lr))
+        with autocast(device, precision, args.amp):
+            outputs = model(inputs)             # Forward Propagation
+            loss = criterion(outputs, targets)  # Loss
+        if hvd.rank() == straggler_rank:
+            time.sleep(straggler_seconds * targets.size(0) / batch_size) # --simulate-straggler
+        timer.mark('forward')
+        profiler.begin_backward()
+        scaler.scale(loss * loss_weight / accumulation).backward()  # Backward Propagation
+        profiler.end_backward()
+        timer.mark('backward')
+        if batch_idx % accumulation == accumulation - 1:
+            if isinstance(optimizer, CompressedDistributedOptimizer):
+                optimizer.grad_scale = scaler.get_scale() # residuals are kept unscaled
+            optimizer.synchronize() # wait for the gradient allreduce
+            timer.mark('comm')
+            # averaged gradients overflow on every rank or none, so the ranks
+            # skip (or take) the step together; with a local SGD period > 1
+            # each rank unscales its own gradients and the scaler is per rank:
+            # a rank skips only its own step, and end_step() still averages on all
+            scaler.unscale_(optimizer)
+            with optimizer.skip_synchronize():
+                scaler.step(optimizer) # Optimizer update
+            scaler.update()
+            if local_sgd_periods:
+                optimizer.end_step() # average every H steps, skipped ones included
+            timer.mark('optimizer')
+            profiler.end_step()
+            optimizer_steps += 1
+            step = epoch*steps_per_epoch + batch_idx//accumulation + 1
+            if elastic_state is not None and step % args.commit_interval == 0:
+                if local_sgd_periods:
+                    optimizer.average() # commit one model, not rank 0's local one
+                commit_state(epoch, batch_idx+1, train_sampler.state_dict((batch_idx+1-start_batch)*batch_size))
+            if checkpoint_due(step):
+                if local_sgd_periods:
+                    optimizer.average()
+                save_checkpoint(checkpoint_state(epoch, batch_idx+1, step, False,
+                                                 sampler_state=train_sampler.state_dict((batch_idx+1-start_batch)*batch_size)))
+
+        train_metrics.update(outputs, targets, loss) # stays on the device
+        if hvd.rank()==0 and (batch_idx+1) % args.log_interval == 0:
+            running = train_metrics.value()
+            print ('| Epoch [%3d/%3d] Iter[%3d/%3d]\t\tLoss: %.4f Acc@1: %.3f%% LR: %.8f'
+                    %(epoch, num_epochs, batch_idx+1,
+                        batches_per_epoch, running['loss'], running['top1'], lr))
+        timer.mark('metrics')
+        timer.end_step(targets.size(0))
+    if local_sgd_periods:
+        # evaluate and checkpoint the same averaged model on every rank
+        optimizer.average()
+    result = train_metrics.reduce(lambda t: hvd.allreduce(t, name='train_metrics', op=hvd.Sum))
     if hvd.rank()==0:
-        save_dict = {"epoch": epoch, "optimizer": optimizer.state_dict(), "state_dict": net.state_dict()}
-        torch.save(save_dict, os.path.join('/home/lunit/Pytorch-Horovod-Examples/examples/cifar100/checkpoints/', 'cifar100_last.pth.tar'))
-
-def metric_average(val, name):
-    tensor = torch.tensor(val)
-    avg_tensor = hvd.allreduce(tensor, name=name)
-    return avg_tensor.item()
+        print ('| Train Epoch #%d\t\tLoss: %.4f Acc@1: %.3f%% Acc@5: %.3f%%' %(epoch, result['loss'], result['top1'], result['top5']))
+    print ('| Input wait: %d/%d steps, %.2fs' %(train_input.wait_count, train_input.batches, train_input.wait_time))
+    print ('| Peak memory: %.1f MB%s, optimizer state %.1f MB' %(peak_memory_mb(device), ' (amp %s)' % str(precision).split('.')[-1] if args.amp else '', state_bytes(optimizer) / 2.**20))
+    if hvd.rank()==0:
+        print ('| Gradient bytes sent per step: %.2f MB (%s, compression x%.1f)' %(optimizer.bytes_per_step / 2.**20, args.compression, optimizer.compression_ratio))
+        if hasattr(optimizer, 'allreduces_per_step'):
+            print ('| Allreduce calls per step: %d' %(optimizer.allreduces_per_step))
+    # written in the background; training goes on with the next epoch
+    save_checkpoint(checkpoint_state(epoch, steps_per_epoch*accumulation, (epoch+1)*steps_per_epoch, True,
+                                     sampler_state=train_sampler.state_dict(train_sampler.num_samples)))
 
 def test(epoch):
     global best_acc
     net.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
+    test_metrics.reset()
     with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(testloader):
-            inputs, targets = inputs.cuda(), targets.cuda()
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
- 
-            test_loss += loss.data.item()
-            _, predicted = torch.max(outputs.data, 1)
-            total += targets.size(0)
-            correct += predicted.eq(targets.data).cpu().float().sum()
-    test_loss /= len(test_sampler)
-    test_accuracy = correct / len(test_sampler)
-    test_loss = metric_average(test_loss, 'avg_loss')
-    test_accuracy = metric_average(test_accuracy, 'avg_acc')
+        for batch_idx, (inputs, targets) in enumerate(test_input):
+            with autocast(device, precision, args.amp):
+                outputs = model(inputs)
+                loss = criterion(outputs, targets)
+            test_metrics.update(outputs, targets, loss)
+    # one allreduce for every metric of the epoch
+    result = test_metrics.reduce(lambda t: hvd.allreduce(t, name='test_metrics', op=hvd.Sum))
+    test_loss, test_accuracy = result['loss'], result['top1'] / 100.
     if best_acc < test_accuracy:
         best_acc = test_accuracy
+        if hvd.rank()==0:
+            print('| Saving Best model...\t\t\tTop1 = %.2f%%' %(100.*test_accuracy))
+        save_checkpoint(checkpoint_state(epoch, 0, 0, True, test_accuracy), best=True)
     if hvd.rank()==0:
-        print ("\n| Validation average loss : {:.4f}, accuracy: {:.2f}%, best accuracy so far {:.2f}%\n".format(test_loss, 100.*test_accuracy, 100.*best_acc))
+        print ("\n| Validation average loss : {:.4f}, accuracy: {:.2f}%, top-5: {:.2f}%, best accuracy so far {:.2f}%\n".format(test_loss, 100.*test_accuracy, result['top5'], 100.*best_acc))
+        if 'confusion' in result:
+            confusion = result['confusion']
+            per_class = confusion.diag() / confusion.sum(1).clamp(min=1)
+            worst = per_class.argsort()[:5].tolist()
+            print ("| Worst classes : {}".format(", ".join("{} ({:.1f}%)".format(c, 100.*per_class[c]) for c in worst)))
+    return test_accuracy
 
 print('\n[Phase 3] : Training model')
 print('| Training Epochs = ' + str(num_epochs))
@@ -326,15 +607,80 @@ print('| Initial Learning Rate = ' + str(args.lr))
 print('| Optimizer = ' + str(optim_type))
 
 elapsed_time = 0
-for epoch in range(start_epoch, start_epoch+num_epochs+20):
-    start_time = time.time()
-
-    train(epoch)
-    test(epoch)
+target_time = None
+def fit(first_epoch):
+    global elapsed_time, target_time
+    for epoch in range(first_epoch, end_epoch):
+        start_time = time.time()
+
+        train(epoch)
+        test_accuracy = test(epoch)
+        if elastic_state is not None:
+            commit_state(epoch+1, 0, train_sampler.state_dict(train_sampler.num_samples))
+
+        epoch_time = time.time() - start_time
+        elapsed_time += epoch_time
+        print('| Elapsed time : %d:%02d:%02d'  %(cf.get_hms(elapsed_time)))
+        if args.target_acc and target_time is None and 100.*test_accuracy >= args.target_acc:
+            target_time = elapsed_time
+            print('| Reached %.2f%% after %d:%02d:%02d' %((args.target_acc,) + cf.get_hms(target_time)))
+        if hvd.rank()==0:
+            # time-to-accuracy and communication volume, comparable across --local-sgd settings
+            sent = optimizer.bytes_sent if hasattr(optimizer, 'bytes_sent') else optimizer.bytes_per_step*optimizer_steps
+            timer.write({'epoch': epoch, 'elapsed': round(elapsed_time, 1), 'test_top1': round(100.*test_accuracy, 2),
+                         'comm_mb': round(sent / 2.**20, 1), 'optimizer_steps': optimizer_steps,
+                         'local_sgd_period': getattr(optimizer, 'period', 1), 'time_to_target': target_time})
+
+if args.elastic:
+    # model and optimizer are restored/broadcast by their handlers, the rest as objects
+    elastic_state = hvd.elastic.TorchState(
+        model=net,
+        optimizer=optimizer.optimizer if isinstance(optimizer, (CompressedDistributedOptimizer, LocalSGDOptimizer)) else optimizer,
+        epoch=start_epoch, batch=0, best_acc=best_acc, scaler=scaler.state_dict(),
+        sampler=train_sampler.state_dict())
+
+    def on_state_reset():
+        # the rest of the epoch is repartitioned; the LR schedules scale with hvd.size()
+        train_sampler.set_replicas(hvd.size(), hvd.rank())
+        test_sampler.set_replicas(hvd.size(), hvd.rank())
+        timer.rank = hvd.rank()
+        # the stats allgather fires on timer.step: every rank, old or new, restarts the count together
+        timer.step = 0
+        timer.reset_window()
+        # strikes and rates were measured on the old set of ranks
+        monitor.reset()
+        monitor.hosts = hvd.allgather_object(socket.gethostname(), name='hosts')
+        monitor.verbose = hvd.rank()==0
+        ckpt.enabled = hvd.rank()==0
+        if local_sgd_periods:
+            # the committed model was averaged; count the period from it on every rank
+            optimizer.local_steps = 0
+        if isinstance(optimizer, BucketedDistributedOptimizer):
+            # handles and arrival counts of the interrupted step would misfire the next one
+            optimizer.reset()
+        if isinstance(optimizer, CompressedDistributedOptimizer):
+            # residuals belong to the old set of ranks and the rolled back steps
+            optimizer.residuals = {}
+        print ("| Elastic reset: rank {} of {}".format(hvd.rank(), hvd.size()))
+    elastic_state.register_reset_callbacks([on_state_reset])
+
+    @hvd.elastic.run
+    def elastic_fit(state):
+        global best_acc
+        train_sampler.load_state_dict(state.sampler)
+        scaler.load_state_dict(state.scaler)
+        best_acc = state.best_acc
+        if state.batch > 0:
+            print ("| Restarting from commit: epoch {}, batch {}".format(state.epoch, state.batch))
+        fit(state.epoch)
+
+    elastic_fit(elastic_state)
+else:
+    fit(start_epoch)
 
-    epoch_time = time.time() - start_time
-    elapsed_time += epoch_time
-    print('| Elapsed time : %d:%02d:%02d'  %(cf.get_hms(elapsed_time)))
+ckpt.wait()
+if shard_ckpt is not None:
+    shard_ckpt.wait()
 
 print('\n[Phase 4] : Testing model')
-print('* Test results : Acc@1 = %.2f%%' %(best_acc))
+print('* Test results : Acc@1 = %.2f%%' %(100.*best_acc))
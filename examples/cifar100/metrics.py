@@ -0,0 +1,63 @@
+'''Classification metrics accumulated on the device.
+
+Loss sum, top-1/top-5 correct counts, sample count and an optional confusion
+matrix live in one flat float64 buffer, so update() never synchronizes with
+the host and reduce() needs a single allreduce for all of them.
+'''
+import torch
+
+
+__all__ = ['MetricAccumulator']
+
+
+class MetricAccumulator(object):
+    """Running loss / top-k accuracy of one rank; reduce() sums over all ranks."""
+
+    def __init__(self, num_classes, device, confusion=False):
+        self.num_classes = num_classes
+        self.topk = min(5, num_classes)
+        size = 4 + (num_classes * num_classes if confusion else 0)
+        self.buffer = torch.zeros(size, dtype=torch.float64, device=device)
+        self.confusion = self.buffer[4:].view(num_classes, num_classes) if confusion else None
+
+    def reset(self):
+        self.buffer.zero_()
+
+    def update(self, outputs, targets, loss):
+        """Accumulate a batch; `loss` is the batch mean as returned by the criterion."""
+        n = targets.size(0)
+        _, pred = outputs.detach().topk(self.topk, 1)
+        correct = pred.eq(targets.view(-1, 1))
+        self.buffer[0] += loss.detach().double() * n
+        self.buffer[1] += correct[:, 0].sum()
+        self.buffer[2] += correct.sum()
+        self.buffer[3] += n
+        if self.confusion is not None:
+            index = targets * self.num_classes + pred[:, 0]
+            self.confusion.view(-1).index_add_(0, index, torch.ones_like(index, dtype=torch.float64))
+
+    def _summary(self, buffer):
+        loss_sum, top1, top5, count = buffer[:4].tolist()
+        count = max(count, 1.)
+        summary = {
+            'loss': loss_sum / count,
+            'top1': 100. * top1 / count,
+            'top5': 100. * top5 / count,
+            'count': int(count),
+        }
+        if self.confusion is not None:
+            summary['confusion'] = buffer[4:].view(self.num_classes, self.num_classes).cpu()
+
+        return summary
+
+    def value(self):
+        """Local metrics of this rank (synchronizes with the device)."""
+        return self._summary(self.buffer)
+
+    def reduce(self, allreduce=None):
+        """Global metrics; allreduce(tensor) must return the sum over ranks."""
+        buffer = self.buffer.clone()
+        if allreduce is not None:
+            buffer = allreduce(buffer)
+
+        return self._summary(buffer)
@@ -0,0 +1,35 @@
+'''Autocast / dynamic loss scaling setup shared by the training scripts.
+
+bf16 on CPU (same exponent range as fp32, no loss scaling needed), fp16 on
+CUDA with a GradScaler. Modules are never cast, so BatchNorm weights and
+running statistics stay fp32 and only activations run in low precision.
+'''
+import torch
+
+
+__all__ = ['amp_dtype', 'autocast', 'grad_scaler', 'peak_memory_mb']
+
+
+def amp_dtype(device, name='auto'):
+    if name == 'auto':
+        return torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return {'fp16': torch.float16, 'bf16': torch.bfloat16}[name]
+
+
+def autocast(device, dtype, enabled):
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+
+def grad_scaler(device, dtype, enabled):
+    """A GradScaler that is a no-op unless fp16 autocast is on."""
+    enabled = enabled and dtype == torch.float16
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2.**20
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
@@ -0,0 +1,20 @@
+'''Network construction shared by the training, export and serving scripts.'''
+from preresnet import preresnet
+from wideresnet import Wide_ResNet
+
+
+__all__ = ['get_network']
+
+
+def get_network(arch, depth, widen_factor, dropout, num_classes):
+    """Return (net, file_name); file_name names the checkpoints of this net."""
+    if arch == 'WIDERESNET':
+        net = Wide_ResNet(depth, widen_factor, dropout, num_classes)
+        file_name = 'wide-resnet-'+str(depth)+'x'+str(widen_factor)
+    elif arch == 'PRERESNET':
+        net = preresnet(depth=depth, num_classes=num_classes)
+        file_name = 'preresnet-'+str(depth)
+    else:
+        raise ValueError('unknown arch %s' % arch)
+
+    return net, file_name
@@ -0,0 +1,52 @@
+'''One-time conversion of the TinyImageNet ImageFolder tree into packed memmaps.
+
+python pack_tinyimagenet.py --datadir /data/tiny-imagenet [--out /data/tiny-imagenet/packed]
+
+Writes train and val_cls splits (see packed.py), decoded and resized to
+64x64 exactly like transforms.Scale(64) did at every epoch.
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+
+from packed import create_packed
+
+parser = argparse.ArgumentParser(description='Pack TinyImageNet into memory-mappable arrays')
+parser.add_argument('--datadir', required=True, type=str, help='data directory with train/ and val_cls/')
+parser.add_argument('--out', default='', type=str, help='output directory (default: <datadir>/packed)')
+parser.add_argument('--size', default=64, type=int, help='stored image size')
+parser.add_argument('--workers', default=8, type=int, help='decode processes')
+args = parser.parse_args()
+
+resize = transforms.Compose([
+    transforms.Resize(args.size),
+    transforms.CenterCrop(args.size),
+])
+
+def decode(path):
+    return np.asarray(resize(datasets.folder.default_loader(path)), dtype=np.uint8)
+
+out_dir = args.out or os.path.join(args.datadir, 'packed')
+if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+
+pool = Pool(args.workers)
+for split in ('train', 'val_cls'):
+    start_time = time.time()
+    folder = datasets.ImageFolder(os.path.join(args.datadir, split))
+    prefix = os.path.join(out_dir, split)
+    images, labels, flush = create_packed(prefix, len(folder.samples), args.size, args.size, folder.classes)
+    paths = [path for path, _ in folder.samples]
+    for i, img in enumerate(pool.imap(decode, paths, chunksize=256)):
+        images[i] = img
+        labels[i] = folder.samples[i][1]
+    flush()
+    print('| %s: %d images, %d classes -> %s (%.1fs)' % (split, len(paths), len(folder.classes), prefix, time.time() - start_time))
+pool.close()
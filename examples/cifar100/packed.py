@@ -0,0 +1,81 @@
+'''Packed uint8 image arrays read through numpy.memmap.
+
+A split is stored as three files sharing a prefix:
+    <prefix>.json         {"num": N, "height": H, "width": W, "classes": [...]}
+    <prefix>_images.u8    raw uint8, shape (N, H, W, 3), C order
+    <prefix>_labels.npy   int64, shape (N,)
+Samples are read in O(1) with no decode; read-only mappings of the same file
+share page-cache pages across every process on the host.
+'''
+import json
+import os
+
+import numpy as np
+import torch.utils.data as data
+from PIL import Image
+
+
+__all__ = ['PackedImageDataset', 'create_packed', 'packed_exists']
+
+
+def packed_exists(prefix):
+    return os.path.exists(prefix + '.json')
+
+
+def create_packed(prefix, num, height, width, classes=None):
+    """Allocate the image memmap and label array of a new split.
+
+    The caller fills both, then calls flush(); the json header is written
+    last so a half-written split is never picked up.
+    """
+    images = np.memmap(prefix + '_images.u8', dtype=np.uint8, mode='w+', shape=(num, height, width, 3))
+    labels = np.zeros(num, dtype=np.int64)
+
+    def flush():
+        images.flush()
+        np.save(prefix + '_labels.npy', labels)
+        meta = {'num': num, 'height': height, 'width': width, 'classes': classes or []}
+        with open(prefix + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(prefix + '.json.tmp', prefix + '.json')
+
+    return images, labels, flush
+
+
+class PackedImageDataset(data.Dataset):
+    """Dataset over a packed split; returns (transform(image), label).
+
+    Images are handed to the transform as PIL images (to_pil=True) or as
+    HWC uint8 arrays (for ToUint8Tensor).
+    """
+
+    def __init__(self, prefix, transform=None, to_pil=True):
+        with open(prefix + '.json') as f:
+            meta = json.load(f)
+        self.prefix = prefix
+        self.shape = (meta['num'], meta['height'], meta['width'], 3)
+        self.classes = meta['classes']
+        self.targets = np.load(prefix + '_labels.npy', mmap_mode='r')
+        self.transform = transform
+        self.to_pil = to_pil
+        self.images = None
+
+    def __getstate__(self):
+        # loader workers re-open the mapping instead of pickling it
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.memmap(self.prefix + '_images.u8', dtype=np.uint8, mode='r', shape=self.shape)
+        img = self.images[index]
+        if self.to_pil:
+            img = Image.fromarray(img)
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, int(self.targets[index])
@@ -0,0 +1,119 @@
+'''Background prefetching of DataLoader batches.
+
+A thread pulls the next batches from the loader, copies them to the device
+(non-blocking, on a side stream under CUDA), runs the batch augmentation and
+converts the inputs to `memory_format`, keeping up to `depth` ready batches queued while the current step computes.
+'''
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import torch
+
+
+__all__ = ['Prefetcher', 'loader_kwargs']
+
+
+def loader_kwargs(workers, persistent_workers, prefetch_factor, pin_memory):
+    """DataLoader keyword arguments for the given worker settings."""
+    kwargs = {'num_workers': workers, 'pin_memory': pin_memory}
+    if workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+
+    return kwargs
+
+
+class Prefetcher(object):
+    """Iterable wrapper around a DataLoader yielding (inputs, targets) on `device`.
+
+    wait_count / wait_time accumulate how often and how long the consumer
+    found the queue empty since the last reset_stats().
+    """
+
+    def __init__(self, loader, device, depth=2, augment=None, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.augment = augment
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.wait_count = 0
+        self.wait_time = 0.
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _stage(self, inputs, targets):
+        if self.stream is None:
+            inputs, targets = inputs.to(self.device), targets.to(self.device)
+            if self.augment is not None:
+                inputs = self.augment(inputs)
+            return inputs.contiguous(memory_format=self.memory_format), targets, None
+
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
+            if self.augment is not None:
+                inputs = self.augment(inputs)
+            inputs = inputs.contiguous(memory_format=self.memory_format)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        return inputs, targets, event
+
+    def _worker(self, ready, stop):
+        try:
+            for inputs, targets in self.loader:
+                if stop.is_set():
+                    return
+                ready.put(self._stage(inputs, targets))
+        except Exception as e:
+            ready.put(e)
+            return
+        ready.put(None)
+
+    def __iter__(self):
+        ready = queue.Queue(maxsize=max(self.depth, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(ready, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                if ready.empty():
+                    start = time.time()
+                    item = ready.get()
+                    self.wait_count += 1
+                    self.wait_time += time.time() - start
+                else:
+                    item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                inputs, targets, event = item
+                if event is not None:
+                    # compute stream waits for the copy; the caching allocator
+                    # must not recycle the side-stream memory before use
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    inputs.record_stream(torch.cuda.current_stream(self.device))
+                    targets.record_stream(torch.cuda.current_stream(self.device))
+                self.batches += 1
+                yield inputs, targets
+        finally:
+            stop.set()
+            # unblock the producer if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,112 @@
+'''Activation recomputation for the residual stages of Wide_ResNet and PreResNet.
+
+enable_recompute(net, 'every2') checkpoints every second block of layer1-3:
+only the block input is kept for backward and the block runs again during
+backward. 'stages23' checkpoints layer2 and layer3 as one segment each, keeping
+only the stage input. The stages stay nn.Sequential with the same children, so
+state_dict keys, checkpoints and optimizers are unaffected.
+
+The recomputation is exact: the RNG state is restored before dropout runs
+again, and BatchNorm running statistics updated by the recomputed forward are
+rolled back so every batch is counted once.
+'''
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+__all__ = ['CheckpointedSequential', 'enable_recompute', 'parse_spec', 'saved_activation_bytes']
+
+STAGES = ('layer1', 'layer2', 'layer3')
+
+
+@contextlib.contextmanager
+def _frozen_running_stats(module):
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, tracked) in zip(bns, saved):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(tracked)
+
+
+def _checkpointed(run, module, x):
+    calls = [0]
+
+    def forward(inputs):
+        calls[0] += 1
+        if calls[0] == 1:
+            return run(inputs)
+        with _frozen_running_stats(module):
+            return run(inputs)
+
+    return checkpoint(forward, x, use_reentrant=False, preserve_rng_state=True)
+
+
+class CheckpointedSequential(nn.Sequential):
+    """nn.Sequential recomputing the blocks whose index is in `recompute`.
+
+    whole=True runs all blocks as a single checkpointed segment instead.
+    """
+
+    recompute = ()
+    whole = False
+
+    def forward(self, x):
+        run = super(CheckpointedSequential, self).forward
+        if not (self.training and torch.is_grad_enabled()):
+            return run(x)
+        if self.whole:
+            return _checkpointed(run, self, x)
+        for i, block in enumerate(self):
+            x = _checkpointed(block, block, x) if i in self.recompute else block(x)
+        return x
+
+
+def parse_spec(spec):
+    """'none' -> (0, ()), 'every2' -> (2, ()), 'stages23' -> (0, (2, 3))"""
+    if spec in ('', 'none'):
+        return 0, ()
+    if spec.startswith('every'):
+        return int(spec[5:]), ()
+    if spec.startswith('stages'):
+        return 0, tuple(int(s) for s in spec[6:])
+    raise ValueError('recompute spec must be none, every<K> or stages<digits>: %s' % spec)
+
+
+def enable_recompute(net, spec):
+    """Turn layer1-3 of `net` into CheckpointedSequential according to `spec`; returns net."""
+    every, stages = parse_spec(spec)
+    if not every and not stages:
+        return net
+    for index, name in enumerate(STAGES, 1):
+        stage = getattr(net, name)
+        stage.__class__ = CheckpointedSequential
+        if index in stages:
+            stage.whole = True
+        elif every:
+            stage.recompute = frozenset(range(0, len(stage), every))
+    return net
+
+
+def saved_activation_bytes(net, inputs, loss_fn):
+    """Bytes of activations kept for backward by one forward pass (parameters excluded)."""
+    params = set(p.data_ptr() for p in net.parameters())
+    storages = {}
+
+    def pack(t):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in params:
+            storages[ptr] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = loss_fn(net(inputs))
+    loss.backward()
+    return sum(storages.values())
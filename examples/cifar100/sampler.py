@@ -0,0 +1,86 @@
+'''Distributed sampler that can be checkpointed and resumed mid-epoch.
+
+Every epoch draws one global permutation from seed + epoch, the same on all
+ranks, and rank r takes every num_replicas-th index of it starting at r. After
+each rank has consumed k samples the ranks together have consumed exactly the
+first k * num_replicas entries of the permutation, so the state
+(epoch, seed, offset) identifies the next batch independently of the number of
+ranks it is restored on.
+
+pad=True repeats the head of the permutation so every rank gets the same number
+of samples (needed when every step is an allreduce). Evaluation uses pad=False:
+ranks then differ by at most one sample and sum-reduced metrics count every
+sample exactly once.
+'''
+import torch
+from torch.utils.data import Sampler
+
+
+__all__ = ['ResumableDistributedSampler']
+
+
+class ResumableDistributedSampler(Sampler):
+    """Drop-in replacement for DistributedSampler with state_dict()/load_state_dict().
+
+    len() is the number of samples this rank still has to see in the current
+    epoch; num_samples is the per-rank length of a full epoch.
+    """
+
+    def __init__(self, dataset, num_replicas, rank, shuffle=True, seed=0, pad=True):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+        self.offset = 0
+
+    @property
+    def num_samples(self):
+        return self._count(len(self.dataset))
+
+    def _count(self, remaining):
+        if self.pad:
+            return (remaining + self.num_replicas - 1) // self.num_replicas
+        return max(remaining - self.rank + self.num_replicas - 1, 0) // self.num_replicas
+
+    def __len__(self):
+        return self._count(len(self.dataset) - self.offset)
+
+    def remaining_indices(self):
+        """The part of this epoch's global permutation no rank has consumed yet."""
+        if self.shuffle:
+            gen = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=gen).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        return indices[self.offset:]
+
+    def __iter__(self):
+        indices = self.remaining_indices()
+        if self.pad and indices:
+            extra = -len(indices) % self.num_replicas
+            indices += (indices * (extra // len(indices) + 1))[:extra]
+
+        return iter(indices[self.rank::self.num_replicas])
+
+    def set_epoch(self, epoch):
+        """Start `epoch` from its first sample."""
+        self.epoch = epoch
+        self.offset = 0
+
+    def state_dict(self, consumed=0):
+        """State after this rank consumed `consumed` more samples of the current pass."""
+        offset = min(self.offset + consumed * self.num_replicas, len(self.dataset))
+        return {'epoch': self.epoch, 'seed': self.seed, 'offset': offset}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.seed = state['seed']
+        self.offset = state['offset']
+
+    def set_replicas(self, num_replicas, rank):
+        """Repartition the rest of the epoch over a new set of ranks."""
+        self.num_replicas = num_replicas
+        self.rank = rank
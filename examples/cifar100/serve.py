@@ -0,0 +1,262 @@
+'''Dynamic-batching HTTP inference server for trained checkpoints.
+
+python serve.py --checkpoint checkpoint/wide-resnet-28x10-best.pth --max-batch 32 --max-wait-ms 5
+
+POST /predict  body: an encoded image (PNG/JPEG) or, with Content-Type
+               application/octet-stream, raw HxWx3 uint8 pixels at the
+               dataset resolution (32 for CIFAR100, 64 for TinyImageNet).
+               Returns {"top": [[class, probability], ...]}.
+GET  /stats    latency percentiles (queue, inference, total) and the batch
+               size histogram since start or the last ?reset.
+GET  /health
+
+Requests wait in a queue until --max-batch of them are there or the oldest
+waited --max-wait-ms; the batch then runs in one forward pass on a worker
+thread under torch.inference_mode(), so the event loop keeps accepting
+requests meanwhile. Only the standard library and torch are used.
+'''
+from __future__ import print_function
+
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+import config as cf
+from augment import BatchAugment, ToUint8Tensor
+from checkpoint import find_checkpoint, load_checkpoint
+from models import get_network
+from inplace_abn import convert_inplace_abn
+
+
+__all__ = ['DynamicBatcher', 'LatencyStats']
+
+# source resolution, crop fed to the model, normalization
+DATASETS = {
+    'CIFAR100': (32, 32, cf.mean['cifar100'], cf.std['cifar100']),
+    'TinyImageNet': (64, 56, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+}
+
+
+class LatencyStats(object):
+    """Latencies of the last `window` requests and a histogram of batch sizes."""
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.requests = 0
+        self.batches = collections.Counter()
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+
+    def add(self, **latencies):
+        self.requests += 1
+        for name, value in latencies.items():
+            self.latency[name].append(value)
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        result = {
+            'requests': self.requests,
+            'requests_per_sec': round(self.requests / max(elapsed, 1e-9), 2),
+            'batch_size_histogram': dict((str(k), v) for k, v in sorted(self.batches.items())),
+            'mean_batch_size': round(sum(k * v for k, v in self.batches.items()) / max(sum(self.batches.values()), 1), 2),
+        }
+        for name, values in self.latency.items():
+            if values:
+                result[name + '_ms'] = dict(('p%d' % q, round(1000. * np.percentile(values, q), 3)) for q in (50, 90, 99))
+        return result
+
+
+class DynamicBatcher(object):
+    """Collects single images into batches and runs `model` on a worker thread."""
+
+    def __init__(self, model, augment, max_batch=32, max_wait=0.005, top_k=5, stats=None):
+        self.model = model
+        self.augment = augment
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.top_k = top_k
+        self.stats = stats or LatencyStats()
+        self.queue = asyncio.Queue()
+        # one thread: batches run one after another, each using the intra-op pool
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future, time.time()))
+        return await future
+
+    def _forward(self, images):
+        with torch.inference_mode():
+            logits = self.model(self.augment(torch.stack(images)))
+            probs, classes = logits.float().softmax(1).topk(self.top_k, 1)
+        return classes.tolist(), probs.tolist()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    # backlog from the previous forward pass joins regardless of the deadline
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            started = time.time()
+            try:
+                classes, probs = await loop.run_in_executor(self.executor, self._forward, [b[0] for b in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finished = time.time()
+            self.stats.batches[len(batch)] += 1
+            for (_, future, arrived), c, p in zip(batch, classes, probs):
+                self.stats.add(queue=started - arrived, inference=finished - started, total=finished - arrived)
+                if not future.done():
+                    future.set_result({'top': [[k, round(v, 5)] for k, v in zip(c, p)]})
+
+
+async def read_request(reader):
+    """(method, path, headers, body) of the next HTTP/1.1 request, None on EOF."""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode()
+    writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n'
+                  % (status, len(body), 'keep-alive' if keep_alive else 'close')).encode() + body)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dynamic-batching inference server')
+    parser.add_argument('--checkpoint', default='', type=str, help='checkpoint file (default: best checkpoint in --checkpoint-dir)')
+    parser.add_argument('--checkpoint-dir', default='./checkpoint', type=str, help='directory searched without --checkpoint')
+    parser.add_argument('--torchscript', default='', type=str, help='serve a model written by export.py instead of a checkpoint')
+    parser.add_argument('--dataset', default=None, choices=sorted(DATASETS), help='input resolution and normalization (default: the checkpoint config, else CIFAR100)')
+    parser.add_argument('--arch', default='WIDERESNET', type=str, help='used when the checkpoint has no config')
+    parser.add_argument('--depth', default=28, type=int, help='used when the checkpoint has no config')
+    parser.add_argument('--widen_factor', default=10, type=int, help='used when the checkpoint has no config')
+    parser.add_argument('--num-classes', default=100, type=int, help='used when the checkpoint has no config')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='listen address')
+    parser.add_argument('--port', default=8080, type=int, help='listen port')
+    parser.add_argument('--max-batch', default=32, type=int, help='largest batch run in one forward pass')
+    parser.add_argument('--max-wait-ms', default=5., type=float, help='longest a request waits for the batch to fill')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op threads of the forward pass (0: torch default)')
+    parser.add_argument('--top-k', default=5, type=int, help='classes returned per image')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config = {}
+
+    if args.torchscript:
+        model = torch.jit.load(args.torchscript, map_location='cpu')
+        print('| Serving %s' % args.torchscript)
+    else:
+        path = args.checkpoint or find_checkpoint(args.checkpoint_dir, get_network(
+            args.arch, args.depth, args.widen_factor, 0., args.num_classes)[1], 'best')
+        assert path, 'Error: No checkpoint found!'
+        checkpoint = load_checkpoint(path)
+        config = checkpoint.get('config') or {}
+        model, _ = get_network(config.get('arch', args.arch), config.get('depth', args.depth),
+                               config.get('widen_factor', args.widen_factor), 0.,
+                               config.get('num_classes', args.num_classes))
+        if config.get('inplace_abn'):
+            convert_inplace_abn(model, config['inplace_abn'])
+        model.load_state_dict(checkpoint['net'])
+        print('| Serving %s' % path)
+    model.eval()
+    dataset = args.dataset or config.get('dataset', 'CIFAR100')
+    assert dataset in DATASETS, 'Error: no input transform for dataset %s' % dataset
+    source_size, crop_size, mean, std = DATASETS[dataset]
+
+    decode = transforms.Compose([transforms.Resize(source_size), transforms.CenterCrop(source_size), ToUint8Tensor()])
+    batcher = DynamicBatcher(model, BatchAugment(mean, std, crop_size, train=False),
+                             args.max_batch, args.max_wait_ms / 1000., args.top_k)
+
+    def parse_image(headers, body):
+        if headers.get('content-type') == 'application/octet-stream':
+            pixels = np.frombuffer(body, dtype=np.uint8).reshape(source_size, source_size, 3)
+            return torch.from_numpy(pixels.copy()).permute(2, 0, 1)
+        return decode(Image.open(io.BytesIO(body)).convert('RGB'))
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', 'keep-alive').lower() != 'close'
+                if method == 'POST' and path == '/predict':
+                    try:
+                        image = parse_image(headers, body)
+                    except Exception as e:
+                        write_response(writer, '400 Bad Request', {'error': str(e)}, keep_alive)
+                    else:
+                        try:
+                            prediction = await batcher.predict(image)
+                        except Exception as e:
+                            # the batch failed in the model; this request still gets an answer
+                            write_response(writer, '500 Internal Server Error', {'error': str(e)}, keep_alive)
+                        else:
+                            write_response(writer, '200 OK', prediction, keep_alive)
+                elif method == 'GET' and path.startswith('/stats'):
+                    write_response(writer, '200 OK', batcher.stats.summary(), keep_alive)
+                    if path.endswith('?reset'):
+                        batcher.stats.reset()
+                elif method == 'GET' and path == '/health':
+                    write_response(writer, '200 OK', {'status': 'ok'}, keep_alive)
+                else:
+                    write_response(writer, '404 Not Found', {'error': path}, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, args.host, args.port)
+        print('| Listening on http://%s:%d (max batch %d, max wait %.1f ms, %d threads)' % (
+            args.host, args.port, args.max_batch, args.max_wait_ms, torch.get_num_threads()))
+        worker = asyncio.ensure_future(batcher.run())
+        async with server:
+            await server.serve_forever()
+        worker.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+'''Node-wide shared-memory cache of decoded CIFAR images.
+
+Local rank 0 unpickles the torchvision dataset once and writes it as a packed
+split (see packed.py) under /dev/shm; every other local rank and every loader
+worker maps the same pages read-only instead of holding a private copy. The
+cache name carries a hash of the dataset's resolved path, size and mtime, so
+another --datadir or a replaced dataset gets its own cache instead of a stale
+one.
+'''
+import os
+import resource
+import zlib
+
+import numpy as np
+import torchvision
+
+from packed import create_packed, packed_exists
+
+
+__all__ = ['cache_cifar100', 'memory_usage_mb']
+
+
+def cache_cifar100(root, train, local_rank, barrier, cache_dir='/dev/shm'):
+    """Return the packed prefix of the CIFAR-100 split, materializing it on local rank 0.
+
+    barrier() must block until every local rank reached it (a global barrier
+    will do); the cache is kept across launches and rebuilt only when missing.
+    """
+    split = 'train' if train else 'test'
+    source = os.path.realpath(os.path.join(root, 'cifar-100-python', split))
+    key = source
+    if os.path.exists(source):
+        key += '|%d|%d' % (os.path.getsize(source), int(os.path.getmtime(source)))
+    prefix = os.path.join(cache_dir, 'cifar100-%s-%d-%08x' % (split, os.getuid(), zlib.crc32(key.encode()) & 0xffffffff))
+    if local_rank == 0 and not packed_exists(prefix):
+        dataset = torchvision.datasets.CIFAR100(root=root, train=train, download=False)
+        data = getattr(dataset, 'data', None)
+        if data is None:
+            data = dataset.train_data if train else dataset.test_data
+        targets = getattr(dataset, 'targets', None)
+        if targets is None:
+            targets = dataset.train_labels if train else dataset.test_labels
+        images, labels, flush = create_packed(prefix, len(data), data.shape[1], data.shape[2],
+                                              getattr(dataset, 'classes', None))
+        images[:] = data
+        labels[:] = np.asarray(targets, dtype=np.int64)
+        flush()
+        del dataset, data
+    barrier()
+
+    return prefix
+
+
+def memory_usage_mb():
+    """(rss, pss) of this process in MB; pss splits shared pages among their users."""
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] in ('Rss:', 'Pss:'):
+                    usage[fields[0]] = float(fields[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    if 'Rss:' not in usage:
+        usage['Rss:'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    return usage['Rss:'], usage.get('Pss:', usage['Rss:'])
@@ -0,0 +1,129 @@
+'''Per-iteration step-time breakdown with images/sec aggregated across ranks.
+
+Usage inside the training loop:
+
+    timer.begin()
+    for inputs, targets in loader:
+        timer.mark('data')
+        ...forward...;   timer.mark('forward')
+        ...backward...;  timer.mark('backward')
+        ...allreduce...; timer.mark('comm')
+        ...update...;    timer.mark('optimizer')
+        ...metrics...;   timer.mark('metrics')
+        timer.end_step(inputs.size(0))
+
+Host timestamps are taken on every step; the device is synchronized only on
+sampled steps (every `interval`-th), which are the ones the phase breakdown is
+computed from, so the overhead between samples is a few perf_counter calls.
+A `monitor` (straggler.StragglerMonitor) is updated on every rank with the
+gathered per-rank statistics and adds its fields to the record.
+'''
+from __future__ import print_function
+
+import json
+import sys
+import time
+
+import torch
+
+
+__all__ = ['StepTimer']
+
+PHASES = ('data', 'forward', 'backward', 'comm', 'optimizer', 'metrics')
+
+
+class StepTimer(object):
+    """Records per-phase step times and emits one JSON line per window.
+
+    allgather(tensor) must concatenate a (1, K) tensor from every rank along
+    dim 0; only rank 0 writes records, to `out` (a file path) or stdout.
+    """
+
+    def __init__(self, interval, device, rank=0, allgather=None, out='', monitor=None):
+        self.interval = max(interval, 1)
+        self.device = device
+        self.rank = rank
+        self.allgather = allgather
+        self.out = out
+        self.monitor = monitor
+        self.epoch = 0
+        self.step = 0
+        self.reset_window()
+
+    def reset_window(self):
+        self.phase_time = dict((phase, 0.) for phase in PHASES)
+        self.sampled_steps = 0
+        self.window_steps = 0
+        self.images = 0
+        self.window_start = time.time()
+
+    def sampled(self):
+        return self.step % self.interval == self.interval - 1
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def begin(self, epoch=None):
+        if epoch is not None:
+            self.epoch = epoch
+        # evaluation between epochs is not training throughput
+        self.reset_window()
+        self.last = time.time()
+
+    def mark(self, phase):
+        if self.sampled():
+            self._sync()
+            now = time.time()
+            self.phase_time[phase] += now - self.last
+        else:
+            now = time.time()
+        self.last = now
+
+    def end_step(self, batch_size):
+        self.images += batch_size
+        self.window_steps += 1
+        if self.sampled():
+            self.sampled_steps += 1
+            self.emit()
+        self.step += 1
+
+    def emit(self):
+        elapsed = time.time() - self.window_start
+        local = [self.phase_time[phase] / self.sampled_steps for phase in PHASES]
+        local = torch.tensor([local + [self.images, self.window_steps, elapsed]], dtype=torch.float64)
+        stats = self.allgather(local) if self.allgather is not None else local
+        self.reset_window()
+        phases, images, steps, elapsed = stats[:, :len(PHASES)], stats[:, -3], stats[:, -2], stats[:, -1]
+        extra = {}
+        if self.monitor is not None:
+            # everything but the wait for the other ranks' gradients
+            busy = phases.sum(1) - phases[:, PHASES.index('comm')]
+            extra = self.monitor.update(busy, images / steps)
+        # emit() itself must not show up as data wait of the next step
+        self.last = time.time()
+        if self.rank != 0:
+            return
+
+        rank_rate = images / elapsed
+        record = {
+            'epoch': self.epoch,
+            'step': self.step + 1,
+            'time': time.time(),
+            'ranks': stats.size(0),
+            'images_per_sec': round(rank_rate.sum().item(), 1),
+            'rank_images_per_sec': [round(r, 1) for r in rank_rate.tolist()],
+            'step_ms': dict((phase, round(1000. * phases[:, i].mean().item(), 3)) for i, phase in enumerate(PHASES)),
+            'step_ms_max': dict((phase, round(1000. * phases[:, i].max().item(), 3)) for i, phase in enumerate(PHASES)),
+        }
+        record.update(extra)
+        self.write(record)
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        if self.out:
+            with open(self.out, 'a') as f:
+                f.write(line + '\n')
+        else:
+            print(line)
+            sys.stdout.flush()
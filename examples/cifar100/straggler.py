@@ -0,0 +1,138 @@
+'''Straggler detection and per-rank batch rebalancing.
+
+Every allreduce waits for the slowest rank, so one slow host (thermal
+throttling, a noisy neighbour, a slow disk under the DataLoader) sets the pace
+of the whole job. StragglerMonitor is fed the per-rank phase times StepTimer
+allgathers for each stats window. A rank's busy time is its step time minus the
+gradient wait ('comm'), which is where the fast ranks idle; per image it gives
+the rank's cost. A rank above `threshold` times the median cost for `patience`
+windows in a row is reported as a straggler until it recovers.
+
+batch_sizes() splits the global batch in proportion to the smoothed throughput
+of the ranks while a straggler persists, so faster ranks carry more samples.
+RebalancingBatchSampler applies a split to the global permutation of a
+ResumableDistributedSampler: each global batch of B samples is cut into
+consecutive per-rank slices of b_r samples, so the global batch, the epoch and
+the resumable sampler state are the same as with equal batches. Horovod
+averages the rank gradients, so rank r scales its loss by loss_weight =
+b_r * size / B to make that average the mean gradient over all B samples.
+A split takes effect with the next epoch's iterator, identically on all ranks.
+'''
+from __future__ import print_function
+
+import torch
+from torch.utils.data import Sampler
+
+
+__all__ = ['StragglerMonitor', 'RebalancingBatchSampler', 'parse_straggler']
+
+
+def parse_straggler(spec):
+    """'3:0.05' -> (3, 0.05): rank 3 sleeps 0.05 s more per step of the nominal batch."""
+    rank, _, seconds = spec.partition(':')
+    return int(rank), float(seconds)
+
+
+class StragglerMonitor(object):
+    """Flags ranks whose time per image stays above threshold x the median.
+
+    update() receives the same allgathered statistics on every rank, so every
+    rank reaches the same verdict; only a verbose monitor prints. `batch_size`
+    is the per-rank batch without rebalancing.
+    """
+
+    def __init__(self, batch_size, threshold=1.25, patience=3, min_batch=1, momentum=0.5, hosts=None, verbose=True):
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.patience = patience
+        self.min_batch = min_batch
+        self.momentum = momentum
+        self.hosts = hosts
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self, ranks=0):
+        self.strikes = [0] * ranks
+        self.rate = None
+        self.stragglers = []
+
+    def _name(self, rank):
+        if self.hosts is not None and rank < len(self.hosts):
+            return 'rank %d (%s)' % (rank, self.hosts[rank])
+        return 'rank %d' % rank
+
+    def update(self, busy, images):
+        """busy: seconds of work per step, images: images per step, one entry per rank."""
+        busy, images = busy.double(), images.double()
+        if len(self.strikes) != busy.numel():
+            self.reset(busy.numel())
+        cost = busy / images.clamp(min=1)
+        median = cost.median()
+        slow = (cost > self.threshold * median).tolist()
+        self.strikes = [s + 1 if flag else 0 for s, flag in zip(self.strikes, slow)]
+        rate = 1. / cost.clamp(min=1e-9)
+        self.rate = rate if self.rate is None else self.momentum * self.rate + (1 - self.momentum) * rate
+
+        stragglers = [r for r, s in enumerate(self.strikes) if s >= self.patience]
+        if self.verbose:
+            for r in stragglers:
+                if r not in self.stragglers:
+                    print('| Straggler: %s at %.2fx the median time per image for %d windows'
+                          % (self._name(r), (cost[r] / median).item(), self.strikes[r]))
+            for r in self.stragglers:
+                if r not in stragglers:
+                    print('| Straggler: %s recovered' % self._name(r))
+        self.stragglers = stragglers
+        return {'rank_ms_per_image': [round(1000. * c, 4) for c in cost.tolist()],
+                'stragglers': stragglers}
+
+    def batch_sizes(self, ranks):
+        """Per-rank batches summing to ranks * batch_size; equal unless a straggler persists."""
+        total = self.batch_size * ranks
+        if not self.stragglers or self.rate is None or self.rate.numel() != ranks:
+            return [self.batch_size] * ranks
+        share = self.rate / self.rate.sum()
+        raw = self.min_batch + share * (total - self.min_batch * ranks)
+        sizes = raw.floor().long()
+        # the samples lost to rounding go to the largest remainders
+        rest = total - int(sizes.sum().item())
+        sizes[(raw - sizes.double()).argsort(descending=True)[:rest]] += 1
+        return sizes.tolist()
+
+
+class RebalancingBatchSampler(Sampler):
+    """Batch sampler cutting rank `sampler.rank`'s slice out of every global batch.
+
+    The trailing partial global batch is dropped; len() is the number of
+    batches left in the current pass of `sampler`.
+    """
+
+    def __init__(self, sampler, batch_size):
+        self.sampler = sampler
+        self.set_sizes([batch_size] * sampler.num_replicas)
+
+    def set_sizes(self, sizes):
+        assert len(sizes) == self.sampler.num_replicas and min(sizes) >= 1, 'Error: bad batch split %s' % sizes
+        self.sizes = list(sizes)
+
+    @property
+    def global_batch(self):
+        return sum(self.sizes)
+
+    @property
+    def batch_size(self):
+        return self.sizes[self.sampler.rank]
+
+    @property
+    def loss_weight(self):
+        return float(self.batch_size * len(self.sizes)) / self.global_batch
+
+    def __len__(self):
+        return (len(self.sampler.dataset) - self.sampler.offset) // self.global_batch
+
+    def __iter__(self):
+        total, start = self.global_batch, sum(self.sizes[:self.sampler.rank])
+        end = start + self.batch_size
+        indices = self.sampler.remaining_indices()
+        for first in range(0, len(indices) - total + 1, total):
+            yield indices[first + start:first + end]
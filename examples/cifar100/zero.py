@@ -0,0 +1,234 @@
+'''ZeRO-style sharding of optimizer state across Horovod ranks.
+
+(Rajbhandari et al., ZeRO: Memory Optimizations Toward Training Trillion
+Parameter Models, https://arxiv.org/abs/1910.02054, stages 1 and 2)
+
+ShardedOptimizer packs parameters and gradients into flat buckets
+(flat_optim.FlatBucket) padded to a multiple of hvd.size(); rank r owns the
+r-th contiguous slice of every bucket. Once backward has filled a bucket, its
+gradient is reduce-scattered, so every rank receives the average of only its
+slice. The wrapped optimizer is rebuilt over the slices: it keeps momentum (or
+Adam's moments) for 1/size of the model and updates only that part, and the
+updated slices are allgathered back into the full parameters. A reduce-scatter
+plus an allgather move as many bytes as one ring allreduce; parameters and
+gradients stay replicated. The wrapped optimizer must update elementwise (SGD,
+Adam, AdamW); LARS/LAMB trust ratios need per-layer norms a slice lacks.
+
+state_dict() holds this rank's slices and the bucket layout.
+consolidate_state_dicts() merges the shards of all ranks into the layout of
+the wrapped optimizer (consolidate_zero.py does it on disk); load_state_dict()
+takes a shard of the same rank and size or such a merged state dict, which it
+slices, so a merged checkpoint resumes on any number of ranks.
+'''
+import contextlib
+
+import torch
+import horovod.torch as hvd
+
+from flat_optim import FlatBucket, _split
+
+
+__all__ = ['ShardedOptimizer', 'consolidate_state_dicts', 'state_bytes']
+
+
+def state_bytes(optimizer):
+    """Bytes of the tensors kept in optimizer.state (momentum, moments)."""
+    return sum(t.numel() * t.element_size() for state in optimizer.state.values()
+               for t in state.values() if torch.is_tensor(t))
+
+
+def _views(flat, bucket):
+    offset = 0
+    for shape, stride in zip(bucket['shapes'], bucket['strides']):
+        yield flat.as_strided(shape, stride, offset)
+        offset += int(torch.Size(shape).numel())
+
+
+def _flatten(tensors, bucket):
+    # laid out like the bucket itself, so channels_last tensors land where their parameter is
+    flat = torch.zeros(bucket['padded'], dtype=tensors[0].dtype)
+    for view, tensor in zip(_views(flat, bucket), tensors):
+        view.copy_(tensor)
+    return flat
+
+
+def consolidate_state_dicts(shards):
+    """Merge the state_dict() of every rank into the layout of the wrapped optimizer."""
+    shards = sorted(shards, key=lambda s: s['zero']['rank'])
+    layout = shards[0]['zero']
+    assert [s['zero']['rank'] for s in shards] == list(range(layout['size'])), \
+        'Error: need the shards of all %d ranks' % layout['size']
+
+    index = {}
+    for names in layout['groups']:
+        for name in names:
+            index[name] = len(index)
+    state = {}
+    for i, bucket in enumerate(layout['buckets']):
+        for key, value in shards[0]['state'].get(i, {}).items():
+            if torch.is_tensor(value) and value.dim() == 1 and value.numel() * layout['size'] == bucket['padded']:
+                flat = torch.cat([s['state'][i][key].cpu() for s in shards])
+                values = [v.clone() for v in _views(flat, bucket)]
+            else:
+                # per-step scalars such as Adam's step count are the same on every rank
+                values = [value.clone() if torch.is_tensor(value) else value for _ in bucket['names']]
+            for name, v in zip(bucket['names'], values):
+                state.setdefault(index[name], {})[key] = v
+
+    param_groups = []
+    for group, names in zip(shards[0]['param_groups'], layout['groups']):
+        param_groups.append(dict([(k, v) for k, v in group.items() if k != 'params'],
+                                 params=[index[name] for name in names]))
+    return {'state': state, 'param_groups': param_groups}
+
+
+class ShardedOptimizer(object):
+    """Wraps a torch optimizer; every rank keeps and updates 1/size of its state.
+
+    `optimizer` serves as a template (class, defaults, param groups) and is
+    rebuilt over this rank's slices. sync_overflow=True makes every rank see a
+    non-finite gradient when any slice has one, so a GradScaler skips the step
+    on all ranks together. Mirrors the parts of hvd.DistributedOptimizer the
+    training loop uses: synchronize(), skip_synchronize(), param_groups.
+    """
+
+    def __init__(self, optimizer, named_parameters, bucket_size_mb=25., backward_passes_per_step=1,
+                 sync_overflow=False):
+        names = dict((p, name) for name, p in named_parameters)
+        self.size, self.rank = hvd.size(), hvd.rank()
+        self.backward_passes_per_step = backward_passes_per_step
+        self.sync_overflow = sync_overflow
+        self.buckets, self.shards = [], []
+        self.layout = {'size': self.size, 'rank': self.rank, 'groups': [], 'buckets': []}
+        shard_groups = []
+        for group_index, group in enumerate(optimizer.param_groups):
+            params = [p for p in group['params'] if p.requires_grad]
+            self.layout['groups'].append([names[p] for p in params])
+            shards = []
+            for chunk in _split(params[::-1], bucket_size_mb * 2.**20):
+                bucket = FlatBucket(chunk, pad_to=self.size, momentum=False)
+                # shares storage with this rank's slice of the bucket
+                shard = bucket.param.view(self.size, -1)[self.rank].detach().requires_grad_()
+                self.buckets.append(bucket)
+                shards.append(shard)
+                self.layout['buckets'].append({
+                    'group': group_index, 'names': [names[p] for p in chunk], 'shapes': [list(p.size()) for p in chunk],
+                    'strides': [list(p.stride()) for p in chunk], 'padded': bucket.param.numel()})
+            self.shards.extend(shards)
+            shard_groups.append(dict([(k, v) for k, v in group.items() if k != 'params'], params=shards))
+        self.optimizer = type(optimizer)(shard_groups, **optimizer.defaults)
+
+        self._skip_synchronize = False
+        self._handles = {}
+        self._arrived = [0] * len(self.buckets)
+        self.bytes_per_step = sum(b.nbytes for b in self.buckets)
+        self.compression_ratio = 1.
+        for index, bucket in enumerate(self.buckets):
+            for p in bucket.params:
+                p.register_post_accumulate_grad_hook(self._make_hook(index))
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    @property
+    def shard_numel(self):
+        return sum(s.numel() for s in self.shards)
+
+    def _make_hook(self, index):
+        expected = len(self.buckets[index].params) * self.backward_passes_per_step
+
+        def hook(p):
+            self._arrived[index] += 1
+            if self._arrived[index] == expected:
+                self._reducescatter(index)
+        return hook
+
+    def _reducescatter(self, index):
+        self._handles[index] = hvd.reducescatter_async(self.buckets[index].grad, name='zero.grad.%d' % index,
+                                                       op=hvd.Average)
+
+    def zero_grad(self):
+        for bucket in self.buckets:
+            bucket.grad.zero_()
+
+    def synchronize(self):
+        for index in range(len(self.buckets)):
+            if index not in self._handles:
+                self._reducescatter(index)
+        for index, handle in self._handles.items():
+            self.shards[index].grad = hvd.synchronize(handle)
+        self._handles.clear()
+        self._arrived = [0] * len(self.buckets)
+
+        if self.sync_overflow:
+            local = torch.stack([(~torch.isfinite(s.grad)).any() for s in self.shards]).any().float()
+            overflow = hvd.allreduce(local.view(1), name='zero.overflow', op=hvd.Sum)
+            # NaN in the first slice of every rank; no host sync needed
+            self.shards[0].grad[:1].add_(torch.where(overflow > 0, float('nan'), 0.))
+
+    @contextlib.contextmanager
+    def skip_synchronize(self):
+        self._skip_synchronize = True
+        try:
+            yield
+        finally:
+            self._skip_synchronize = False
+
+    def step(self, closure=None):
+        if not self._skip_synchronize:
+            self.synchronize()
+        loss = self.optimizer.step(closure)
+        with torch.no_grad():
+            handles = [hvd.allgather_async(shard.detach(), name='zero.param.%d' % index)
+                       for index, shard in enumerate(self.shards)]
+            for bucket, handle in zip(self.buckets, handles):
+                bucket.param.copy_(hvd.synchronize(handle))
+        return loss
+
+    def state_dict(self):
+        state_dict = self.optimizer.state_dict()
+        state_dict['zero'] = self.layout
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        if 'zero' in state_dict:
+            layout = state_dict['zero']
+            assert (layout['size'], layout['rank']) == (self.size, self.rank), \
+                'Error: optimizer shard of rank %d of %d; merge the shards with consolidate_zero.py' % (layout['rank'], layout['size'])
+            state_dict = dict((k, v) for k, v in state_dict.items() if k != 'zero')
+        else:
+            state_dict = self._slice(state_dict)
+        self.optimizer.load_state_dict(state_dict)
+
+    def _slice(self, full):
+        """This rank's part of a state dict in the layout of the wrapped optimizer."""
+        index = {}
+        for group, names in zip(full['param_groups'], self.layout['groups']):
+            assert len(group['params']) == len(names), 'Error: optimizer state of a different model'
+            index.update(zip(names, group['params']))
+        state = {}
+        for i, bucket in enumerate(self.layout['buckets']):
+            per_param = [full['state'].get(index[name], {}) for name in bucket['names']]
+            keys = set(k for s in per_param for k in s)
+            for key in keys:
+                values = [s.get(key) for s in per_param]
+                first = next((v for v in values if v is not None), None)
+                if torch.is_tensor(first) and first.dim() > 0:
+                    # a parameter without state yet starts from zeros
+                    flat = _flatten([v if v is not None else torch.zeros(shape)
+                                     for v, shape in zip(values, bucket['shapes'])], bucket)
+                    state.setdefault(i, {})[key] = flat.view(self.size, -1)[self.rank].clone()
+                elif first is not None:
+                    state.setdefault(i, {})[key] = first
+        param_groups = []
+        shard_ids = iter(range(len(self.shards)))
+        for group, inner in zip(full['param_groups'], self.optimizer.param_groups):
+            param_groups.append(dict([(k, v) for k, v in group.items() if k != 'params'],
+                                     params=[next(shard_ids) for _ in inner['params']]))
+        return {'state': state, 'param_groups': param_groups}
+